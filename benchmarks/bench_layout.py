@@ -0,0 +1,107 @@
+"""
+Per-query I/O and latency of lazy SpecModel.get_flux for each HDF5 layout.
+
+Run with:  python benchmarks/bench_layout.py [--n-wave 20000] [--queries 300]
+
+A synthetic (teff, feh, logg) grid is written once per layout/filter
+combination. Every combination is then opened lazily and queried at the
+same random points. The I/O bytes are the bytes read through read
+syscalls (/proc/self/io rchar, Linux only), so they include reads served
+by the page cache but not those served by the HDF5 chunk cache.
+"""
+import os
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+from stellarSpecModel.SpecGrid import SpecGrid
+from stellarSpecModel.SpecModel import SpecModel
+
+
+CONFIGS = [
+    {'layout': 'contiguous'},
+    {'layout': 'spectrum'},
+    {'layout': 'spectrum', 'compression': 'lzf', 'shuffle': True},
+    {'layout': 'spectrum', 'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+    {'layout': 'cell'},
+    {'layout': 'cell', 'compression': 'lzf', 'shuffle': True},
+    {'layout': 'wave_tile', 'wave_tile': 4096},
+]
+
+
+def read_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def make_grid(n_wave, shape=(20, 6, 8), seed=0):
+    rng = np.random.default_rng(seed)
+    wave = np.geomspace(3000, 30000, n_wave)
+    axes = {'teff': np.linspace(3500, 8000, shape[0]),
+            'feh': np.linspace(-2.0, 0.5, shape[1]),
+            'logg': np.linspace(1.0, 5.0, shape[2])}
+    T = axes['teff'][:, None, None, None]
+    log_flux = 4 * np.log10(T) - 0.3 * np.log10(wave) + 0.01 * rng.standard_normal(shape + (n_wave,))
+    metadata = {'model_name': 'bench'}
+    return SpecGrid(wave, axes, ['teff', 'feh', 'logg'], log_flux.astype(np.float32), metadata=metadata)
+
+
+def bench(filepath, points):
+    with SpecGrid.from_hdf5(filepath, lazy=True) as grid:
+        model = SpecModel(grid)
+        out = np.empty(grid.n_wave)
+        latencies = np.empty(len(points))
+        start_bytes = read_bytes()
+        for ind, (teff, feh, logg) in enumerate(points):
+            t0 = time.perf_counter()
+            model.get_flux(out=out, teff=teff, feh=feh, logg=logg)
+            latencies[ind] = time.perf_counter() - t0
+        stop_bytes = read_bytes()
+    io_bytes = None if start_bytes is None else (stop_bytes - start_bytes) / len(points)
+    return {
+        'file_bytes': os.path.getsize(filepath),
+        'io_bytes_per_query': io_bytes,
+        'latency_median_ms': float(np.median(latencies) * 1e3),
+        'latency_p90_ms': float(np.percentile(latencies, 90) * 1e3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--n-wave', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    grid = make_grid(args.n_wave)
+    rng = np.random.default_rng(1)
+    points = np.column_stack([rng.uniform(grid.axes[name][0], grid.axes[name][-1], args.queries)
+                              for name in grid.axis_names])
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for ind, options in enumerate(CONFIGS):
+            filepath = os.path.join(tmpdir, f'grid_{ind}.h5')
+            grid.to_hdf5(filepath, **options)
+            result = dict(options, **bench(filepath, points))
+            results.append(result)
+            io_bytes = result['io_bytes_per_query']
+            io_text = 'n/a' if io_bytes is None else f'{io_bytes / 1024:10.1f}'
+            label = ' '.join(f'{key}={value}' for key, value in options.items())
+            print(f'{label:60s} file {result["file_bytes"] / 1024 ** 2:8.1f} MB  '
+                  f'io/query {io_text} KB  median {result["latency_median_ms"]:7.3f} ms  '
+                  f'p90 {result["latency_p90_ms"]:7.3f} ms')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
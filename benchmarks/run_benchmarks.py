@@ -0,0 +1,346 @@
+"""
+Offline benchmark suite of the stellarSpecModel hot paths.
+
+Run with:  python benchmarks/run_benchmarks.py [--n-wave 20000] [--output results.json]
+           python benchmarks/run_benchmarks.py --compare old.json new.json
+
+Synthetic grids (see synthetic.py) are generated in a temporary directory,
+in the legacy layout for StellarSpecModel and in the SpecGrid layout for
+SpecModel, so nothing is downloaded. Every benchmark reports the median and
+the minimum time per call and the RSS of the process after it ran. The
+results are saved as JSON together with the machine, the versions and the
+grid sizes, so that two runs can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import subprocess
+import tempfile
+import numpy as np
+
+import synthetic
+
+
+BANDS = ['SDSSg', 'SDSSr', 'SDSSi', '2MASSJ', '2MASSH', '2MASSKs', 'W1', 'W2']
+
+
+def rss_bytes():
+    """current resident set size of the process"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def measure(func, repeat, number=1):
+    """time func() `repeat` times `number` calls, per-call median and minimum"""
+    func()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - t0) / number)
+    return {'median_s': float(np.median(times)), 'min_s': float(np.min(times)),
+            'calls': repeat * number, 'rss_bytes': rss_bytes()}
+
+
+def cycle(points):
+    """a function returning the rows of points one after the other, forever"""
+    state = {'ind': -1}
+
+    def next_point():
+        state['ind'] = (state['ind'] + 1) % len(points)
+        return points[state['ind']]
+    return next_point
+
+
+def random_points(axes, n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(axes[name][0], axes[name][-1], n) for name in ('teff', 'feh', 'logg')])
+
+
+def bench_import(args):
+    code = ('import time, json; t0 = time.perf_counter(); import stellarSpecModel; '
+            'seconds = time.perf_counter() - t0; '
+            'rss = [int(l.split()[1]) * 1024 for l in open("/proc/self/status") if l.startswith("VmRSS:")]; '
+            'print(json.dumps({"seconds": seconds, "rss": rss[0] if rss else None}))')
+    runs = []
+    for _ in range(max(3, args.repeat // 5)):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    seconds = [run['seconds'] for run in runs]
+    return {'import': {'median_s': float(np.median(seconds)), 'min_s': float(np.min(seconds)),
+                       'calls': len(runs), 'rss_bytes': runs[-1]['rss']}}
+
+
+def bench_stellar_spec_model(args, files):
+    from stellarSpecModel import StellarSpecModel, emulator
+    results = {'StellarSpecModel.__init__': measure(lambda: StellarSpecModel(files['legacy']), max(3, args.repeat // 10))}
+    model = StellarSpecModel(files['legacy'])
+    axes = {'teff': model.teff_grid, 'feh': model.feh_grid, 'logg': model.logg_grid}
+    points = random_points(axes, 1000)
+    next_point = cycle(points)
+    results['StellarSpecModel.get_flux'] = measure(lambda: model.get_flux(*next_point()), args.repeat, 20)
+    results['StellarSpecModel.get_flux_batch[1000]'] = measure(
+        lambda: model.get_flux_batch(points[:, 0], points[:, 1], points[:, 2]), max(3, args.repeat // 10))
+    model_mmap = StellarSpecModel(files['legacy'], mmap=True)
+    results['StellarSpecModel.get_flux[mmap]'] = measure(lambda: model_mmap.get_flux(*next_point()), args.repeat, 20)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        results['emulator.compress'] = measure(
+            lambda: emulator.compress(model, cache_dir=cache_dir, overwrite=True), max(3, args.repeat // 20))
+        pca_model = emulator.compress(model, cache_dir=cache_dir)
+    results['emulator.compress'].update(pca_model.emulator.report())
+    results['PCAStellarSpecModel.get_flux'] = measure(lambda: pca_model.get_flux(*next_point()), args.repeat, 20)
+    results['PCAStellarSpecModel.get_flux_batch[1000]'] = measure(
+        lambda: pca_model.get_flux_batch(points[:, 0], points[:, 1], points[:, 2]), max(3, args.repeat // 10))
+    return results
+
+
+def bench_spec_model(args, files):
+    from stellarSpecModel.SpecGrid import SpecGrid
+    from stellarSpecModel.SpecModel import SpecModel
+    results = {}
+    grid = SpecGrid.from_hdf5(files['spec_grid'], lazy=False)
+    model = SpecModel(grid)
+    valid_points = []
+    for point in random_points(grid.axes, 4000, seed=1):
+        _, invalid = model.interpolator.evaluate_one(point)
+        if not invalid:
+            valid_points.append(point)
+    valid_points = np.array(valid_points[:1000])
+    next_point = cycle(valid_points)
+
+    def query(spec_model, out=None):
+        teff, feh, logg = next_point()
+        return spec_model.get_flux(out=out, teff=teff, feh=feh, logg=logg)
+
+    out = np.empty(grid.n_wave)
+    results['SpecModel.get_flux'] = measure(lambda: query(model), args.repeat, 20)
+    results['SpecModel.get_flux[out]'] = measure(lambda: query(model, out), args.repeat, 20)
+    with SpecGrid.from_hdf5(files['spec_grid_chunked'], lazy=True) as lazy_grid:
+        lazy_model = SpecModel(lazy_grid)
+        results['SpecModel.get_flux[lazy]'] = measure(lambda: query(lazy_model, out), args.repeat, 20)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        wavelength = {'method': 'log', 'step': 5e-4}
+        results['SpecModel.derive[resample]'] = measure(
+            lambda: model.derive(wavelength=wavelength, cache_dir=cache_dir, overwrite=True), max(3, args.repeat // 20))
+        results['SpecModel.derive[stream]'] = measure(
+            lambda: model.derive(wavelength=wavelength, cache_dir=cache_dir, overwrite=True,
+                                 memory_budget=32 * 1024 ** 2).grid.close(), max(3, args.repeat // 20))
+    return results
+
+
+def bench_sed(args, files):
+    from stellarSpecModel import StellarSpecModel, SEDModel, BinarySEDModel
+    from stellarSpecModel.SED_model import ObservedSEDModel
+    results = {}
+    specmodel = StellarSpecModel(files['legacy'])
+    axes = {'teff': specmodel.teff_grid, 'feh': specmodel.feh_grid, 'logg': specmodel.logg_grid}
+    points = random_points(axes, 1000, seed=2)
+    next_point = cycle(points)
+    model = SEDModel(BANDS, specmodel=specmodel)
+
+    def get_SED():
+        teff, feh, logg = next_point()
+        model.set_SED_pars(teff, logg, feh, 1.0, 100.0, 0.5)
+        return model.get_SED()
+
+    results['SEDModel.get_SED'] = measure(get_SED, args.repeat, 20)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        model.enable_phot_grid(Av=np.linspace(0, 3, 7), cache_dir=cache_dir)
+        results['SEDModel.get_SED[phot_grid]'] = measure(get_SED, args.repeat, 20)
+        model.disable_phot_grid()
+
+    fluxes = model.get_SED_batch(5800, 4.4, 0.0, 1.0, 100.0, 0.5)[0][0]
+    observed = ObservedSEDModel(BANDS, specmodel=specmodel, observed_fluxes=fluxes, observed_errors=0.05 * fluxes)
+    thetas = np.column_stack([points[:64, 0], points[:64, 2], points[:64, 1], np.ones(64), np.full(64, 100.0),
+                              np.full(64, 0.5)])
+    results['ObservedSEDModel.log_likelihood[64 walkers]'] = measure(
+        lambda: observed.log_likelihood(thetas), max(3, args.repeat // 5))
+
+    fluxes2 = model.get_SED_batch(4500, 4.6, 0.0, 0.7, 100.0, 0.5)[0][0]
+    binary = BinarySEDModel(teff1=5800, feh1=0.0, logg1=4.4, R1=1.0, D=100.0, Av=0.5,
+                            teff2=4500, feh2=0.0, logg2=4.6, R2=0.7, specmodel=specmodel)
+    binary.add_data(BANDS, obs_fluxes=fluxes + fluxes2, obs_fluxerrs=0.05 * (fluxes + fluxes2))
+
+    def get_lnlike():
+        teff, feh, logg = next_point()
+        binary.set_pars(teff1=teff, feh1=feh, logg1=logg)
+        return binary.get_lnlike()
+
+    results['BinarySEDModel.get_lnlike'] = measure(get_lnlike, args.repeat, 20)
+    return results
+
+
+def bench_precision(args, files):
+    """float32 against float64: timings and max relative error of the fluxes, the SED and the likelihood"""
+    from stellarSpecModel import StellarSpecModel, SEDModel, config
+    from stellarSpecModel.SED_model import ObservedSEDModel
+    points = None
+    models = {}
+    for precision in ('float64', 'float32'):
+        config.set_precision(precision)
+        try:
+            specmodel = StellarSpecModel(files['legacy'])
+        finally:
+            config.set_precision('float64')
+        if points is None:
+            axes = {'teff': specmodel.teff_grid, 'feh': specmodel.feh_grid, 'logg': specmodel.logg_grid}
+            points = random_points(axes, 1000, seed=3)
+            fluxes = SEDModel(BANDS, specmodel=specmodel).get_SED_batch(5800, 4.4, 0.0, 1.0, 100.0, 0.5)[0][0]
+        models[precision] = ObservedSEDModel(BANDS, specmodel=specmodel, observed_fluxes=fluxes,
+                                             observed_errors=0.05 * fluxes)
+
+    results = {}
+    for precision, model in models.items():
+        specmodel = model.stellar_model
+        next_point = cycle(points)
+        out = model.workspace.band_fluxes
+
+        def get_SED():
+            teff, feh, logg = next_point()
+            model.set_SED_pars(teff, logg, feh, 1.0, 100.0, 0.5)
+            return model.get_SED(out=out)
+
+        def get_log_likelihood():
+            teff, feh, logg = next_point()
+            model.set_SED_pars(teff, logg, feh, 1.0, 100.0, 0.5)
+            return model.get_log_likelihood()
+
+        results[f'StellarSpecModel.get_flux[{precision}]'] = measure(
+            lambda: specmodel.get_flux(*next_point()), args.repeat, 20)
+        results[f'StellarSpecModel.get_flux[{precision}]']['grid_nbytes'] = specmodel.memory_report()['grid_nbytes']
+        results[f'StellarSpecModel.get_flux_batch[1000, {precision}]'] = measure(
+            lambda: specmodel.get_flux_batch(points[:, 0], points[:, 1], points[:, 2]), max(3, args.repeat // 10))
+        results[f'SEDModel.get_SED[{precision}]'] = measure(get_SED, args.repeat, 20)
+        results[f'ObservedSEDModel.get_log_likelihood[{precision}]'] = measure(get_log_likelihood, args.repeat, 20)
+
+    # accuracy of float32 against the float64 reference on the same points
+    errors = {'flux': 0.0, 'sed': 0.0, 'log_likelihood': 0.0}
+    for teff, feh, logg in points[:200]:
+        values = {}
+        for precision, model in models.items():
+            model.set_SED_pars(teff, logg, feh, 1.0, 100.0, 0.5)
+            values[precision] = (model.stellar_model.get_flux(teff, feh, logg), model.get_SED()[1],
+                                 model.get_log_likelihood())
+        for key, ref, val in zip(errors, values['float64'], values['float32']):
+            errors[key] = max(errors[key], float(np.max(np.abs(np.asarray(val, dtype=float) / ref - 1))))
+    results['StellarSpecModel.get_flux[float32]']['max_rel_error'] = errors['flux']
+    results['SEDModel.get_SED[float32]']['max_rel_error'] = errors['sed']
+    results['ObservedSEDModel.get_log_likelihood[float32]']['max_rel_error'] = errors['log_likelihood']
+    print(f"float32 max relative error: flux {errors['flux']:.2g}, SED {errors['sed']:.2g}, "
+          f"log-likelihood {errors['log_likelihood']:.2g}")
+    return results
+
+
+def metadata(args):
+    import h5py
+    import scipy
+    import stellarSpecModel
+    commit = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'h5py': h5py.__version__,
+        'stellarSpecModel': stellarSpecModel.__version__,
+        'commit': commit,
+        'grid': {'n_teff': args.n_teff, 'n_feh': args.n_feh, 'n_logg': args.n_logg, 'n_wave': args.n_wave},
+        'repeat': args.repeat,
+    }
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if old['meta']['grid'] != new['meta']['grid']:
+        print(f"warning: the grid sizes differ: {old['meta']['grid']} vs {new['meta']['grid']}")
+    print(f"{'benchmark':48s} {'old (ms)':>12s} {'new (ms)':>12s} {'new/old':>8s}")
+    for name in sorted(set(old['results']) | set(new['results'])):
+        old_s = old['results'].get(name, {}).get('median_s')
+        new_s = new['results'].get(name, {}).get('median_s')
+        ratio = f'{new_s / old_s:8.2f}' if old_s and new_s else f'{"-":>8s}'
+        old_text = f'{old_s * 1e3:12.4f}' if old_s else f'{"-":>12s}'
+        new_text = f'{new_s * 1e3:12.4f}' if new_s else f'{"-":>12s}'
+        print(f'{name:48s} {old_text} {new_text} {ratio}')
+
+
+SUITES = {
+    'import': lambda args, files: bench_import(args),
+    'stellar_spec_model': bench_stellar_spec_model,
+    'spec_model': bench_spec_model,
+    'sed': bench_sed,
+    'precision': bench_precision,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of stellarSpecModel on synthetic grids.')
+    parser.add_argument('--n-teff', type=int, default=30)
+    parser.add_argument('--n-feh', type=int, default=6)
+    parser.add_argument('--n-logg', type=int, default=10)
+    parser.add_argument('--n-wave', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50, help='timed repetitions of each benchmark')
+    parser.add_argument('--suites', nargs='+', default=list(SUITES), choices=list(SUITES))
+    parser.add_argument('--output', default=None, help='JSON file of the results, defaults to benchmarks/results/')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return None
+
+    sizes = {'n_teff': args.n_teff, 'n_feh': args.n_feh, 'n_logg': args.n_logg, 'n_wave': args.n_wave}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # config reads the environment at import, which synthetic has already done
+        from stellarSpecModel import config
+        config.cache_PATH = os.path.join(tmpdir, 'cache')
+        files = {
+            'legacy': synthetic.write_legacy_grid(os.path.join(tmpdir, 'legacy.hdf5'), **sizes),
+            'spec_grid': synthetic.write_spec_grid(os.path.join(tmpdir, 'spec_grid.h5'), **sizes),
+            'spec_grid_chunked': synthetic.write_spec_grid(os.path.join(tmpdir, 'spec_grid_chunked.h5'),
+                                                           layout='spectrum', **sizes),
+        }
+        for suite in args.suites:
+            suite_results = SUITES[suite](args, files)
+            for name, result in suite_results.items():
+                print(f"{name:48s} median {result['median_s'] * 1e3:10.4f} ms  "
+                      f"min {result['min_s'] * 1e3:10.4f} ms  rss {(result['rss_bytes'] or 0) / 1024 ** 2:8.1f} MB")
+            results.update(suite_results)
+
+    output = args.output
+    if output is None:
+        result_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        os.makedirs(result_dir, exist_ok=True)
+        output = os.path.join(result_dir, f"bench-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump({'meta': metadata(args), 'results': results}, f, indent=2)
+    print(f'results saved to {output}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
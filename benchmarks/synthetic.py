@@ -0,0 +1,65 @@
+"""
+Synthetic stellar grids for offline benchmarks.
+
+The spectra are smooth black-body-like curves whose shape depends on all
+the parameters, written either in the legacy layout read by
+StellarSpecModel (default/{wave,teff,feh,logg,spec_grid}) or in the
+SpecGrid layout read by SpecModel (wave, axes/*, flux_tensor, valid_mask).
+"""
+import numpy as np
+import h5py
+from stellarSpecModel.SpecGrid import SpecGrid
+
+
+def log_flux_tensor(n_teff=30, n_feh=6, n_logg=10, n_wave=20000, dtype=np.float32, seed=0):
+    """
+    Build the axes and the log10 flux tensor of a synthetic grid.
+
+    Returns:
+        tuple: (wave, axes, log_flux), axes is {'teff', 'feh', 'logg'} and
+        log_flux has shape (n_teff, n_feh, n_logg, n_wave).
+    """
+    rng = np.random.default_rng(seed)
+    wave = np.geomspace(1000, 50000, n_wave)
+    axes = {'teff': np.linspace(3000, 12000, n_teff),
+            'feh': np.linspace(-2.5, 0.5, n_feh),
+            'logg': np.linspace(0.0, 5.5, n_logg)}
+    T, F, G = np.meshgrid(axes['teff'], axes['feh'], axes['logg'], indexing='ij')
+    log_flux = np.empty((n_teff, n_feh, n_logg, n_wave), dtype=dtype)
+    log_wave = np.log10(wave)
+    for ind in range(n_teff):
+        x = 1.4388e8 / (wave * axes['teff'][ind])
+        shape = 25 - 5 * log_wave - np.log10(np.expm1(np.minimum(x, 700)))
+        log_flux[ind] = (shape + 0.1 * F[ind, ..., None] * (wave / 1e4)
+                         - 0.05 * G[ind, ..., None] * (log_wave - 3)
+                         + 0.001 * rng.standard_normal((n_feh, n_logg, 1)))
+    return wave, axes, log_flux
+
+
+def write_legacy_grid(path, **kwargs):
+    """write a grid in the default/spec_grid layout of StellarSpecModel"""
+    wave, axes, log_flux = log_flux_tensor(**kwargs)
+    with h5py.File(path, 'w') as f:
+        grid = f.create_group('default')
+        grid['wave'] = wave
+        grid['teff'] = axes['teff']
+        grid['feh'] = axes['feh']
+        grid['logg'] = axes['logg']
+        grid['spec_grid'] = log_flux
+    return path
+
+
+def spec_grid(hole_fraction=0.05, **kwargs):
+    """a SpecGrid of the synthetic spectra, with a fraction of invalid nodes"""
+    wave, axes, log_flux = log_flux_tensor(**kwargs)
+    rng = np.random.default_rng(kwargs.get('seed', 0) + 1)
+    valid_mask = rng.random(log_flux.shape[:-1]) >= hole_fraction
+    log_flux[~valid_mask] = np.nan
+    metadata = {'model_name': 'synthetic', 'wave_sampling': 'log'}
+    return SpecGrid(wave, axes, ['teff', 'feh', 'logg'], log_flux, valid_mask=valid_mask, metadata=metadata)
+
+
+def write_spec_grid(path, layout='contiguous', compression=None, shuffle=False, **kwargs):
+    """write a grid in the SpecGrid layout of SpecModel"""
+    spec_grid(**kwargs).to_hdf5(path, layout=layout, compression=compression, shuffle=shuffle)
+    return path
@@ -1,23 +1,106 @@
 import io
 import contextlib
 import pyphot
-import spectool
 import numpy as np
-from extinction import apply
-from extinction import fitzpatrick99
 from astropy import constants as cs
 import matplotlib.pyplot as plt
 from . import stellarSpecModel
+from . import registry
+from .phot_grid import PhotGrid
+from .projection import get_band_projector
+from . import reddening
+from . import instrument
 from .phot_util import flux_to_mag as f2m
 from .phot_util import mag_to_flux as m2f
 from .phot_util import filtername2pyphotname
 from .phot_util import fluxes_to_mags, mags_to_fluxes
+import logging
+logger = logging.getLogger(__name__)
+
+
+def profile_scale(obs_fluxes, sigmas, model_fluxes):
+    """best scale and chi-square of model band fluxes fitted to observed band fluxes
+
+    The observed fluxes are fitted by s * model_fluxes, the best s >= 0 and
+    its chi-square are solved in closed form for every (star, model) pair.
+    Bands with a non-finite observed flux or error are ignored.
+
+    Args:
+        obs_fluxes (numpy.ndarray): observed fluxes, shape (n_band,) or (n_star, n_band).
+        sigmas (numpy.ndarray): their errors, same shape as obs_fluxes.
+        model_fluxes (numpy.ndarray): model fluxes, shape (n_model, n_band).
+
+    Returns:
+        tuple: (scale, chisq), shape (n_model,) or (n_star, n_model). The
+        models with non-finite fluxes get a NaN scale and an infinite chisq.
+    """
+    obs_fluxes = np.asarray(obs_fluxes, dtype=float)
+    with np.errstate(divide='ignore'):
+        weights = 1.0 / np.asarray(sigmas, dtype=float)**2
+    missing = ~(np.isfinite(obs_fluxes) & np.isfinite(weights))
+    if np.any(missing):
+        weights = np.where(missing, 0.0, weights)
+        obs_fluxes = np.where(missing, 0.0, obs_fluxes)
+    obs_weighted = obs_fluxes * weights
+    obs_norm = np.sum(obs_weighted * obs_fluxes, axis=-1)
+    valid = np.all(np.isfinite(model_fluxes), axis=-1)
+    model_fluxes = np.where(valid[:, None], model_fluxes, 0.0)
+    cross = obs_weighted @ model_fluxes.T
+    norm = weights @ (model_fluxes**2).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.maximum(cross / norm, 0.0)
+    chisq = np.asarray(obs_norm)[..., None] - 2 * scale * cross + scale**2 * norm
+    chisq = np.where(valid & np.isfinite(chisq), chisq, np.inf)
+    scale = np.where(valid, scale, np.nan)
+    return scale, chisq
+
+
+class SEDWorkspace:
+    """
+    The preallocated buffers of the evaluations of one SEDModel.
+
+    get_SED(out=...) and the likelihood methods of ObservedSEDModel write
+    every intermediate result into these buffers: the spectrum (the
+    interpolated log10 flux, converted to flux, scaled and reddened in
+    place), the extinction factor (recomputed only when Av, Rv or the law
+    change), the band fluxes and the normalized residuals, so an evaluation
+    allocates no arrays. The buffers are overwritten by the next
+    evaluation, and a workspace should not be used by several threads at
+    once. The spectrum and the extinction factor are in the dtype of the
+    stellar model (see config.precision), the band fluxes and the residuals
+    in float64.
+
+    Attributes:
+        flux (numpy.ndarray): the spectrum, shape (n_wave,).
+        extinction (numpy.ndarray): 10 ** (-0.4 * A_lambda), shape (n_wave,).
+        band_fluxes (numpy.ndarray): the band fluxes, shape (n_band,).
+        residuals (numpy.ndarray): (band_fluxes - observed) / errors, shape (n_band,).
+        eff_waves (numpy.ndarray): effective wavelength of the bands (read-only), shape (n_band,).
+    """
+
+    def __init__(self, n_wave, eff_waves, dtype=np.float64):
+        self.flux = np.empty(n_wave, dtype=dtype)
+        self.extinction = np.empty(n_wave, dtype=dtype)
+        self.extinction_key = None
+        self.eff_waves = np.array(eff_waves, dtype=float)
+        self.eff_waves.flags.writeable = False
+        self.band_fluxes = np.empty(len(self.eff_waves))
+        self.residuals = np.empty(len(self.eff_waves))
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.flux, self.extinction, self.eff_waves, self.band_fluxes, self.residuals))
 
 
 class SEDModel:
+    # column order of the parameter arrays of get_SED_batch and log_likelihood
+    param_names = ('teff', 'logg', 'feh', 'R', 'distance', 'Av')
+    # upper limit of the spectra block of get_SED_batch, in bytes
+    max_block_bytes = 64 * 1024 ** 2
+
     def __init__(self, bands=None, teff=5700, logg=4.5, feh=0.0, 
                  R=1.0, distance=10.0, Av=0.0,
-                 specmodel=stellarSpecModel.BTCond_Model()):
+                 specmodel=None):
         """a class to generate stellar model SED
 
         Args:
@@ -28,11 +111,13 @@ class SEDModel:
             R (float, optional): radius of the stellar, unit is R_sun. Defaults to 1.0.
             distance (float, optional): distance of the stellar, unit is pc. Defaults to 10.0.
             Av (float, optional): Extinction Coefficient. Defaults to 0.0.
-            specmodel (stellarSpecModel, optional): stellarSpecModel used to generate the stellar spectrum. Defaults to stellarSpecModel.BTCond_Model().
+            specmodel (stellarSpecModel, optional): stellarSpecModel used to generate the stellar spectrum. Defaults to None, which uses the shared registry.get_model('BTCond').
 
         Raises:
             ValueError: if specmodel is not an instance of StellarSpecModel, raise ValueError
         """
+        if specmodel is None:
+            specmodel = registry.get_model('BTCond')
         if isinstance(specmodel, stellarSpecModel.StellarSpecModel):
             self.stellar_model = specmodel
         else:
@@ -44,6 +129,10 @@ class SEDModel:
         self.pyphot_lib = pyphot.get_library()
         self._rat_rsun_pc = cs.R_sun.to('pc').value
         self.Rv = 3.1
+        self.ext_law = 'F99'
+        self.phot_grid = None
+        self._projector = None
+        self._workspace = None
         self.teff = teff
         self.logg = logg
         self.feh = feh
@@ -79,6 +168,14 @@ class SEDModel:
 
     def set_Av(self, Av):
         self.Av = Av
+
+    def set_ext_law(self, law, Rv=None):
+        """set the extinction law, one of reddening.available_laws() ('F99', 'CCM89', 'O94')"""
+        if law not in reddening.available_laws():
+            raise ValueError(f'law should be one of {reddening.available_laws()}')
+        self.ext_law = law
+        if Rv is not None:
+            self.Rv = Rv
         
     def add_band(self, band):
         std_filtername = filtername2pyphotname(band)
@@ -91,33 +188,225 @@ class SEDModel:
         self.filters[std_filtername] = [waves, trans]
         self.eff_waves_SED.append(eff_wave)
         self.widths_band.append(width)
+        self._projector = None
+        self._workspace = None
+        if self.phot_grid is not None:
+            logger.warning('The band list changed, the phot grid fast mode is disabled')
+            self.phot_grid = None
 
     def add_bands(self, bands):
         for band in bands:
             self.add_band(band)
 
-    def get_SED_spec(self):
+    @property
+    def workspace(self):
+        """the SEDWorkspace of the model, rebuilt when the band list, the wavelength grid or the dtype changes"""
+        workspace = self._workspace
+        n_wave = len(self.stellar_model.wavelength)
+        dtype = self.stellar_model.dtype
+        if workspace is None or len(workspace.flux) != n_wave or workspace.flux.dtype != dtype:
+            workspace = self._workspace = SEDWorkspace(n_wave, self.eff_waves_SED, dtype=dtype)
+        return workspace
+
+    def _extinction_factor(self, waves):
+        """10 ** (-0.4 * A_lambda) of the current Av in the workspace, None for Av = 0"""
+        if self.Av == 0:
+            return None
+        workspace = self.workspace
+        key = (self.Av, self.Rv, self.ext_law, id(waves))
+        if workspace.extinction_key != key:
+            curve = reddening.get_curve(waves, self.Rv, self.ext_law, dtype=workspace.extinction.dtype)
+            np.multiply(curve, -0.4 * self.Av, out=workspace.extinction)
+            np.power(10.0, workspace.extinction, out=workspace.extinction)
+            workspace.extinction_key = key
+        return workspace.extinction
+
+    def get_SED_spec(self, out=None):
+        """the wavelength and the observed spectrum
+
+        Args:
+            out (numpy.ndarray, optional): (n_wave,) float array receiving
+                the spectrum, e.g. workspace.flux. Defaults to None.
+
+        Returns:
+            tuple: (waves, fluxes).
+        """
         waves = self.stellar_model.wavelength
-        fluxes = self.stellar_model.get_flux(self.teff, self.feh, self.logg)
-        rat = (self.rad / self.distance * self._rat_rsun_pc) ** 2
+        fluxes = self.stellar_model.get_flux(self.teff, self.feh, self.logg, out=out)
+        # a python float, so the scaling keeps the dtype of float32 spectra
+        rat = float((self.rad / self.distance * self._rat_rsun_pc) ** 2)
         fluxes *= rat
-        ext = fitzpatrick99(waves, self.Av, self.Rv)
-        nfluxes = apply(ext, fluxes)
-        return waves, nfluxes
-
-    def get_SED(self):
-        waves, fluxes = self.get_SED_spec()
-        waves_out, fluxes_out = [], []
-        for ind, band in enumerate(self.bands):
-            wave_filter, transmit = self.filters[band]
-            eff_wave = self.eff_waves_SED[ind]
-            flux_interp = spectool.pyrebin.rebin_padvalue(waves, fluxes, wave_filter)
-            widths = np.diff(wave_filter)
-            widths = np.append(widths, widths[-1])
-            flux_int = np.sum(flux_interp * transmit * widths) / np.sum(transmit * widths)
-            waves_out.append(eff_wave)
-            fluxes_out.append(flux_int)
-        return np.array(waves_out), np.array(fluxes_out)
+        factor = self._extinction_factor(waves)
+        if factor is not None:
+            with instrument.stage('extinction'):
+                fluxes *= factor
+        return waves, fluxes
+
+    def enable_phot_grid(self, Av=None, cache_dir=None, overwrite=False, progress=False):
+        """switch get_SED to the fast photometric mode
+
+        The band fluxes of the stellar model are compiled once on the grid
+        nodes (see PhotGrid.compile, the result is cached on disk) and
+        get_SED then interpolates the band fluxes directly instead of
+        integrating a full spectrum over every filter. Adding a band
+        disables the fast mode.
+
+        Args:
+            Av (array-like, optional): Av nodes of the phot grid. If None, Av is applied with per-band reddening coefficients. Defaults to None.
+            cache_dir (str, optional): cache directory of the phot grid. Defaults to config.cache_PATH.
+            overwrite (bool, optional): recompile the phot grid even if it is cached. Defaults to False.
+            progress (bool, optional): show a progress bar while compiling. Defaults to False.
+
+        Returns:
+            PhotGrid: the phot grid used by the model.
+        """
+        self.phot_grid = PhotGrid.compile(self.stellar_model, self.bands, Av=Av, Rv=self.Rv,
+                                          law=self.ext_law, filters=self.filters, cache_dir=cache_dir,
+                                          overwrite=overwrite, progress=progress)
+        return self.phot_grid
+
+    def disable_phot_grid(self):
+        self.phot_grid = None
+
+    def _get_SED_phot_grid(self, out=None):
+        if self.Rv != self.phot_grid.Rv or self.ext_law != self.phot_grid.law:
+            raise ValueError(f'(Rv, law) = ({self.Rv}, {self.ext_law}) differs from the '
+                             f'({self.phot_grid.Rv}, {self.phot_grid.law}) of the phot grid')
+        with instrument.stage('phot_grid'):
+            fluxes = self.phot_grid.get_band_fluxes(self.teff, self.feh, self.logg, self.Av, out=out)
+        fluxes *= (self.rad / self.distance * self._rat_rsun_pc) ** 2
+        if out is None:
+            return np.array(self.eff_waves_SED), fluxes
+        return self.workspace.eff_waves, fluxes
+
+    def get_SED(self, out=None):
+        """the effective wavelength and the flux of each band
+
+        Args:
+            out (numpy.ndarray, optional): (n_band,) float array receiving
+                the band fluxes, e.g. workspace.band_fluxes. The spectrum
+                then goes through the workspace buffers and the call
+                allocates no arrays; the returned wavelengths are the
+                read-only workspace.eff_waves. Defaults to None.
+
+        Returns:
+            tuple: (eff_waves, fluxes), shape (n_band,).
+        """
+        if self.phot_grid is not None:
+            return self._get_SED_phot_grid(out)
+        if out is None:
+            waves, fluxes = self.get_SED_spec()
+            return np.array(self.eff_waves_SED), self.projector.apply(fluxes, out=np.empty(len(self.bands)))
+        workspace = self.workspace
+        waves, fluxes = self.get_SED_spec(out=workspace.flux)
+        return workspace.eff_waves, self.projector.apply(fluxes, out=out)
+
+    def get_SED_batch(self, teff, logg, feh, R, distance, Av=0.0, out=None):
+        """get the band fluxes of arrays of SED parameters in one vectorized pass
+
+        The parameters are not stored in the model. The spectra are
+        interpolated, scaled and reddened in blocks (or the phot grid is
+        used in the fast photometric mode) and projected onto the bands.
+
+        Args:
+            teff, logg, feh, R, distance, Av (array-like): SED parameters, shape (N,) or scalars.
+            out (numpy.ndarray, optional): (N, n_band) float array to reuse. Defaults to None.
+
+        Returns:
+            tuple: (fluxes, invalid), the (N, n_band) band fluxes and the
+            (N,) bool array flagging the rows outside of the model grid
+            (their fluxes are NaN).
+        """
+        teff, logg, feh, R, distance, Av = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(val, dtype=float)) for val in (teff, logg, feh, R, distance, Av)])
+        rat = (R / distance * self._rat_rsun_pc) ** 2
+        if self.phot_grid is not None:
+            if self.Rv != self.phot_grid.Rv or self.ext_law != self.phot_grid.law:
+                raise ValueError(f'(Rv, law) = ({self.Rv}, {self.ext_law}) differs from the '
+                                 f'({self.phot_grid.Rv}, {self.phot_grid.law}) of the phot grid')
+            with instrument.stage('phot_grid', len(teff)):
+                fluxes, invalid = self.phot_grid.get_band_fluxes_batch(teff, feh, logg, Av, out=out)
+            fluxes *= rat[:, None]
+            return fluxes, invalid
+        nrow = len(teff)
+        if out is None:
+            out = np.empty((nrow, len(self.bands)), dtype=float)
+        invalid = np.zeros(nrow, dtype=bool)
+        waves = self.stellar_model.wavelength
+        block = max(1, int(self.max_block_bytes // (self.stellar_model.dtype.itemsize * len(waves))))
+        for start in range(0, nrow, block):
+            stop = min(start + block, nrow)
+            spectra, invalid[start:stop] = self.stellar_model.get_flux_batch(teff[start:stop], feh[start:stop], logg[start:stop])
+            spectra *= rat[start:stop, None].astype(spectra.dtype)
+            reddening.redden(waves, spectra, Av[start:stop], self.Rv, self.ext_law, out=spectra)
+            out[start:stop] = self.projector.apply(spectra)
+        return out, invalid
+
+    def grid_axes(self, teff=None, feh=None, logg=None, Av=None):
+        """the (teff, feh, logg, Av) nodes of a grid evaluation, see fit_grid for the defaults"""
+        if Av is None:
+            if self.phot_grid is not None and self.phot_grid.has_Av:
+                Av = self.phot_grid.grid.axes['Av']
+            else:
+                Av = [self.Av]
+        axes = {
+            'teff': self.stellar_model.teff_grid if teff is None else teff,
+            'feh': self.stellar_model.feh_grid if feh is None else feh,
+            'logg': self.stellar_model.logg_grid if logg is None else logg,
+            'Av': Av,
+        }
+        return {name: np.atleast_1d(np.asarray(val, dtype=float)) for name, val in axes.items()}
+
+    def node_band_fluxes(self, teff, feh, logg, Av):
+        """the band fluxes at the stellar surface on every node of a (teff, feh, logg, Av) grid
+
+        The nodes are evaluated in chunks of vectorized NumPy: through the
+        phot grid in the fast photometric mode, through the spectra (one
+        interpolation per (teff, feh, logg) node, reddened for every Av)
+        otherwise.
+
+        Args:
+            teff, feh, logg, Av (array-like): the nodes of each axis.
+
+        Returns:
+            numpy.ndarray: shape (n_teff, n_feh, n_logg, n_Av, n_band), NaN
+            for the nodes outside of the model grid.
+        """
+        teff, feh, logg, Av = [np.atleast_1d(np.asarray(val, dtype=float)) for val in (teff, feh, logg, Av)]
+        nodes = np.stack(np.meshgrid(teff, feh, logg, indexing='ij'), axis=-1).reshape(-1, 3)
+        band_fluxes = np.full((len(nodes), len(Av), len(self.bands)), np.nan)
+        if self.phot_grid is not None:
+            if self.Rv != self.phot_grid.Rv or self.ext_law != self.phot_grid.law:
+                raise ValueError(f'(Rv, law) = ({self.Rv}, {self.ext_law}) differs from the '
+                                 f'({self.phot_grid.Rv}, {self.phot_grid.law}) of the phot grid')
+            block = max(1, int(self.max_block_bytes // (8 * max(len(self.bands), 1))))
+            for start in range(0, len(nodes), block):
+                stop = min(start + block, len(nodes))
+                for ind_av, av in enumerate(Av):
+                    self.phot_grid.get_band_fluxes_batch(nodes[start:stop, 0], nodes[start:stop, 1], nodes[start:stop, 2],
+                                                         av, out=band_fluxes[start:stop, ind_av])
+        else:
+            waves = self.stellar_model.wavelength
+            dtype = self.stellar_model.dtype
+            curve = reddening.get_curve(waves, self.Rv, self.ext_law, dtype=dtype)
+            factors = [10 ** (-0.4 * float(av) * curve) for av in Av]
+            block = max(1, int(self.max_block_bytes // (2 * dtype.itemsize * len(waves))))
+            for start in range(0, len(nodes), block):
+                stop = min(start + block, len(nodes))
+                spectra, _ = self.stellar_model.get_flux_batch(nodes[start:stop, 0], nodes[start:stop, 1], nodes[start:stop, 2])
+                reddened = np.empty_like(spectra)
+                for ind_av, factor in enumerate(factors):
+                    np.multiply(spectra, factor, out=reddened)
+                    band_fluxes[start:stop, ind_av] = self.projector.apply(reddened)
+        return band_fluxes.reshape((len(teff), len(feh), len(logg), len(Av), len(self.bands)))
+
+    @property
+    def projector(self):
+        """the sparse projection of the model spectra onto the bands, rebuilt when the band list changes"""
+        if self._projector is None:
+            filters = [self.filters[band] for band in self.bands]
+            self._projector = get_band_projector(self.stellar_model.wavelength, filters)
+        return self._projector
 
     def get_SED_mags(self):
         waves, fluxes = self.get_SED()
@@ -232,7 +521,7 @@ class SEDModel:
 class ObservedSEDModel(SEDModel):
     def __init__(self, bands=None, teff=5700, logg=4.5, feh=0.0, 
                  R=1.0, distance=10.0, Av=0.0,
-                 specmodel=stellarSpecModel.BTCond_Model(),
+                 specmodel=None,
                  observed_fluxes=None, observed_errors=None,
                  observed_mags=None, observed_mag_errors=None):
         """a class to generate and compare stellar model SED with observed data
@@ -245,7 +534,7 @@ class ObservedSEDModel(SEDModel):
             R (float, optional): radius of the stellar, unit is R_sun. Defaults to 1.0.
             distance (float, optional): distance of the stellar, unit is pc. Defaults to 10.0.
             Av (float, optional): Extinction Coefficient. Defaults to 0.0.
-            specmodel (stellarSpecModel, optional): stellarSpecModel used to generate the stellar spectrum. Defaults to stellarSpecModel.BTCond_Model().
+            specmodel (stellarSpecModel, optional): stellarSpecModel used to generate the stellar spectrum. Defaults to None, which uses the shared registry.get_model('BTCond').
             observed_fluxes (list, optional): observed fluxes for the bands. Defaults to None.
             observed_errors (list, optional): errors in the observed fluxes. Defaults to None.
             observed_mags (list, optional): observed magnitudes for the bands. Defaults to None.
@@ -260,9 +549,11 @@ class ObservedSEDModel(SEDModel):
         self.obs_fluxes = []
         self.obs_flux_errs = []
         self.sys_errs = []
+        self._obs_arrays = None
         self._add_mere_data(bands, observed_mags, observed_mag_errors, observed_fluxes, observed_errors)
 
     def _add_mere_data(self, bands=None, obs_mags=None, obs_mag_errs=None, obs_fluxes=None, obs_flux_errs=None):
+        self._obs_arrays = None
         obs_mags, obs_mag_errs, obs_fluxes, obs_flux_errs = self._complete_obsdata(bands, obs_mags, obs_mag_errs, obs_fluxes, obs_flux_errs)
         for mag, mag_err, flux, flux_err in zip(obs_mags, obs_mag_errs, obs_fluxes, obs_flux_errs):
             self.obs_mags.append(mag)
@@ -278,8 +569,10 @@ class ObservedSEDModel(SEDModel):
             self.add_bands(bands)
         self._add_mere_data(bands, obs_mags, obs_mag_errs, obs_fluxes, obs_flux_errs)
         self.sys_errs.append(0.0)
+        self._obs_arrays = None
 
     def set_syserr_all(self, sys_err):
+        self._obs_arrays = None
         if isinstance(sys_err, float):
             self.sys_errs = [sys_err, ] * len(self.bands)
         else:
@@ -310,20 +603,132 @@ class ObservedSEDModel(SEDModel):
                 obs_mag_errs.append(mag_err)
         return obs_mags, obs_mag_errs, obs_fluxes, obs_flux_errs
 
+    @property
+    def observations(self):
+        """the observed data frozen into read-only arrays
+
+        Returns:
+            dict: 'fluxes', 'flux_errs' and 'sigmas' (the flux errors and the
+            systematic errors added in quadrature), shape (n_band,), and
+            'log_norm', the sum of log(sigmas). The arrays are rebuilt
+            after add_data or set_syserr_all; call refresh_observations
+            after editing the observation lists directly.
+        """
+        if self._obs_arrays is None:
+            fluxes = np.array(self.obs_fluxes, dtype=float)
+            flux_errs = np.array(self.obs_flux_errs, dtype=float)
+            sys_errs = np.zeros(len(fluxes))
+            sys_errs[:len(self.sys_errs)] = self.sys_errs
+            sigmas = np.sqrt(flux_errs**2 + sys_errs**2)
+            for arr in (fluxes, flux_errs, sigmas):
+                arr.flags.writeable = False
+            self._obs_arrays = {'fluxes': fluxes, 'flux_errs': flux_errs, 'sigmas': sigmas,
+                                'log_norm': float(np.sum(np.log(sigmas)))}
+        return self._obs_arrays
+
+    def refresh_observations(self):
+        """rebuild the frozen observation arrays from the observation lists"""
+        self._obs_arrays = None
+        return self.observations
+
+    def _residuals(self, errors):
+        """(model - observed) / obs[errors] of the current parameters, in the workspace"""
+        obs = self.observations
+        workspace = self.workspace
+        fluxes_model = self.get_SED(out=workspace.band_fluxes)[1]
+        np.subtract(fluxes_model, obs['fluxes'], out=workspace.residuals)
+        workspace.residuals /= obs[errors]
+        return workspace.residuals
+
     def get_chisq(self):
         """calculate the chi-squared value of the observed data and the model
+
+        The evaluation runs in the workspace buffers and allocates no arrays.
         """
-        fluxes_model = self.get_SED()[1]
-        chisq = np.sum((self.obs_fluxes - fluxes_model)**2/self.obs_flux_errs**2)
-        return chisq
+        residuals = self._residuals('flux_errs')
+        return np.dot(residuals, residuals)
 
     def get_log_likelihood(self):
-        sigmas = np.sqrt(np.array(self.obs_flux_errs)**2 + np.array(self.sys_errs)**2)
-        fluxes_data = np.array(self.obs_fluxes)
-        fluxes_model = self.get_SED()[1]
-        log_likelihood = -0.5 * np.sum(((fluxes_data - fluxes_model)/sigmas)**2) - np.sum(np.log(sigmas))
+        """the log-likelihood of the current parameters, with the systematic errors
+
+        The evaluation runs in the workspace buffers and allocates no arrays.
+        """
+        residuals = self._residuals('sigmas')
+        return -0.5 * np.dot(residuals, residuals) - self.observations['log_norm']
+
+    def log_likelihood(self, theta):
+        """the log-likelihood of a parameter set or of an ensemble of parameter sets
+
+        Stateless: the parameters held by the model are neither used nor
+        changed, so one model can serve all the walkers of a sampler, e.g.
+        emcee.EnsembleSampler(nwalkers, 6, model.log_likelihood, vectorize=True).
+
+        Args:
+            theta (array-like): parameters in the order of param_names
+                (teff, logg, feh, R, distance, Av), shape (6,) or (n_walkers, 6).
+
+        Returns:
+            float or numpy.ndarray: the log-likelihood, shape (n_walkers,)
+            for a 2D theta. Parameter sets outside of the model grid get -inf.
+        """
+        theta = np.asarray(theta, dtype=float)
+        thetas = np.atleast_2d(theta)
+        if thetas.ndim != 2 or thetas.shape[1] != len(self.param_names):
+            raise ValueError(f'theta should have shape (n_walkers, {len(self.param_names)}), got {theta.shape}')
+        obs = self.observations
+        fluxes_model, invalid = self.get_SED_batch(*thetas.T)
+        fluxes_model -= obs['fluxes']
+        fluxes_model /= obs['sigmas']
+        log_likelihood = -0.5 * np.einsum('ij,ij->i', fluxes_model, fluxes_model) - obs['log_norm']
+        log_likelihood[invalid | ~np.isfinite(log_likelihood)] = -np.inf
+        if theta.ndim == 1:
+            return float(log_likelihood[0])
         return log_likelihood
 
+    def fit_grid(self, teff=None, feh=None, logg=None, Av=None, distance=None):
+        """brute-force fit of the observed SED on a grid of (teff, feh, logg, Av) nodes
+
+        The model band fluxes scale linearly with s = (R / distance)**2, so
+        for every node the best scale and its chi-square are solved in
+        closed form (s is kept >= 0) instead of being searched. The nodes
+        are evaluated in chunks of vectorized NumPy: through the phot grid
+        in the fast photometric mode, through the spectra otherwise.
+
+        Args:
+            teff, feh, logg (array-like, optional): nodes of each parameter. Defaults to the nodes of the stellar model grid.
+            Av (array-like, optional): Av nodes. Defaults to the Av nodes of the phot grid, or to [self.Av].
+            distance (float, optional): distance (pc) converting the best scales into radii. Defaults to self.distance.
+
+        Returns:
+            dict: 'axes' ({'teff', 'feh', 'logg', 'Av'}: nodes), 'chisq' and
+            'R' (cubes of shape (n_teff, n_feh, n_logg, n_Av), inf and NaN
+            for the nodes outside of the model grid), 'best' (the
+            parameters, R, distance and chisq of the best node) and
+            'marginals' ({name: probability of each node of the axis},
+            with the likelihood exp(-chisq / 2) profiled over the scale).
+        """
+        axes = self.grid_axes(teff, feh, logg, Av)
+        distance = self.distance if distance is None else distance
+        band_fluxes = self.node_band_fluxes(axes['teff'], axes['feh'], axes['logg'], axes['Av'])
+        shape = band_fluxes.shape[:-1]
+        obs = self.observations
+        scale, chisq = profile_scale(obs['fluxes'], obs['sigmas'], band_fluxes.reshape(-1, len(self.bands)))
+        chisq = chisq.reshape(shape)
+        radius = np.sqrt(scale.reshape(shape)) * distance / self._rat_rsun_pc
+        result = {'axes': axes, 'chisq': chisq, 'R': radius, 'best': None, 'marginals': None}
+        if not np.any(np.isfinite(chisq)):
+            logger.warning('No node of the grid has a valid model SED')
+            return result
+        ind_best = np.unravel_index(np.argmin(chisq), shape)
+        result['best'] = {name: float(axes[name][ind]) for name, ind in zip(axes, ind_best)}
+        result['best'].update({'R': float(radius[ind_best]), 'distance': float(distance),
+                               'chisq': float(chisq[ind_best])})
+        prob = np.exp(-0.5 * (chisq - chisq[ind_best]))
+        prob /= np.sum(prob)
+        result['marginals'] = {name: np.sum(prob, axis=tuple(ax for ax in range(4) if ax != dim))
+                               for dim, name in enumerate(axes)}
+        return result
+
     def _display_observations(self):
         headers = ["Band", "Wavelength", "Observed Flux", "Error", "Observed Mag", "Mag Error"]
         units = ["", "AA", "erg/s/cm2/AA", "erg/s/cm2/AA", "", ""]
@@ -3,6 +3,40 @@ import h5py
 import datetime
 
 
+# chunk layouts of the stored flux tensor:
+#   'contiguous': no chunking (the only layout np.memmap can map directly)
+#   'spectrum':   one spectrum per chunk
+#   'cell':       one 2 x 2 x ... x 2 block of nodes (a grid cell) per chunk
+#   'wave_tile':  one wavelength tile of one spectrum per chunk
+CHUNK_LAYOUTS = ('contiguous', 'spectrum', 'cell', 'wave_tile')
+COMPRESSIONS = (None, 'gzip', 'lzf')
+
+
+def _dataset_options(layout, grid_shape, n_wave, compression=None, compression_opts=None,
+                     shuffle=False, wave_tile=4096):
+    """h5py create_dataset options of the flux tensor for a chunk layout"""
+    if layout not in CHUNK_LAYOUTS:
+        raise ValueError(f"layout should be one of {CHUNK_LAYOUTS}, got '{layout}'")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression should be one of {COMPRESSIONS}, got '{compression}'")
+    if layout == 'contiguous':
+        if compression is not None or shuffle:
+            raise ValueError("Compression and shuffle need a chunked layout")
+        return {}
+    if layout == 'spectrum':
+        chunks = (1,) * len(grid_shape) + (n_wave,)
+    elif layout == 'cell':
+        chunks = tuple(min(2, n) for n in grid_shape) + (n_wave,)
+    else:
+        chunks = (1,) * len(grid_shape) + (min(n_wave, int(wave_tile)),)
+    options = {'chunks': chunks, 'shuffle': bool(shuffle)}
+    if compression is not None:
+        options['compression'] = compression
+        if compression_opts is not None:
+            options['compression_opts'] = compression_opts
+    return options
+
+
 class SpecGrid:
     def __init__(self, wave, axes, axis_names, flux_tensor, valid_mask=None, 
                  grid_parameters=None, metadata=None, h5_file=None):
@@ -109,21 +143,77 @@ class SpecGrid:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def to_hdf5(self, filepath):
-        """save grid and metadata to hdf5 file"""
+    def to_hdf5(self, filepath, layout='contiguous', compression=None, compression_opts=None,
+                shuffle=False, wave_tile=4096):
+        """save grid and metadata to hdf5 file
+
+        Args:
+            filepath (str): output file.
+            layout (str, optional): chunk layout of the flux tensor, one of
+                CHUNK_LAYOUTS. 'spectrum' suits lazy point queries, 'cell'
+                reads a whole interpolation cell in one chunk when the cell
+                is aligned. Defaults to 'contiguous'.
+            compression (str, optional): None, 'gzip' or 'lzf'. Defaults to None.
+            compression_opts (int, optional): gzip level. Defaults to None.
+            shuffle (bool, optional): apply the shuffle filter before the compression. Defaults to False.
+            wave_tile (int, optional): number of wavelength points per chunk of the 'wave_tile' layout.
+        """
+        options = _dataset_options(layout, self.shape, self.n_wave, compression, compression_opts,
+                                   shuffle, wave_tile)
         with h5py.File(filepath, 'w') as f:
-            f.create_dataset('wave', data=self.wave)
-            f.create_dataset('flux_tensor', data=self.flux_tensor)
-            if self.valid_mask is not None:
-                f.create_dataset('valid_mask', data=self.valid_mask)
-            
-            for name, array in self.axes.items():
-                f.create_dataset(f'axes/{name}', data=array)
-            
-            f.attrs['axis_names'] = self.axis_names
-            
-            for key, value in self.metadata.items():
-                f.attrs[key] = value
+            f.create_dataset('flux_tensor', data=self.flux_tensor, **options)
+            self._write_header(f, self.wave, self.axes, self.axis_names, self.valid_mask,
+                               self.grid_parameters, self.metadata)
+
+    @staticmethod
+    def _write_header(f, wave, axes, axis_names, valid_mask, grid_parameters, metadata):
+        """write everything except the flux tensor into an open hdf5 file"""
+        f.create_dataset('wave', data=wave)
+        if valid_mask is not None:
+            f.create_dataset('valid_mask', data=valid_mask)
+
+        for name, array in axes.items():
+            f.create_dataset(f'axes/{name}', data=array)
+
+        for key, array in grid_parameters.items():
+            f.create_dataset(f'grid_parameters/{key}', data=array)
+
+        f.attrs['axis_names'] = tuple(axis_names)
+
+        for key, value in metadata.items():
+            f.attrs[key] = value
+
+    @staticmethod
+    def create_hdf5(filepath, wave, axes, axis_names, dtype=np.float32, valid_mask=None,
+                    grid_parameters=None, metadata=None, layout='spectrum', compression=None,
+                    compression_opts=None, shuffle=False, wave_tile=4096):
+        """
+        Create a grid file whose flux tensor is written later, slab by slab.
+
+        The flux tensor is pre-created filled with NaN (by default as a
+        chunked dataset with one spectrum per chunk, see to_hdf5 for the
+        layout and compression options), so a grid larger than the memory
+        can be streamed into the file. The open h5py.File is returned,
+        write into f['flux_tensor'] and close it.
+        """
+        shape = tuple(len(axes[name]) for name in axis_names)
+        if valid_mask is not None and np.shape(valid_mask) != shape:
+            raise ValueError(f"Mask shape {np.shape(valid_mask)} mismatches axes shape {shape}")
+        metadata = dict(metadata or {})
+        metadata.setdefault('creation_date', datetime.datetime.now().isoformat())
+        metadata.setdefault('is_derived', False)
+        options = _dataset_options(layout, shape, len(wave), compression, compression_opts,
+                                   shuffle, wave_tile)
+        f = h5py.File(filepath, 'w')
+        try:
+            f.create_dataset('flux_tensor', shape=shape + (len(wave),), dtype=dtype,
+                             fillvalue=np.nan, **options)
+            SpecGrid._write_header(f, np.asarray(wave), axes, axis_names, valid_mask,
+                                   grid_parameters or {}, metadata)
+        except Exception:
+            f.close()
+            raise
+        return f
 
     @property
     def shape(self):
@@ -2,23 +2,42 @@ import os
 import json
 import hashlib
 import numpy as np
+import h5py
 from pathlib import Path
-from scipy.interpolate import RegularGridInterpolator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm.auto import tqdm
-from spectool import pyrebin
 from .SpecGrid import SpecGrid
+from .grid_interp import MultilinearInterpolator
+from .projection import rebin_matrix
+from .node_cache import NodeCache, get_node_cache
 from .excepts import AliasAlreadyExistsError
 from . import config
+from . import instrument
 import logging
 logger = logging.getLogger(__name__)
 
 
+def _rebin_block(matrix, log_flux, dtype):
+    """rebin a (N, n_wave) block of log10 spectra with the rebin matrix"""
+    flux64 = np.power(10.0, log_flux, dtype=np.float64)
+    nflux64 = (matrix @ flux64.T).T
+    # the pixels padded with zero outside of the old range are -inf, as with rebin_padvalue
+    with np.errstate(divide='ignore'):
+        return np.log10(nflux64).astype(dtype, copy=False)
+
+
 class SpecModel:
-    def __init__(self, grid: SpecGrid):
+    # upper limit of the float64 working set of one resampling block, in bytes
+    resample_block_bytes = 64 * 1024 ** 2
+
+    def __init__(self, grid: SpecGrid, dtype=None):
         """
         :param grid: SpecGrid, including data and meta info
+        :param dtype: dtype of the computed fluxes, defaults to config.precision
         """
         self.grid = grid
+        self.dtype = config.get_dtype(dtype)
+        self._interpolator = None
 
     @classmethod
     def load(cls, filepath):
@@ -138,6 +157,10 @@ class SpecModel:
         cache_dir: str | Path | None = None,
         overwrite: bool = False,
         progress: bool = False,
+        workers: int = 1,
+        executor: str = 'thread',
+        block_size: int | None = None,
+        memory_budget: int | None = None,
     ) -> "SpecModel":
         """
         Create a derived spectral model from the current model.
@@ -266,6 +289,31 @@ class SpecModel:
             If ``True``, the derived model will be regenerated and the
             existing cached file will be replaced.
 
+        progress : bool, default=False
+            Show a progress bar over the resampled blocks.
+
+        workers : int, default=1
+            Number of workers resampling the spectra blocks in parallel.
+
+        executor : {'thread', 'process'}, default='thread'
+            Pool used when ``workers > 1``. The resampling is numpy/scipy
+            work that releases the GIL, so threads are usually enough and
+            avoid copying the blocks to the worker processes.
+
+        block_size : int, optional
+            Number of spectra resampled at once. Defaults to the largest
+            block whose float64 working set fits ``resample_block_bytes``.
+
+        memory_budget : int, optional
+            Stream the derivation out of core, keeping the working set
+            under about this many bytes.
+
+            The parent grid is read in slabs (which also works on a lazy
+            HDF5 grid), each slab is cropped and resampled, then written
+            into a chunked flux dataset pre-created in the cache file. The
+            returned model reads the cached file lazily. If ``None``, the
+            derived grid is built in memory before being cached.
+
         Returns
         -------
         SpecModel
@@ -400,6 +448,34 @@ class SpecModel:
         global_indices = slice_indices + [wave_keep_idx]
         mask_slice_tuple = tuple(slice_indices)
 
+        cropped_mask = self.grid.valid_mask[np.ix_(*mask_slice_tuple)]
+        cropped_wave = wave_vals[wave_keep_idx]
+        grid_pars = self.grid.grid_parameters
+        cropped_grid_pars = {param: grid_pars[param][np.ix_(*mask_slice_tuple)] for param in grid_pars}
+
+        new_metadata = self.grid.metadata.copy()
+        new_metadata['is_derived'] = True
+        new_metadata['wave_sampling'] = method
+        if new_wave is None:
+            new_wave = cropped_wave
+
+        if memory_budget is not None:
+            tmp_filepath = cache_filepath.with_name(cache_filepath.name + '.tmp')
+            logger.info(f"Streaming derived grid to {cache_filepath}")
+            f = SpecGrid.create_hdf5(tmp_filepath, new_wave, new_axes, self.grid.axis_names,
+                                     dtype=self.grid.flux_tensor.dtype, valid_mask=cropped_mask,
+                                     grid_parameters=cropped_grid_pars, metadata=new_metadata)
+            try:
+                self._stream_derive(slice_indices, wave_keep_idx, cropped_wave, cropped_mask,
+                                    flag_resample, new_wave, f['flux_tensor'], memory_budget,
+                                    progress=progress, workers=workers, executor=executor)
+            finally:
+                f.close()
+            os.replace(tmp_filepath, cache_filepath)
+            if alias:
+                self._create_symlink(cache_filepath, alias_filepath, overwrite)
+            return self.__class__.load(cache_filepath)
+
         bounding_box_slices = []
         local_indices = []
 
@@ -412,34 +488,15 @@ class SpecModel:
 
         sub_flux_tensor = self.grid.flux_tensor[bounding_box_slices]
         cropped_flux = sub_flux_tensor[np.ix_(*local_indices)]
-        
-        cropped_mask = self.grid.valid_mask[np.ix_(*mask_slice_tuple)]
-        cropped_wave = wave_vals[wave_keep_idx]
-        grid_pars = self.grid.grid_parameters
-        cropped_grid_pars = {param: grid_pars[param][np.ix_(*mask_slice_tuple)] for param in grid_pars}
 
-        if new_wave is not None:
+        if flag_resample:
             nflux_tensor = np.full(cropped_mask.shape + (len(new_wave),), np.nan, dtype=cropped_flux.dtype)
-            iterator = np.ndindex(cropped_mask.shape)
-            if progress:
-                iterator = tqdm(
-                    iterator,
-                    total=cropped_mask.size,
-                    desc="Resampling spectra"
-                )
-            for idx in iterator:
-                if cropped_mask[idx]:
-                    flux64 = 10**(cropped_flux[idx].astype(np.float64))
-                    nflux64 = pyrebin.rebin_padvalue(cropped_wave, flux64, new_wave)
-                    lognflux = np.log10(nflux64).astype(cropped_flux.dtype)
-                    nflux_tensor[idx] = lognflux
+            with instrument.stage('rebin', int(np.count_nonzero(cropped_mask))):
+                self._resample(cropped_wave, cropped_flux, cropped_mask, new_wave, nflux_tensor,
+                               progress=progress, workers=workers, executor=executor, block_size=block_size)
         else:
             nflux_tensor = cropped_flux
 
-        new_metadata = self.grid.metadata.copy()
-        new_metadata['is_derived'] = True
-        new_metadata['wave_sampling'] = method
-        
         # 实例化新的底层网格
         new_grid = SpecGrid(
             wave=new_wave,
@@ -461,58 +518,206 @@ class SpecModel:
 
         return new_model
 
-    def get_flux(self, **kwargs):
-        missing_params = set(self.grid.axis_names) - set(kwargs.keys())
-        if missing_params:
+    def _stream_derive(self, slice_indices, wave_keep_idx, cropped_wave, cropped_mask,
+                       flag_resample, new_wave, dataset, memory_budget, *,
+                       progress=False, workers=1, executor='thread'):
+        """
+        Crop (and resample) the parent grid slab by slab into dataset.
+
+        The parent is read one slab at a time: the selected indices of a
+        split axis in groups, all the outer axes fixed and the bounding
+        block of the inner axes. The split axis is the outermost one whose
+        slabs fit memory_budget, so the working set (the slab read from the
+        parent plus the float64 resampling buffers) stays under the budget
+        as long as the budget holds at least one spectrum.
+        """
+        ndim = len(slice_indices)
+        wave_slice = slice(int(wave_keep_idx[0]), int(wave_keep_idx[-1]) + 1)
+        wave_local = wave_keep_idx - wave_keep_idx[0]
+        n_wave_read = wave_slice.stop - wave_slice.start
+        spectrum_bytes = self.grid.flux_tensor.dtype.itemsize * n_wave_read + 16 * (len(cropped_wave) + len(new_wave))
+        inner_bounds = [slice(int(idx[0]), int(idx[-1]) + 1) for idx in slice_indices]
+        inner_local = [idx - idx[0] for idx in slice_indices]
+
+        split = ndim - 1
+        for dim in range(ndim):
+            inner_nodes = int(np.prod([bound.stop - bound.start for bound in inner_bounds[dim + 1:]], dtype=np.int64))
+            if inner_nodes * spectrum_bytes <= memory_budget:
+                split = dim
+                break
+        inner_nodes = int(np.prod([bound.stop - bound.start for bound in inner_bounds[split + 1:]], dtype=np.int64))
+        group = max(1, int(memory_budget // (inner_nodes * spectrum_bytes)))
+        split_indices = slice_indices[split]
+
+        outer_shape = tuple(len(idx) for idx in slice_indices[:split])
+        n_slab = int(np.prod(outer_shape, dtype=np.int64)) * ((len(split_indices) + group - 1) // group)
+        bar = tqdm(total=n_slab, desc="Deriving grid") if progress else None
+        try:
+            for outer in np.ndindex(*outer_shape):
+                outer_parent = tuple(int(slice_indices[dim][ind]) for dim, ind in enumerate(outer))
+                for start in range(0, len(split_indices), group):
+                    stop = min(start + group, len(split_indices))
+                    chunk = split_indices[start:stop]
+                    if chunk[-1] - chunk[0] == len(chunk) - 1:
+                        split_sel = slice(int(chunk[0]), int(chunk[-1]) + 1)
+                    else:
+                        split_sel = chunk.tolist()
+                    slab = self.grid.flux_tensor[outer_parent + (split_sel,) + tuple(inner_bounds[split + 1:]) + (wave_slice,)]
+                    slab = slab[np.ix_(np.arange(len(chunk)), *inner_local[split + 1:], wave_local)]
+                    target = outer + (slice(start, stop),)
+                    if flag_resample:
+                        block = np.full(slab.shape[:-1] + (len(new_wave),), np.nan, dtype=dataset.dtype)
+                        with instrument.stage('rebin', int(np.count_nonzero(cropped_mask[target]))):
+                            self._resample(cropped_wave, slab, cropped_mask[target], new_wave, block,
+                                           workers=workers, executor=executor)
+                    else:
+                        block = slab
+                    dataset[target] = block
+                    if bar is not None:
+                        bar.update(1)
+        finally:
+            if bar is not None:
+                bar.close()
+
+    def _resample(self, wave, flux_tensor, valid_mask, new_wave, out, *,
+                  progress=False, workers=1, executor='thread', block_size=None):
+        """
+        Resample the valid spectra of a log10 flux tensor onto new_wave.
+
+        The flux-conserving rebin operator from wave to new_wave is built
+        once as a sparse matrix and applied to blocks of spectra, the blocks
+        are dispatched to a thread or process pool when workers > 1. The
+        result is written into out (flux_tensor shape with n_wave replaced
+        by len(new_wave)); the rows of invalid nodes are left untouched.
+        """
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"executor should be 'thread' or 'process', got '{executor}'")
+        matrix = rebin_matrix(wave, new_wave)
+        flat_flux = flux_tensor.reshape(-1, len(wave))
+        flat_out = out.reshape(-1, len(new_wave))
+        rows = np.flatnonzero(valid_mask)
+        if block_size is None:
+            block_size = max(1, int(self.resample_block_bytes // (8 * max(len(wave), len(new_wave)))))
+        blocks = [rows[start:start + block_size] for start in range(0, len(rows), block_size)]
+        bar = tqdm(total=len(rows), desc="Resampling spectra") if progress else None
+        try:
+            if workers <= 1 or len(blocks) <= 1:
+                for block in blocks:
+                    flat_out[block] = _rebin_block(matrix, flat_flux[block], out.dtype)
+                    if bar is not None:
+                        bar.update(len(block))
+                return out
+            pool_class = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+            with pool_class(max_workers=workers) as pool:
+                futures = [pool.submit(_rebin_block, matrix, flat_flux[block], out.dtype) for block in blocks]
+                for block, future in zip(blocks, futures):
+                    flat_out[block] = future.result()
+                    if bar is not None:
+                        bar.update(len(block))
+        finally:
+            if bar is not None:
+                bar.close()
+        return out
+
+    @property
+    def interpolator(self) -> MultilinearInterpolator:
+        """
+        The query engine of the grid, built once on first use.
+
+        It caches the axis bounds and steps, and reads the flux tensor
+        directly (in memory or through the lazy HDF5 dataset). The node
+        spectra of a lazy grid go through the node cache shared by all the
+        models reading the same file.
+        """
+        if self._interpolator is None:
+            axes = tuple(self.grid.axes[param] for param in self.grid.axis_names)
+            cache = None
+            if isinstance(self.grid.flux_tensor, h5py.Dataset):
+                cache = get_node_cache(self.grid.flux_tensor)
+            self._interpolator = MultilinearInterpolator(
+                axes, self.grid.flux_tensor, valid_mask=self.grid.valid_mask, node_cache=cache,
+                dtype=self.dtype)
+        return self._interpolator
+
+    @property
+    def node_cache(self) -> NodeCache | None:
+        """the node-spectrum cache of a lazy grid (None for an in-memory grid), see NodeCache.stats"""
+        return self.interpolator.node_cache
+
+    def _query_values(self, kwargs):
+        try:
+            return [kwargs[param] for param in self.grid.axis_names]
+        except KeyError:
+            missing_params = set(self.grid.axis_names) - set(kwargs.keys())
             raise ValueError(
                 f"Missing required grid parameters: {list(missing_params)}. "
                 f"Required parameters for this model are: {list(self.grid.axis_names)}"
-            )
-            
-        query_point = []
-        bounding_slices = []
-        local_axes = []
-        
-        for param in self.grid.axis_names:
-            val = kwargs[param]
-            axis_arr = self.grid.axes[param]
-            min_val, max_val = np.min(axis_arr), np.max(axis_arr)
-            
-            if val < min_val or val > max_val:
-                raise ValueError(
-                    f"Parameter '{param}'={val} is outside of the grid range [{min_val}, {max_val}]."
-                )
-            query_point.append(val)
-            
-            # 定位当前参数所在的局部区间（找到紧邻的左右两个网格点）
-            # 假设网格轴是升序排列的
-            idx_left = np.searchsorted(axis_arr, val, side='right') - 1
-            idx_left = int(np.clip(idx_left, 0, len(axis_arr) - 2))
-            idx_right = idx_left + 1
-            
-            # 记录原生 slice 和局部坐标轴
-            bounding_slices.append(slice(idx_left, idx_right + 1))
-            local_axes.append(axis_arr[idx_left:idx_right + 1])
-        
-        bounding_slices.append(slice(None))
-        
-        local_flux_tensor = self.grid.flux_tensor[tuple(bounding_slices)]
-        
-        local_interpolator = RegularGridInterpolator(
-            tuple(local_axes), 
-            local_flux_tensor, 
-            method='linear', 
-            bounds_error=True, 
-            fill_value=np.nan
-        )
-        
-        interpolated_flux = local_interpolator([query_point])[0]
-        if np.any(np.isnan(interpolated_flux)):
+            ) from None
+
+    def get_flux(self, out=None, **kwargs):
+        """
+        Interpolate the spectrum at one point of the parameter grid.
+
+        Parameters
+        ----------
+        out : numpy.ndarray, optional
+            Float array of shape (n_wave,) receiving the flux. With ``out``
+            and an in-memory grid the call allocates no arrays.
+        **kwargs
+            One value per grid axis, e.g. ``teff=5700, logg=4.5, feh=0.0``.
+
+        Returns
+        -------
+        numpy.ndarray
+            The flux, shape (n_wave,).
+
+        Raises
+        ------
+        ValueError
+            If a parameter is missing or outside of the grid range, or if
+            the point falls into a hole (invalid model region) of the grid.
+        """
+        query_point = self._query_values(kwargs)
+        interpolator = self.interpolator
+        with instrument.stage('interpolate'):
+            log_flux, invalid = interpolator.evaluate_one(query_point, out=out)
+        if invalid:
+            for param, val, min_val, max_val in zip(self.grid.axis_names, query_point,
+                                                    interpolator.lower, interpolator.upper):
+                if not min_val <= val <= max_val:
+                    raise ValueError(
+                        f"Parameter '{param}'={val} is outside of the grid range [{min_val}, {max_val}]."
+                    )
             raise ValueError(
                 f"The requested parameters {kwargs} fall into a physical hole (invalid model region) in the grid."
             )
+        with instrument.stage('exp10'):
+            return np.power(10.0, log_flux, out=log_flux)
+
+    def get_flux_batch(self, out=None, **kwargs):
+        """
+        Interpolate the spectra of a batch of points of the parameter grid.
+
+        Parameters
+        ----------
+        out : numpy.ndarray, optional
+            Float array of shape (N, n_wave) receiving the fluxes.
+        **kwargs
+            One array of shape (N,) (or a scalar) per grid axis.
 
-        return 10**interpolated_flux
+        Returns
+        -------
+        tuple
+            (fluxes, invalid): the (N, n_wave) fluxes and the (N,) bool
+            array flagging the points outside of the grid or in a hole,
+            whose rows are NaN.
+        """
+        columns = [np.atleast_1d(np.asarray(val, dtype=float)) for val in self._query_values(kwargs)]
+        points = np.column_stack(np.broadcast_arrays(*columns))
+        with instrument.stage('interpolate', len(points)):
+            log_flux, invalid = self.interpolator.evaluate(points, out=out)
+        with instrument.stage('exp10', len(points)):
+            return np.power(10.0, log_flux, out=log_flux), invalid
 
     @property
     def metadata(self):
@@ -10,6 +10,7 @@ from .stellarSpecModel import BTCond_Model_R500
 from .stellarSpecModel import BTCond_Model_R100
 from .tlusty import TlustyModel
 from .tlustyWD import TlustyWDModel
+from .registry import get_model
 from .SED_model import SEDModel
 from .binary_SED_model import BinarySEDModel
 
@@ -2,21 +2,88 @@ import pyphot
 import numpy as np
 from astropy import constants as cs
 import matplotlib.pyplot as plt
-from extinction import apply
-from extinction import fitzpatrick99
-import spectool
 from . import stellarSpecModel
+from . import registry
 from .phot_util import fluxes_to_mags as f2ms
 from .phot_util import mags_to_fluxes as m2fs
 from .phot_util import filtername2pyphotname as f2p
 from .phot_util import load_local_filter
 from . import phot_util
+from .projection import get_band_projector
+from . import reddening
+from . import instrument
+import logging
+logger = logging.getLogger(__name__)
+
+
+def profile_scales2(obs_fluxes, sigmas, model_fluxes1, model_fluxes2):
+    """best non-negative scales and chi-square of every pair of two-component models
+
+    The observed fluxes are fitted by s1 * model_fluxes1[i] + s2 *
+    model_fluxes2[j]. For every pair (i, j) the 2x2 weighted normal
+    equations are solved in closed form; when the unconstrained solution
+    has a negative scale, the best one-component solution (s1 = 0 or
+    s2 = 0) is used instead, which is the non-negative least-squares
+    solution. Bands with a non-finite observed flux or error are ignored.
+
+    Args:
+        obs_fluxes (numpy.ndarray): observed fluxes, shape (n_band,).
+        sigmas (numpy.ndarray): their errors, shape (n_band,).
+        model_fluxes1 (numpy.ndarray): fluxes of the first component, shape (n1, n_band).
+        model_fluxes2 (numpy.ndarray): fluxes of the second component, shape (n2, n_band).
+
+    Returns:
+        tuple: (scale1, scale2, chisq), shape (n1, n2). The pairs with a
+        non-finite model get NaN scales and an infinite chisq.
+    """
+    obs_fluxes = np.asarray(obs_fluxes, dtype=float)
+    with np.errstate(divide='ignore'):
+        weights = 1.0 / np.asarray(sigmas, dtype=float)**2
+    missing = ~(np.isfinite(obs_fluxes) & np.isfinite(weights))
+    weights = np.where(missing, 0.0, weights)
+    obs_fluxes = np.where(missing, 0.0, obs_fluxes)
+    obs_weighted = obs_fluxes * weights
+    obs_norm = np.sum(obs_weighted * obs_fluxes)
+    valid1 = np.all(np.isfinite(model_fluxes1), axis=-1)
+    valid2 = np.all(np.isfinite(model_fluxes2), axis=-1)
+    model_fluxes1 = np.where(valid1[:, None], model_fluxes1, 0.0)
+    model_fluxes2 = np.where(valid2[:, None], model_fluxes2, 0.0)
+    b1 = (model_fluxes1 @ obs_weighted)[:, None]
+    b2 = (model_fluxes2 @ obs_weighted)[None, :]
+    a11 = ((model_fluxes1**2) @ weights)[:, None]
+    a22 = ((model_fluxes2**2) @ weights)[None, :]
+    a12 = (model_fluxes1 * weights) @ model_fluxes2.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        det = a11 * a22 - a12**2
+        scale1 = (a22 * b1 - a12 * b2) / det
+        scale2 = (a11 * b2 - a12 * b1) / det
+        # one-component solutions, used where the pair solution is not >= 0
+        only1 = np.broadcast_to(np.maximum(b1 / a11, 0.0), a12.shape)
+        only2 = np.broadcast_to(np.maximum(b2 / a22, 0.0), a12.shape)
+    chisq_only1 = obs_norm - 2 * only1 * b1 + only1**2 * a11
+    chisq_only2 = obs_norm - 2 * only2 * b2 + only2**2 * a22
+    use1 = ~(chisq_only2 < chisq_only1)
+    bound_scale1 = np.where(use1, only1, 0.0)
+    bound_scale2 = np.where(use1, 0.0, only2)
+    inside = (scale1 >= 0) & (scale2 >= 0) & np.isfinite(scale1) & np.isfinite(scale2)
+    scale1 = np.where(inside, scale1, bound_scale1)
+    scale2 = np.where(inside, scale2, bound_scale2)
+    chisq = (obs_norm - 2 * (scale1 * b1 + scale2 * b2)
+             + scale1**2 * a11 + 2 * scale1 * scale2 * a12 + scale2**2 * a22)
+    valid = valid1[:, None] & valid2[None, :]
+    chisq = np.where(valid & np.isfinite(chisq), np.maximum(chisq, 0.0), np.inf)
+    scale1 = np.where(valid, scale1, np.nan)
+    scale2 = np.where(valid, scale2, np.nan)
+    return scale1, scale2, chisq
 
 
 class BinarySEDModel:
+    # upper limit of the working set of one block of fit_grid, in bytes
+    max_block_bytes = 64 * 1024 ** 2
+
     def __init__(self, teff1=None, feh1=None, logg1=None, R1=None, 
                  D=None, Av=0.0, teff2=None, feh2=None, logg2=None, R2=None, 
-                 syserr=None, specmodel=stellarSpecModel.BTCond_Model()):
+                 syserr=None, specmodel=None):
         self.teff1 = teff1
         self.feh1 = feh1
         self.logg1 = logg1
@@ -27,6 +94,8 @@ class BinarySEDModel:
         self.feh2 = feh2
         self.logg2 = logg2
         self.R2 = R2
+        if specmodel is None:
+            specmodel = registry.get_model('BTCond')
         self.stellar_model = specmodel
         self.syserr = syserr
 
@@ -37,6 +106,12 @@ class BinarySEDModel:
         self._pyphot_lib = pyphot.get_library()
         self._rat_rsun_pc = cs.R_sun.to('pc').value
         self._Rv = 3.1
+        self._ext_law = 'F99'
+        self._projector = None
+        self._projector_wave = None
+        # per-component memo of the last evaluation, see _component
+        self._memo = {}
+        self._ext_cache = None
         self._obs_mags = []
         self._obs_magerrs = []
         self._obs_fluxes = []
@@ -60,18 +135,16 @@ class BinarySEDModel:
         self.R2 = R2 if R2 is not None else self.R2
         self.syserr = syserr if syserr is not None else self.syserr
 
+    def set_ext_law(self, law, Rv=None):
+        """set the extinction law, one of reddening.available_laws() ('F99', 'CCM89', 'O94')"""
+        if law not in reddening.available_laws():
+            raise ValueError(f'law should be one of {reddening.available_laws()}')
+        self._ext_law = law
+        if Rv is not None:
+            self._Rv = Rv
+
     def _load_filter(self, bandname):
-        if bandname in phot_util._dic_local_f:
-            waves, trans, eff_wave, width = phot_util.load_local_filter(bandname)
-        else:
-            tfilter = self._pyphot_lib[bandname]
-            waves = tfilter.wavelength.to('AA').value
-            trans = tfilter.transmit
-            eff_wave = tfilter.leff.to('AA').value
-            width = tfilter.width.to('AA').value
-            if bandname == 'WISE_RSR_W3':
-                eff_wave = 115598.23320737253
-        return waves, trans, eff_wave, width
+        return phot_util.load_filter(bandname)
         
     def add_data(self, bands, obs_mags=None, obs_magerrs=None, 
                  obs_fluxes=None, obs_fluxerrs=None, 
@@ -115,77 +188,104 @@ class BinarySEDModel:
         self._obs_fluxes += list(obs_fluxes)
         self._obs_fluxerrs += list(obs_fluxerrs)
         self._eff_waves_SED += list(eff_waves)
+        self._projector = None
 
-    def get_SED_spec1(self):
-        teff = self.teff1
-        feh = self.feh1
-        if feh is None:
-            feh = 0.0
-        logg = self.logg1
+    def _component_key(self, ind):
+        """the parameters determining the observed spectrum of component ind (1 or 2)"""
+        if ind == 1:
+            teff, feh, logg, R = self.teff1, self.feh1, self.logg1, self.R1
+            if feh is None:
+                feh = 0.0
+        else:
+            teff, feh, logg, R = self.teff2, self.feh2, self.logg2, self.R2
+            if feh is None:
+                feh = self.feh1 if self.feh1 is not None else 0.0
         if logg is None:
             logg = 4.4
+        return (teff, feh, logg, R, self.D, self.Av, self._Rv, self._ext_law, id(self.stellar_model))
+
+    def _extinction_factor(self, waves):
+        """10 ** (-0.4 * A_lambda) of the current Av, shared by both components (None for Av = 0)"""
+        key = (self.Av, self._Rv, self._ext_law, id(waves))
+        if self._ext_cache is None or self._ext_cache[0] != key:
+            factor = None
+            if self.Av != 0:
+                curve = reddening.get_curve(waves, self._Rv, self._ext_law, dtype=self.stellar_model.dtype)
+                factor = 10 ** (-0.4 * float(self.Av) * curve)
+            self._ext_cache = (key, factor)
+        return self._ext_cache[1]
+
+    def _component(self, ind):
+        """
+        The observed spectrum of component ind, computed once per parameter state.
+
+        The memo is keyed by the parameter values, so setting the
+        attributes directly or through set_pars both invalidate it, and a
+        component whose parameters did not change is not recomputed.
+        """
+        key = self._component_key(ind)
+        memo = self._memo.get(ind)
+        if memo is not None and memo['key'] == key:
+            return memo
+        teff, feh, logg, R = key[:4]
         waves = self.stellar_model.wavelength
-        fluxes = self.stellar_model.get_flux(teff, feh, logg)
-        rat = (self.R1 / self.D * self._rat_rsun_pc) ** 2
-        fluxes *= rat
-        ext = fitzpatrick99(waves, self.Av, self._Rv)
-        nfluxes = apply(ext, fluxes)
-        return waves, nfluxes
+        spec = self.stellar_model.get_flux(teff, feh, logg)
+        spec *= float((R / self.D * self._rat_rsun_pc) ** 2)
+        factor = self._extinction_factor(waves)
+        if factor is not None:
+            with instrument.stage('extinction'):
+                spec *= factor
+        spec.flags.writeable = False
+        memo = {'key': key, 'spec': spec, 'bands': None, 'projector': None}
+        self._memo[ind] = memo
+        return memo
+
+    def _band_fluxes(self):
+        """the band fluxes of both components, the stale ones projected in one call"""
+        memos = [self._component(1), self._component(2)]
+        projector = self._get_projector(self.stellar_model.wavelength)
+        stale = [memo for memo in memos if memo['projector'] is not projector]
+        if stale:
+            band_fluxes = projector.apply(np.stack([memo['spec'] for memo in stale]))
+            for memo, fluxes in zip(stale, band_fluxes):
+                memo['bands'] = fluxes
+                memo['projector'] = projector
+        return memos[0]['bands'], memos[1]['bands']
+
+    def get_SED_spec1(self):
+        """wavelength and observed spectrum of component 1, the spectrum is read-only"""
+        return self.stellar_model.wavelength, self._component(1)['spec']
 
     def get_SED_spec2(self):
-        teff = self.teff2
-        feh = self.feh2
-        if feh is None:
-            if self.feh1 is not None:
-                feh = self.feh1
-            else:
-                feh = 0.0
-        logg = self.logg2
-        if logg is None:
-            logg = 4.4
-        waves = self.stellar_model.wavelength
-        fluxes = self.stellar_model.get_flux(teff, feh, logg)
-        rat = (self.R2 / self.D * self._rat_rsun_pc) ** 2
-        fluxes *= rat
-        ext = fitzpatrick99(waves, self.Av, self._Rv)
-        nfluxes = apply(ext, fluxes)
-        return waves, nfluxes
+        """wavelength and observed spectrum of component 2, the spectrum is read-only"""
+        return self.stellar_model.wavelength, self._component(2)['spec']
 
     def get_SED_spec(self):
-        wave_spec1, spec1 = self.get_SED_spec1()
-        wave_spec2, spec2 = self.get_SED_spec2()
-        return wave_spec1, spec1 + spec2
+        return self.stellar_model.wavelength, self._component(1)['spec'] + self._component(2)['spec']
+
+    def _get_projector(self, wave_spec):
+        # keyed on the wavelength array held here: the shared projector may have been
+        # built from an equal copy, its .wave is then another array
+        if self._projector is None or self._projector_wave is not wave_spec:
+            filters = [self.filters[band] for band in self._bands]
+            self._projector = get_band_projector(wave_spec, filters)
+            self._projector_wave = wave_spec
+        return self._projector
 
     def _SED_from_spec(self, wave_spec, spec):
-        SED_outs = []
-        for ind, band in enumerate(self._bands):
-            wave_filter, trans = self.filters[band]
-            flux_interp = spectool.pyrebin.rebin_padvalue(wave_spec, spec, wave_filter)
-            widths = np.diff(wave_filter)
-            widths = np.append(widths, widths[-1])
-            flux_int = np.sum(flux_interp * trans * widths) / np.sum(trans * widths)
-            SED_outs.append(flux_int)
-        return SED_outs
+        """band fluxes of one spectrum (n_wave,) or of a stack of spectra (N, n_wave)"""
+        return self._get_projector(wave_spec).apply(spec)
 
     def get_SED1(self):
-        wave_spec, spec = self.get_SED_spec1()
-        wave_SED = np.array(self._eff_waves_SED)
-        SED_outs = np.array(self._SED_from_spec(wave_spec, spec))
-        return wave_SED, SED_outs
+        return np.array(self._eff_waves_SED), np.array(self._band_fluxes()[0])
 
     def get_SED2(self):
-        wave_spec, spec = self.get_SED_spec2()
-        wave_SED = np.array(self._eff_waves_SED)
-        SED_outs = np.array(self._SED_from_spec(wave_spec, spec))
-        return wave_SED, SED_outs
+        return np.array(self._eff_waves_SED), np.array(self._band_fluxes()[1])
 
     def get_SED(self):
-        wave_spec1, spec1 = self.get_SED_spec1()
-        wave_spec2, spec2 = self.get_SED_spec2()
-        spec = spec1 + spec2
-        wave_SED = np.array(self._eff_waves_SED)
-        SED_outs = np.array(self._SED_from_spec(wave_spec1, spec))
-        return wave_SED, SED_outs
+        """the combined band fluxes, the sum of the band fluxes of the components (the projection is linear)"""
+        band_fluxes1, band_fluxes2 = self._band_fluxes()
+        return np.array(self._eff_waves_SED), band_fluxes1 + band_fluxes2
 
     def get_SED_mags1(self):
         wave_SED, SED_outs = self.get_SED1()
@@ -212,31 +312,132 @@ class BinarySEDModel:
         chisq = np.sum((fluxes_obs - SED_model) ** 2 / flux_errs_obs ** 2)
         return chisq
 
+    def _sigmas(self):
+        """the observed fluxes and their errors including the syserr term"""
+        fluxes_obs = np.array(self._obs_fluxes, dtype=float)
+        flux_errs_obs = np.array(self._obs_fluxerrs, dtype=float)
+        flux_errs_obs[np.isnan(flux_errs_obs)] = 0
+        if self.syserr is not None:
+            return fluxes_obs, np.sqrt(flux_errs_obs ** 2 + (fluxes_obs * self.syserr) ** 2)
+        return fluxes_obs, flux_errs_obs
+
+    def node_band_fluxes(self, teff, feh, logg, Av):
+        """the band fluxes at the stellar surface on every node of a (teff, feh, logg, Av) grid
+
+        Args:
+            teff, feh, logg, Av (array-like): the nodes of each axis.
+
+        Returns:
+            numpy.ndarray: shape (n_teff, n_feh, n_logg, n_Av, n_band), NaN
+            for the nodes outside of the model grid.
+        """
+        teff, feh, logg, Av = [np.atleast_1d(np.asarray(val, dtype=float)) for val in (teff, feh, logg, Av)]
+        nodes = np.stack(np.meshgrid(teff, feh, logg, indexing='ij'), axis=-1).reshape(-1, 3)
+        waves = self.stellar_model.wavelength
+        projector = self._get_projector(waves)
+        band_fluxes = np.full((len(nodes), len(Av), len(self._bands)), np.nan)
+        dtype = self.stellar_model.dtype
+        curve = reddening.get_curve(waves, self._Rv, self._ext_law, dtype=dtype)
+        factors = [10 ** (-0.4 * float(av) * curve) for av in Av]
+        block = max(1, int(self.max_block_bytes // (2 * dtype.itemsize * len(waves))))
+        for start in range(0, len(nodes), block):
+            stop = min(start + block, len(nodes))
+            spectra, _ = self.stellar_model.get_flux_batch(nodes[start:stop, 0], nodes[start:stop, 1], nodes[start:stop, 2])
+            reddened = np.empty_like(spectra)
+            for ind_av, factor in enumerate(factors):
+                np.multiply(spectra, factor, out=reddened)
+                band_fluxes[start:stop, ind_av] = projector.apply(reddened)
+        return band_fluxes.reshape((len(teff), len(feh), len(logg), len(Av), len(self._bands)))
+
+    def fit_grid(self, teff1=None, teff2=None, feh=None, logg1=None, logg2=None, Av=None, D=None, n_best=10):
+        """brute-force fit of the observed SED with every pair of grid nodes
+
+        For fixed (teff1, logg1, teff2, logg2, feh, Av) the band fluxes are
+        linear in s1 = (R1 / D)**2 and s2 = (R2 / D)**2, so the best
+        non-negative radii and the chi-square (with the syserr term, as in
+        get_chisq_syserr) of every pair are solved in closed form, see
+        profile_scales2. The band fluxes of the nodes of each component are
+        computed once, and the pairs are evaluated in blocks of matrix
+        products.
+
+        Args:
+            teff1, teff2 (array-like, optional): teff nodes of each component. Default to the teff nodes of the stellar model.
+            feh (array-like, optional): feh nodes, shared by the components. Defaults to [feh1] (0.0 if unset).
+            logg1, logg2 (array-like, optional): logg nodes of each component. Default to [logg1] and [logg2] (4.4 if unset).
+            Av (array-like, optional): Av nodes. Defaults to [self.Av].
+            D (float, optional): distance (pc) converting the scales into radii. Defaults to self.D.
+            n_best (int, optional): number of best solutions returned. Defaults to 10.
+
+        Returns:
+            dict: 'axes' ({'teff1', 'logg1', 'teff2', 'logg2', 'feh', 'Av'}:
+            nodes), 'chisq', 'R1' and 'R2' (arrays of shape (n_teff1,
+            n_logg1, n_teff2, n_logg2, n_feh, n_Av), inf and NaN for the
+            pairs outside of the model grid) and 'best' (the parameters,
+            radii and chisq of the n_best solutions, best first).
+        """
+        default_feh = self.feh1 if self.feh1 is not None else 0.0
+        axes = {
+            'teff1': self.stellar_model.teff_grid if teff1 is None else teff1,
+            'logg1': (self.logg1 if self.logg1 is not None else 4.4) if logg1 is None else logg1,
+            'teff2': self.stellar_model.teff_grid if teff2 is None else teff2,
+            'logg2': (self.logg2 if self.logg2 is not None else 4.4) if logg2 is None else logg2,
+            'feh': default_feh if feh is None else feh,
+            'Av': self.Av if Av is None else Av,
+        }
+        axes = {name: np.atleast_1d(np.asarray(val, dtype=float)) for name, val in axes.items()}
+        D = self.D if D is None else D
+        n_band = len(self._bands)
+        fluxes_obs, sigmas = self._sigmas()
+        # (n_teff, n_feh, n_logg, n_Av, n_band) -> (n_feh, n_Av, n_teff * n_logg, n_band)
+        fluxes1 = self.node_band_fluxes(axes['teff1'], axes['feh'], axes['logg1'], axes['Av'])
+        fluxes1 = fluxes1.transpose(1, 3, 0, 2, 4).reshape(len(axes['feh']), len(axes['Av']), -1, n_band)
+        fluxes2 = self.node_band_fluxes(axes['teff2'], axes['feh'], axes['logg2'], axes['Av'])
+        fluxes2 = fluxes2.transpose(1, 3, 0, 2, 4).reshape(len(axes['feh']), len(axes['Av']), -1, n_band)
+        n1, n2 = fluxes1.shape[2], fluxes2.shape[2]
+        chisq = np.empty((len(axes['feh']), len(axes['Av']), n1, n2))
+        scale1 = np.empty_like(chisq)
+        scale2 = np.empty_like(chisq)
+        block = max(1, int(self.max_block_bytes // (8 * 12 * n2)))
+        for ind_feh in range(len(axes['feh'])):
+            for ind_av in range(len(axes['Av'])):
+                for start in range(0, n1, block):
+                    stop = min(start + block, n1)
+                    (scale1[ind_feh, ind_av, start:stop], scale2[ind_feh, ind_av, start:stop],
+                     chisq[ind_feh, ind_av, start:stop]) = profile_scales2(
+                        fluxes_obs, sigmas, fluxes1[ind_feh, ind_av, start:stop], fluxes2[ind_feh, ind_av])
+        # (n_feh, n_Av, n_teff1 * n_logg1, n_teff2 * n_logg2) -> (n_teff1, n_logg1, n_teff2, n_logg2, n_feh, n_Av)
+        shape = (len(axes['feh']), len(axes['Av']), len(axes['teff1']), len(axes['logg1']),
+                 len(axes['teff2']), len(axes['logg2']))
+        order = (2, 3, 4, 5, 0, 1)
+        chisq = chisq.reshape(shape).transpose(order)
+        to_radius = D / self._rat_rsun_pc
+        R1 = (np.sqrt(scale1) * to_radius).reshape(shape).transpose(order)
+        R2 = (np.sqrt(scale2) * to_radius).reshape(shape).transpose(order)
+        result = {'axes': axes, 'chisq': chisq, 'R1': R1, 'R2': R2, 'best': []}
+        finite = np.flatnonzero(np.isfinite(chisq))
+        if len(finite) == 0:
+            logger.warning('No pair of the grid has a valid model SED')
+            return result
+        flat_chisq = chisq.ravel()[finite]
+        n_best = min(n_best, len(finite))
+        best = finite[np.argpartition(flat_chisq, n_best - 1)[:n_best]]
+        best = best[np.argsort(chisq.ravel()[best], kind='stable')]
+        for flat_ind in best:
+            ind = np.unravel_index(flat_ind, chisq.shape)
+            solution = {name: float(axes[name][i]) for name, i in zip(axes, ind)}
+            solution.update({'R1': float(R1[ind]), 'R2': float(R2[ind]), 'D': float(D), 'chisq': float(chisq[ind])})
+            result['best'].append(solution)
+        return result
+
     def get_chisq_syserr(self):
         wave_SED, SED_model = self.get_SED()
-        fluxes_obs = np.array(self._obs_fluxes)
-        flux_errs_obs = np.array(self._obs_fluxerrs)
-        arg = np.isnan(flux_errs_obs)
-        flux_errs_obs[arg] = 0
-        if self.syserr is not None:
-            syserrs = fluxes_obs * self.syserr
-            sigma = np.sqrt(flux_errs_obs ** 2 + syserrs ** 2)
-        else:
-            sigma = flux_errs_obs
+        fluxes_obs, sigma = self._sigmas()
         chisq = np.sum((fluxes_obs - SED_model) ** 2 / sigma ** 2)
         return chisq
 
     def get_lnlike(self):
         wave_SED, SED_model = self.get_SED()
-        fluxes_obs = np.array(self._obs_fluxes)
-        flux_errs_obs = np.array(self._obs_fluxerrs)
-        arg = np.isnan(flux_errs_obs)
-        flux_errs_obs[arg] = 0
-        if self.syserr is not None:
-            syserrs = fluxes_obs * self.syserr
-            sigma = np.sqrt(flux_errs_obs ** 2 + syserrs ** 2)
-        else:
-            sigma = flux_errs_obs
+        fluxes_obs, sigma = self._sigmas()
         lnlike = -0.5 * np.sum((fluxes_obs - SED_model)**2 / sigma**2 + np.log(sigma**2))
         return lnlike
 
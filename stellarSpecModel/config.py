@@ -1,6 +1,12 @@
 import os
+import json
 import time
+import threading
 from hashlib import md5
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
 
 
 home_dir = os.path.expanduser('~')
@@ -11,6 +17,21 @@ alias_PATH = os.getenv('stellarSpecModel_alias_PATH', f'{home_dir}/.stellarSpecM
 
 grid_data_dir = os.getenv('stellarSpecModel_grid_PATH', f'{home_dir}/.stellarSpecModel/grid_data/')
 
+# memory budget (in bytes) of the models shared through registry.get_model, 0 means no limit
+model_memory_budget = int(os.getenv('stellarSpecModel_model_memory_budget', 0)) or None
+
+# byte budget of the node-spectrum cache of each lazily read grid file, 0 disables the cache
+node_cache_bytes = int(os.getenv('stellarSpecModel_node_cache_bytes', 256 * 1024 ** 2))
+
+# block size of the streaming md5 of the grid files
+hash_chunk_bytes = 8 * 1024 ** 2
+
+# floating-point precision of the loaded grids and of the flux computations, 'float64' or 'float32'
+PRECISIONS = ('float64', 'float32')
+precision = os.getenv('stellarSpecModel_precision', 'float64')
+if precision not in PRECISIONS:
+    raise ValueError(f"stellarSpecModel_precision should be one of {PRECISIONS}, got '{precision}'")
+
 grid_names = {
     # grid_name: (file_name, url, md5)
     'MARCS': ('MARCS_grid.hdf5', 'https://www.jianguoyun.com/p/DZmcNoUQ2ZfcCBjW-5cFIAA', 'e94e1f52807aa647bb4e9a9bce37e352'),
@@ -26,7 +47,45 @@ grid_names = {
 }
 
 
-def fetch_grid(grid_name):
+def set_precision(name):
+    """
+    Set the precision policy of the models built afterwards.
+
+    With 'float32' the grids are loaded as float32 and the interpolation,
+    the extinction and the band integration run in float32, halving the
+    memory and the memory bandwidth of the hot loops. The models already
+    built keep their precision.
+
+    Args:
+        name (str): 'float64' (the default) or 'float32'.
+    """
+    global precision
+    if name not in PRECISIONS:
+        raise ValueError(f"precision should be one of {PRECISIONS}, got '{name}'")
+    precision = name
+
+
+def get_dtype(dtype=None):
+    """the numpy dtype of the precision policy, or of dtype if given"""
+    return np.dtype(precision if dtype is None else dtype)
+
+
+def fetch_grid(grid_name, background=False):
+    """
+    Download a registered grid if needed and verify its md5.
+
+    Args:
+        grid_name (str): one of grid_names.
+        background (bool, optional): verify an already downloaded file in a
+            background thread (see verify_in_background) and return at once;
+            a broken file is then reported by the returned future. A file
+            downloaded by this call is verified at once and the future is
+            already resolved. Defaults to False.
+
+    Returns:
+        str: the path of the grid file, or (path, future) if background, the
+        future resolving to the dict of verify_all.
+    """
     if grid_name not in grid_names:
         raise ValueError(f'grid_name should be one of {list(grid_names.keys())}')
     file_name, url, md5_value = grid_names[grid_name]
@@ -34,19 +93,154 @@ def fetch_grid(grid_name):
     expected_file_name = file_name
     if not os.path.exists(download_dir):
         os.makedirs(download_dir)
+    downloaded = False
     if not os.path.exists(os.path.join(download_dir, expected_file_name)):
         download_from_jianguoyun(url, download_dir, expected_file_name)
+        downloaded = True
+    if background and not downloaded:
+        return os.path.join(download_dir, expected_file_name), verify_in_background([grid_name])
     if not check_md5(os.path.join(download_dir, expected_file_name), md5_value):
         raise ValueError(f'{expected_file_name} is broken, please delete it and try again')
+    if background:
+        future = Future()
+        future.set_result({grid_name: 'ok'})
+        return os.path.join(download_dir, expected_file_name), future
     return os.path.join(download_dir, expected_file_name)
 
 
-def check_md5(file_path, md5_value):
+def file_md5(file_path, chunk_bytes=None):
+    """md5 hex digest of a file, read in blocks of chunk_bytes (config.hash_chunk_bytes)"""
+    chunk_bytes = hash_chunk_bytes if chunk_bytes is None else int(chunk_bytes)
+    md5_obj = md5()
     with open(file_path, 'rb') as f:
-        md5_obj = md5()
-        md5_obj.update(f.read())
-        md5_file = md5_obj.hexdigest()
-    return md5_file == md5_value
+        for block in iter(lambda: f.read(chunk_bytes), b''):
+            md5_obj.update(block)
+    return md5_obj.hexdigest()
+
+
+def _stamp_path(file_path):
+    return f'{file_path}.verified.json'
+
+
+def _file_signature(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_stamp(file_path):
+    """the verification stamp of a file, None if missing, unreadable or out of date"""
+    try:
+        with open(_stamp_path(file_path)) as f:
+            stamp = json.load(f)
+        signature = _file_signature(file_path)
+    except (OSError, ValueError):
+        return None
+    if stamp.get('size') != signature['size'] or stamp.get('mtime_ns') != signature['mtime_ns']:
+        return None
+    return stamp
+
+
+def _write_stamp(file_path, signature, md5_file):
+    stamp = dict(signature, md5=md5_file, verified_at=time.time())
+    tmp_path = f'{_stamp_path(file_path)}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(stamp, f)
+        os.replace(tmp_path, _stamp_path(file_path))
+    except OSError as exc:
+        logger.debug(f'cannot write the verification stamp of {file_path}: {exc}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def check_md5(file_path, md5_value, force=False):
+    """
+    Check the md5 of a file against the expected value.
+
+    The file is hashed in blocks. A successful check is recorded in the
+    sidecar stamp `<file>.verified.json` (size, mtime and md5), and later
+    checks of the unchanged file only compare the stamp.
+
+    Args:
+        file_path (str): the file.
+        md5_value (str): the expected md5 hex digest.
+        force (bool, optional): ignore the stamp and hash the file. Defaults to False.
+
+    Returns:
+        bool: True if the md5 matches.
+    """
+    if not force:
+        stamp = read_stamp(file_path)
+        if stamp is not None and stamp.get('md5') == md5_value:
+            return True
+    signature = _file_signature(file_path)
+    md5_file = file_md5(file_path)
+    if md5_file != md5_value:
+        return False
+    if _file_signature(file_path) == signature:
+        _write_stamp(file_path, signature, md5_file)
+    return True
+
+
+def verify_grid(grid_name, force=False):
+    """
+    Verify the downloaded file of a registered grid.
+
+    Returns:
+        str: 'ok', 'broken' or 'missing' (the grid was not downloaded).
+    """
+    if grid_name not in grid_names:
+        raise ValueError(f'grid_name should be one of {list(grid_names.keys())}')
+    file_name, url, md5_value = grid_names[grid_name]
+    file_path = os.path.join(grid_data_dir, file_name)
+    if not os.path.exists(file_path):
+        return 'missing'
+    return 'ok' if check_md5(file_path, md5_value, force=force) else 'broken'
+
+
+def verify_all(names=None, workers=4, force=False):
+    """
+    Verify the downloaded files of the registered grids in parallel.
+
+    The hashing releases the GIL, so the files are hashed by a thread
+    pool. Files with an up-to-date stamp are not hashed again unless force.
+
+    Args:
+        names (list, optional): grid names. Defaults to all of grid_names.
+        workers (int, optional): number of files hashed at once. Defaults to 4.
+        force (bool, optional): ignore the stamps. Defaults to False.
+
+    Returns:
+        dict: {grid_name: 'ok' | 'broken' | 'missing'}.
+    """
+    names = list(grid_names) if names is None else list(names)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(lambda name: verify_grid(name, force=force), names))
+    for name, result in zip(names, results):
+        if result == 'broken':
+            logger.warning(f'{grid_names[name][0]} is broken, please delete it and download it again')
+    return dict(zip(names, results))
+
+
+def verify_in_background(names=None, workers=1, force=False):
+    """
+    Run verify_all in a daemon thread.
+
+    Returns:
+        concurrent.futures.Future: resolves to the dict of verify_all.
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(verify_all(names, workers=workers, force=force))
+        except BaseException as exc:
+            future.set_exception(exc)
+
+    threading.Thread(target=run, name='stellarSpecModel-verify', daemon=True).start()
+    return future
 
 
 def download_from_jianguoyun(url, download_dir, expected_file_name):
@@ -0,0 +1,466 @@
+"""
+PCA emulators of spectral grids.
+
+compress(model, tol) factorizes the log10 spectra of the grid nodes with a
+truncated SVD: every node is stored as mean + coefficients @ basis, with
+the fewest components reproducing every valid node within `tol` dex. Only
+the (k, n_wave) basis and the (n_nodes, k) coefficients are kept, instead
+of the (n_nodes, n_wave) tensor.
+
+A query interpolates the k coefficients multilinearly and does one
+(k, n_wave) matrix-vector product. The reconstruction being linear in the
+coefficients, this is exactly the multilinear interpolation of the
+reconstructed grid, so the interpolation error adds to the reconstruction
+error but does not grow with the compression.
+
+The compressed models are drop-in replacements of the models they come
+from: PCAStellarSpecModel is a StellarSpecModel (accepted by SEDModel,
+BinarySEDModel, PhotGrid.compile, ...) and PCASpecModel is a SpecModel.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import h5py
+from pathlib import Path
+from astropy import units as u
+from .SpecGrid import SpecGrid
+from .SpecModel import SpecModel
+from .stellarSpecModel import StellarSpecModel
+from .grid_interp import MultilinearInterpolator
+from . import config
+import logging
+logger = logging.getLogger(__name__)
+
+
+# upper limit of the temporary residual buffer of the error search, in bytes
+max_block_bytes = 64 * 1024 ** 2
+
+
+def _max_error(centered, scores, basis, k):
+    """maximum absolute error of the reconstruction of centered with k components"""
+    block = max(1, int(max_block_bytes // (8 * centered.shape[1])))
+    error = 0.0
+    for start in range(0, len(centered), block):
+        stop = min(start + block, len(centered))
+        residual = centered[start:stop] - scores[start:stop, :k] @ basis[:k]
+        error = max(error, float(np.abs(residual).max()))
+    return error
+
+
+def svd_basis(log_flux, tol=1e-3, max_components=None):
+    """
+    Truncated SVD basis of a set of log10 spectra.
+
+    The number of components k is the smallest reproducing every spectrum
+    within tol at every wavelength, found by bisection on the maximum
+    absolute error.
+
+    Args:
+        log_flux (numpy.ndarray): finite log10 spectra, shape (N, n_wave).
+        tol (float, optional): maximum absolute reconstruction error, in dex. Defaults to 1e-3.
+        max_components (int, optional): upper limit of k, the error may then
+            exceed tol. Defaults to None (no limit).
+
+    Returns:
+        tuple: (mean, basis, coefficients, max_error), the (n_wave,) mean
+        spectrum, the (k, n_wave) orthonormal basis, the (N, k) coefficients
+        and the maximum absolute reconstruction error.
+    """
+    log_flux = np.asarray(log_flux, dtype=float)
+    if log_flux.ndim != 2 or len(log_flux) == 0:
+        raise ValueError(f'log_flux should have shape (N, n_wave) with N > 0, got {log_flux.shape}')
+    mean = log_flux.mean(axis=0)
+    centered = log_flux - mean
+    left, singular, basis = np.linalg.svd(centered, full_matrices=False)
+    scores = left * singular
+    del left
+    limit = len(singular) if max_components is None else max(1, min(len(singular), int(max_components)))
+    errors = {limit: _max_error(centered, scores, basis, limit)}
+    if errors[limit] > tol:
+        logger.warning(f'{limit} components reproduce the grid within {errors[limit]:.3g} dex, above tol = {tol}')
+        k = limit
+    else:
+        lo, k = 1, limit
+        while lo < k:
+            mid = (lo + k) // 2
+            errors[mid] = _max_error(centered, scores, basis, mid)
+            if errors[mid] <= tol:
+                k = mid
+            else:
+                lo = mid + 1
+    return mean, np.ascontiguousarray(basis[:k]), np.ascontiguousarray(scores[:, :k]), errors[k]
+
+
+class PCAEmulator:
+    """
+    A spectral grid compressed on a truncated SVD basis, see the module docstring.
+
+    The coefficients are held by a SpecGrid whose "wavelength" axis is the
+    component index (the same convention as PhotGrid for the bands), so
+    they are saved, loaded and interpolated like any other grid. The
+    emulator has the query interface of MultilinearInterpolator (evaluate,
+    evaluate_one, axes, lower, upper, valid_mask), it is the interpolator
+    of PCASpecModel and PCAStellarSpecModel. Like MultilinearInterpolator,
+    evaluate_one reuses an internal scratch buffer. The basis, the mean and
+    the coefficients are held, and the spectra computed, in dtype
+    (config.precision by default).
+
+    Attributes:
+        grid (SpecGrid): the coefficients, shape (grid shape) + (k,).
+        wave (numpy.ndarray): wavelength of the spectra, shape (n_wave,).
+        mean (numpy.ndarray): mean log10 spectrum, shape (n_wave,).
+        basis (numpy.ndarray): orthonormal basis, shape (k, n_wave).
+        dtype (numpy.dtype): dtype of the computed spectra.
+    """
+
+    def __init__(self, grid: SpecGrid, wave, mean, basis, dtype=None):
+        self.grid = grid
+        self.dtype = config.get_dtype(dtype)
+        self.wave = np.asarray(wave, dtype=float)
+        self.mean = np.ascontiguousarray(mean, dtype=self.dtype)
+        self.basis = np.ascontiguousarray(basis, dtype=self.dtype)
+        if self.basis.shape != (grid.n_wave, len(self.wave)):
+            raise ValueError(f'basis shape {self.basis.shape} mismatches ({grid.n_wave}, {len(self.wave)})')
+        self.axis_names = grid.axis_names
+        axes = tuple(grid.axes[name] for name in self.axis_names)
+        self._coeff_interpolator = MultilinearInterpolator(
+            axes, np.asarray(grid.flux_tensor, dtype=self.dtype), valid_mask=grid.valid_mask, dtype=self.dtype)
+        self.axes = self._coeff_interpolator.axes
+        self.lower = self._coeff_interpolator.lower
+        self.upper = self._coeff_interpolator.upper
+        self.ndim = self._coeff_interpolator.ndim
+        self.valid_mask = grid.valid_mask
+        self.node_cache = None
+        self._coeffs = np.empty(self.n_components, dtype=self.dtype)
+
+    @classmethod
+    def from_model(cls, model, tol=1e-3, max_components=None):
+        """
+        Compress the grid of a model, see svd_basis.
+
+        The valid node spectra are read into memory as float64 once. With a
+        float32 emulator, the reported max_error is measured after the basis,
+        the mean and the coefficients are rounded to float32.
+
+        Args:
+            model (StellarSpecModel or SpecModel): the model, a
+                StellarSpecModel must hold a (teff, feh, logg) grid.
+            tol (float, optional): maximum absolute reconstruction error, in dex. Defaults to 1e-3.
+            max_components (int, optional): upper limit of the number of components. Defaults to None.
+
+        Returns:
+            PCAEmulator: the emulator.
+        """
+        wave, axes, axis_names, flux_tensor, valid_mask, grid_parameters, metadata = _model_grid(model)
+        shape = tuple(len(axes[name]) for name in axis_names)
+        n_wave = len(wave)
+        log_flux = np.asarray(flux_tensor[...], dtype=float).reshape(-1, n_wave)
+        valid = np.asarray(valid_mask, dtype=bool).ravel() & np.all(np.isfinite(log_flux), axis=1)
+        if not valid.any():
+            raise ValueError('The grid has no valid spectrum to compress')
+        mean, basis, scores, max_error = svd_basis(log_flux[valid], tol, max_components)
+        coefficients = np.full((len(log_flux), len(basis)), np.nan)
+        coefficients[valid] = scores
+        metadata.update({
+            'is_derived': True,
+            'kind': 'pca_grid',
+            'pca_tol': float(tol),
+            'pca_max_error': max_error,
+            'parent_nbytes': int(log_flux.size * flux_tensor.dtype.itemsize),
+        })
+        grid = SpecGrid(np.arange(len(basis), dtype=float), axes, axis_names,
+                        coefficients.reshape(shape + (len(basis),)), valid_mask=valid.reshape(shape),
+                        grid_parameters=grid_parameters, metadata=metadata)
+        emulator = cls(grid, wave, mean, basis)
+        if emulator.dtype != np.float64:
+            max_error = emulator._reconstruction_error(log_flux[valid], scores)
+            emulator.metadata['pca_max_error'] = max_error
+        logger.info(f"Compressed {metadata.get('model_name')} with {emulator.n_components} components: "
+                    f"{emulator.compression_ratio:.1f}x smaller, max error {max_error:.3g} dex")
+        return emulator
+
+    @classmethod
+    def load(cls, filepath):
+        """load an emulator from a HDF5 file written by save"""
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"Emulator file not found at {filepath}")
+        grid = SpecGrid.from_hdf5(filepath, lazy=False)
+        with h5py.File(filepath, 'r') as f:
+            wave, mean, basis = f['pca/wave'][:], f['pca/mean'][:], f['pca/basis'][:]
+        return cls(grid, wave, mean, basis)
+
+    def save(self, filepath):
+        """save the emulator to a HDF5 file: the coefficient grid plus the pca/{wave,mean,basis} datasets"""
+        self.grid.to_hdf5(filepath)
+        with h5py.File(filepath, 'a') as f:
+            f.create_dataset('pca/wave', data=self.wave)
+            f.create_dataset('pca/mean', data=self.mean)
+            f.create_dataset('pca/basis', data=self.basis)
+
+    def _reconstruction_error(self, log_flux, coefficients):
+        """maximum absolute error of the spectra rebuilt like evaluate does, in the emulator dtype"""
+        coefficients = np.asarray(coefficients, dtype=self.dtype)
+        block = max(1, int(max_block_bytes // (8 * self.n_wave)))
+        out = np.empty((min(block, len(log_flux)), self.n_wave), dtype=self.dtype)
+        error = 0.0
+        for start in range(0, len(log_flux), block):
+            stop = min(start + block, len(log_flux))
+            rebuilt = out[:stop - start]
+            np.matmul(coefficients[start:stop], self.basis, out=rebuilt)
+            rebuilt += self.mean
+            error = max(error, float(np.abs(log_flux[start:stop] - rebuilt).max()))
+        return error
+
+    @property
+    def metadata(self):
+        return self.grid.metadata
+
+    @property
+    def n_wave(self):
+        return len(self.wave)
+
+    @property
+    def n_components(self):
+        return len(self.basis)
+
+    @property
+    def max_error(self):
+        """maximum absolute reconstruction error of the nodes in the emulator dtype, in dex"""
+        return float(self.metadata['pca_max_error'])
+
+    @property
+    def nbytes(self):
+        """bytes held by the basis, the mean and the coefficients"""
+        return self.basis.nbytes + self.mean.nbytes + self._coeff_interpolator.values.nbytes + self.valid_mask.nbytes
+
+    @property
+    def compression_ratio(self):
+        """size of the parent grid over the size of the emulator"""
+        return self.metadata['parent_nbytes'] / self.nbytes
+
+    def report(self):
+        """
+        Summarize the compression.
+
+        Returns:
+            dict: 'n_components', 'tol', 'max_error' (dex), 'nbytes',
+            'parent_nbytes' and 'compression_ratio'.
+        """
+        return {
+            'n_components': self.n_components,
+            'tol': float(self.metadata['pca_tol']),
+            'max_error': self.max_error,
+            'nbytes': self.nbytes,
+            'parent_nbytes': int(self.metadata['parent_nbytes']),
+            'compression_ratio': self.compression_ratio,
+        }
+
+    def evaluate(self, points, out=None):
+        """
+        Interpolate the log10 spectra at a batch of points.
+
+        Args:
+            points (numpy.ndarray): query points, shape (N, ndim).
+            out (numpy.ndarray, optional): float array of shape (N, n_wave)
+                receiving the result. Defaults to None.
+
+        Returns:
+            tuple: (values, invalid), see MultilinearInterpolator.evaluate.
+        """
+        coeffs, invalid = self._coeff_interpolator.evaluate(points)
+        if out is None:
+            out = np.empty((len(coeffs), self.n_wave), dtype=self.dtype)
+        elif out.shape != (len(coeffs), self.n_wave):
+            raise ValueError(f'out should have shape {(len(coeffs), self.n_wave)}, got {out.shape}')
+        np.matmul(coeffs, self.basis, out=out)
+        out += self.mean
+        out[invalid] = np.nan
+        return out, invalid
+
+    def evaluate_one(self, point, out=None):
+        """
+        Interpolate the log10 spectrum at one point.
+
+        Args:
+            point (sequence): the ndim coordinates of the point.
+            out (numpy.ndarray, optional): float array of shape (n_wave,)
+                receiving the result. Defaults to None.
+
+        Returns:
+            tuple: (values, invalid), see MultilinearInterpolator.evaluate_one.
+        """
+        if out is None:
+            out = np.empty(self.n_wave, dtype=self.dtype)
+        coeffs, invalid = self._coeff_interpolator.evaluate_one(point, out=self._coeffs)
+        if invalid:
+            out.fill(np.nan)
+            return out, True
+        np.matmul(coeffs, self.basis, out=out)
+        out += self.mean
+        return out, False
+
+
+def _model_grid(model):
+    """wave, axes, axis_names, flux_tensor, valid_mask, grid_parameters and metadata of a model"""
+    if isinstance(model, (PCASpecModel, PCAStellarSpecModel)):
+        raise ValueError('The model is already compressed')
+    if isinstance(model, StellarSpecModel):
+        if not hasattr(model, '_spec_grid'):
+            raise ValueError(f'{type(model).__name__} has no single (teff, feh, logg) grid to compress')
+        axes = {'teff': model.teff_grid, 'feh': model.feh_grid, 'logg': model.logg_grid}
+        grid_name = model._grid_name
+        model_name = type(model).__name__ if grid_name is None else os.path.splitext(os.path.basename(grid_name))[0]
+        return (model.wavelength, axes, ['teff', 'feh', 'logg'], model._spec_grid,
+                np.ones(model._spec_grid.shape[:-1], dtype=bool), {}, {'model_name': model_name})
+    if isinstance(model, SpecModel):
+        grid = model.grid
+        return (grid.wave, dict(grid.axes), list(grid.axis_names), grid.flux_tensor, grid.valid_mask,
+                dict(grid.grid_parameters), dict(grid.metadata))
+    raise ValueError(f'cannot compress a {type(model).__name__}, only StellarSpecModel and SpecModel')
+
+
+def _generate_cache_key(model, tol, max_components):
+    md5_obj = hashlib.md5()
+    md5_obj.update(type(model).__name__.encode('utf-8'))
+    wave, axes, axis_names, flux_tensor, valid_mask, grid_parameters, metadata = _model_grid(model)
+    if isinstance(flux_tensor, h5py.Dataset):
+        grid_file = flux_tensor.file.filename
+    else:
+        grid_file = getattr(model, '_grid_name', None)
+    if grid_file is not None and os.path.exists(grid_file):
+        stat = os.stat(grid_file)
+        md5_obj.update(f'{os.path.abspath(grid_file)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    else:
+        md5_obj.update(np.ascontiguousarray(flux_tensor).tobytes())
+        md5_obj.update(np.ascontiguousarray(valid_mask).tobytes())
+    md5_obj.update(np.ascontiguousarray(wave, dtype=float).tobytes())
+    for name in axis_names:
+        md5_obj.update(np.ascontiguousarray(axes[name], dtype=float).tobytes())
+    # the basis is saved in the working precision
+    md5_obj.update(json.dumps({'tol': float(tol), 'max_components': max_components,
+                               'dtype': str(config.get_dtype())}).encode('utf-8'))
+    return md5_obj.hexdigest()
+
+
+def compress(model, tol=1e-3, max_components=None, *, cache_dir=None, overwrite=False):
+    """
+    Compress a model into a PCA emulator, like SpecModel.derive for the grid axes.
+
+    The emulator is cached in the derived-grid cache, a later call with
+    the same grid, tol, max_components and config.precision loads the cached
+    emulator.
+
+    Args:
+        model (StellarSpecModel or SpecModel): the model to compress.
+        tol (float, optional): maximum absolute reconstruction error of the
+            node log10 spectra, in dex. Defaults to 1e-3 (0.23%).
+        max_components (int, optional): upper limit of the number of
+            components, the error may then exceed tol. Defaults to None.
+        cache_dir (str or pathlib.Path, optional): cache directory. Defaults to config.cache_PATH.
+        overwrite (bool, optional): compress again even if cached. Defaults to False.
+
+    Returns:
+        PCAStellarSpecModel or PCASpecModel: the compressed model, of the
+        same family as model. See its emulator.report() for the
+        compression ratio and the maximum reconstruction error.
+    """
+    model_class = PCAStellarSpecModel if isinstance(model, StellarSpecModel) else PCASpecModel
+    if cache_dir is None:
+        active_cache_dir = Path(config.cache_PATH).expanduser()
+    else:
+        active_cache_dir = Path(cache_dir).expanduser()
+    active_cache_dir.mkdir(parents=True, exist_ok=True)
+    metadata = _model_grid(model)[-1]
+    cache_hash = _generate_cache_key(model, tol, max_components)
+    cache_filepath = active_cache_dir / f"{metadata.get('model_name', 'grid')}_pca_{cache_hash}.h5"
+    if cache_filepath.exists() and not overwrite:
+        logger.info(f"Cache hit! Loading emulator from {cache_filepath}")
+        return model_class.load(cache_filepath)
+
+    emulator = PCAEmulator.from_model(model, tol, max_components)
+    logger.info(f"Caching emulator to {cache_filepath}")
+    tmp_filepath = cache_filepath.with_name(f'{cache_filepath.name}.{os.getpid()}.tmp')
+    emulator.save(tmp_filepath)
+    os.replace(tmp_filepath, cache_filepath)
+    return model_class(emulator, grid_name=str(cache_filepath))
+
+
+class PCASpecModel(SpecModel):
+    """
+    A SpecModel querying a PCAEmulator instead of the full flux tensor.
+
+    The grid attribute is the coefficient grid of the emulator (same axes
+    and valid mask as the parent grid), wave is the wavelength of the
+    spectra.
+    """
+
+    def __init__(self, emulator: PCAEmulator, grid_name=None):
+        """
+        :param emulator: PCAEmulator of the grid
+        :param grid_name: path of the emulator file, if any
+        """
+        self.emulator = emulator
+        self.grid = emulator.grid
+        self.dtype = emulator.dtype
+        self._grid_name = grid_name
+        self._interpolator = emulator
+
+    @classmethod
+    def load(cls, filepath):
+        """load a compressed model from an emulator file"""
+        return cls(PCAEmulator.load(filepath), grid_name=str(filepath))
+
+    def derive(self, *args, **kwargs):
+        raise ValueError('A compressed model cannot be derived, derive the parent model and compress the result')
+
+    @property
+    def wave(self):
+        return self.emulator.wave
+
+
+class PCAStellarSpecModel(StellarSpecModel):
+    """
+    A StellarSpecModel querying a PCAEmulator of its (teff, feh, logg) grid.
+    """
+
+    def __init__(self, emulator: PCAEmulator, grid_name=None):
+        """
+        Args:
+            emulator (PCAEmulator): emulator of a (teff, feh, logg) grid.
+            grid_name (str, optional): path of the emulator file, if any. Defaults to None.
+        """
+        if tuple(emulator.axis_names) != ('teff', 'feh', 'logg'):
+            raise ValueError(f"The emulator axes should be ('teff', 'feh', 'logg'), got {emulator.axis_names}")
+        self.emulator = emulator
+        self._grid_name = grid_name
+        self._wavelength = emulator.wave
+        self._teff_grid, self._feh_grid, self._logg_grid = (emulator.grid.axes[name] for name in emulator.axis_names)
+        self._shared = None
+        self._interpolator = emulator
+        self._flux_units = u.erg / u.s / u.cm ** 2 / u.AA
+        self._wavelength_units = u.AA
+
+    @classmethod
+    def load(cls, filepath):
+        """load a compressed model from an emulator file"""
+        return cls(PCAEmulator.load(filepath), grid_name=str(filepath))
+
+    def memory_report(self):
+        """
+        Report the memory held by the emulator, see StellarSpecModel.memory_report.
+
+        'float64_nbytes' is the size of the uncompressed grid in float64.
+        """
+        nbytes = self.emulator.nbytes
+        float64_nbytes = len(self._wavelength) * int(np.prod(self.emulator.grid.shape)) * np.dtype(np.float64).itemsize
+        return {
+            'dtype': str(self.emulator.basis.dtype),
+            'grid_nbytes': nbytes,
+            'float64_nbytes': float64_nbytes,
+            'heap_nbytes': nbytes,
+            'mapped_nbytes': 0,
+            'resident_nbytes': 0,
+            'shared_nbytes': 0,
+            'saved_nbytes': float64_nbytes - nbytes,
+        }
@@ -0,0 +1,251 @@
+import bisect
+import itertools
+import numpy as np
+from . import config
+
+
+class MultilinearInterpolator:
+    """
+    Vectorized multilinear interpolation on a rectilinear grid of spectra.
+
+    The last axis of ``values`` is the wavelength axis, every other axis
+    corresponds to one entry of ``axes``. All query points of a batch are
+    handled with array operations: the 2**ndim cell corners are gathered
+    one corner at a time for the whole batch and accumulated with their
+    weights, so there is no Python loop over the query points.
+
+    The axis bounds, the steps of uniformly spaced axes (located in O(1)
+    instead of a binary search) and the corner offsets are computed once.
+    ``evaluate_one`` is the single-point path: with an ``out`` buffer and
+    in-memory values it allocates no arrays. It reuses an internal
+    scratch buffer, so one interpolator should not be shared between
+    threads calling ``evaluate_one`` concurrently.
+
+    The results are accumulated in the dtype of the output array, by
+    default ``dtype`` (the precision policy of config, float64 or float32).
+
+    Attributes:
+        axes (tuple): 1D ascending arrays of the grid axes.
+        values (array-like): grid values, shape ``axes shape + (n_wave,)``.
+        valid_mask (numpy.ndarray or None): bool array of the axes shape,
+            False marks holes of the grid.
+        dtype (numpy.dtype): dtype of the results.
+    """
+
+    # upper limit of the temporary gather buffer, in bytes
+    max_chunk_bytes = 64 * 1024 ** 2
+
+    def __init__(self, axes, values, valid_mask=None, node_cache=None, dtype=None):
+        """
+        Initialize the interpolator.
+
+        Args:
+            axes (sequence): 1D ascending arrays, one per grid dimension.
+            values (array-like): ndarray (or np.memmap, or h5py dataset) of the grid values.
+            valid_mask (numpy.ndarray, optional): bool array of the axes
+                shape, a query depending on a False node is invalid.
+                Defaults to None (NaN values still mark holes).
+            node_cache (NodeCache, optional): cache of the node spectra of
+                lazily read values (an h5py dataset). Defaults to None.
+            dtype (numpy.dtype, optional): float32 or float64, dtype of the
+                results. Defaults to None (config.precision).
+
+        Returns:
+            MultilinearInterpolator: An instance of the MultilinearInterpolator class.
+        """
+        self.axes = tuple(np.asarray(axis, dtype=float) for axis in axes)
+        self.values = values
+        if tuple(values.shape[:-1]) != tuple(len(axis) for axis in self.axes):
+            raise ValueError(f'values shape {values.shape} mismatches the axes shape')
+        self.valid_mask = None if valid_mask is None else np.asarray(valid_mask, dtype=bool)
+        self.ndim = len(self.axes)
+        self.lower = np.array([axis[0] for axis in self.axes])
+        self.upper = np.array([axis[-1] for axis in self.axes])
+        self._max_index = np.array([len(axis) - 1 for axis in self.axes], dtype=np.intp)
+        self._corners = np.array(list(itertools.product((0, 1), repeat=self.ndim)), dtype=np.intp)
+        self._in_memory = isinstance(values, np.ndarray)
+        self.node_cache = None if self._in_memory else node_cache
+        # per axis: the node spacing of a uniform axis, None otherwise
+        self._steps = []
+        for axis in self.axes:
+            step = None
+            if len(axis) > 1:
+                candidate = (axis[-1] - axis[0]) / (len(axis) - 1)
+                if np.allclose(np.diff(axis), candidate, rtol=1e-9, atol=0):
+                    step = candidate
+            self._steps.append(step)
+        # plain python copies for the scalar path
+        self._axis_lists = [axis.tolist() for axis in self.axes]
+        self._lower_list = self.lower.tolist()
+        self._upper_list = self.upper.tolist()
+        self._corner_list = [tuple(corner) for corner in self._corners.tolist()]
+        self._max_index_list = self._max_index.tolist()
+        self._block_max_index = [min(n, 1) for n in self._max_index_list]
+        self.dtype = config.get_dtype(dtype)
+        self._scratch = np.empty(self.n_wave, dtype=self.dtype)
+
+    @property
+    def n_wave(self):
+        """Get the length of the wavelength axis."""
+        return self.values.shape[-1]
+
+    def locate(self, points):
+        """
+        Find the grid cell and the fractional position of each query point.
+
+        Args:
+            points (numpy.ndarray): query points, shape (N, ndim).
+
+        Returns:
+            tuple: (index, frac, invalid). ``index`` (N, ndim) is the lower
+            corner of the cell, ``frac`` (N, ndim) the position inside the
+            cell in [0, 1] and ``invalid`` (N,) flags points outside of the
+            grid or with non-finite coordinates. Invalid points are located
+            at the first node so that they can be gathered safely.
+        """
+        points = np.asarray(points, dtype=float)
+        invalid = ~np.all(np.isfinite(points), axis=1)
+        invalid |= np.any((points < self.lower) | (points > self.upper), axis=1)
+        index = np.zeros(points.shape, dtype=np.intp)
+        frac = np.zeros(points.shape, dtype=float)
+        for dim, axis in enumerate(self.axes):
+            if len(axis) == 1:
+                continue
+            pts = points[:, dim]
+            step = self._steps[dim]
+            if step is None:
+                ind = np.searchsorted(axis, pts, side='right') - 1
+            else:
+                with np.errstate(invalid='ignore'):
+                    ind = np.floor((pts - axis[0]) / step)
+                ind = np.nan_to_num(ind).astype(np.intp)
+            np.clip(ind, 0, len(axis) - 2, out=ind)
+            left = axis[ind]
+            frac[:, dim] = np.clip((pts - left) / (axis[ind + 1] - left), 0.0, 1.0)
+            index[:, dim] = ind
+        index[invalid] = 0
+        frac[invalid] = 0.0
+        return index, frac, invalid
+
+    def _gather(self, index):
+        """read the node spectra of the (N, ndim) node indices"""
+        if self._in_memory:
+            return self.values[tuple(index.T)]
+        if self.node_cache is not None:
+            return np.stack([self.node_cache.get(tuple(node), self.values) for node in index.tolist()])
+        return np.stack([self.values[tuple(node)] for node in index])
+
+    def evaluate(self, points, out=None):
+        """
+        Interpolate the grid at a batch of points.
+
+        Args:
+            points (numpy.ndarray): query points, shape (N, ndim).
+            out (numpy.ndarray, optional): float array of shape (N, n_wave)
+                receiving the result. Defaults to None (allocate a new one of dtype).
+
+        Returns:
+            tuple: (values, invalid). ``values`` has shape (N, n_wave), the
+            rows of points outside of the grid or falling into a hole of
+            the grid (a masked or NaN node with a non-zero weight) are NaN
+            and flagged in ``invalid``.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if points.shape[1] != self.ndim:
+            raise ValueError(f'points should have shape (N, {self.ndim}), got {points.shape}')
+        npoint = points.shape[0]
+        if out is None:
+            out = np.empty((npoint, self.n_wave), dtype=self.dtype)
+        elif out.shape != (npoint, self.n_wave):
+            raise ValueError(f'out should have shape {(npoint, self.n_wave)}, got {out.shape}')
+        index, frac, invalid = self.locate(points)
+        row_bytes = self.n_wave * max(out.itemsize, self.values.dtype.itemsize)
+        chunk = max(1, int(self.max_chunk_bytes // row_bytes))
+        for start in range(0, npoint, chunk):
+            stop = min(start + chunk, npoint)
+            invalid[start:stop] |= self._accumulate(index[start:stop], frac[start:stop], out[start:stop])
+        invalid |= np.isnan(out.sum(axis=1))
+        out[invalid] = np.nan
+        return out, invalid
+
+    def _accumulate(self, index, frac, out):
+        out[...] = 0.0
+        in_hole = np.zeros(len(index), dtype=bool)
+        for corner in self._corners:
+            weight = np.prod(np.where(corner, frac, 1.0 - frac), axis=1)
+            node = np.minimum(index + corner, self._max_index)
+            used = weight > 0
+            if self.valid_mask is not None:
+                in_hole |= used & ~self.valid_mask[tuple(node.T)]
+            spectra = np.asarray(self._gather(node), dtype=out.dtype)
+            spectra[~used] = 0.0
+            spectra *= weight.astype(out.dtype, copy=False)[:, None]
+            out += spectra
+        return in_hole
+
+    def evaluate_one(self, point, out=None):
+        """
+        Interpolate the grid at one point.
+
+        Args:
+            point (sequence): the ndim coordinates of the point.
+            out (numpy.ndarray, optional): float array of shape (n_wave,)
+                receiving the result. Defaults to None (allocate a new one of dtype).
+
+        Returns:
+            tuple: (values, invalid), the (n_wave,) interpolated values (NaN
+            if invalid) and whether the point is outside of the grid or in
+            a hole.
+        """
+        if out is None:
+            out = np.empty(self.n_wave, dtype=self.dtype)
+        lows = [0] * self.ndim
+        fracs = [0.0] * self.ndim
+        for dim in range(self.ndim):
+            val = point[dim]
+            if not (self._lower_list[dim] <= val <= self._upper_list[dim]):
+                out.fill(np.nan)
+                return out, True
+            axis = self._axis_lists[dim]
+            nnode = len(axis)
+            if nnode == 1:
+                continue
+            step = self._steps[dim]
+            if step is None:
+                ind = bisect.bisect_right(axis, val) - 1
+            else:
+                ind = int((val - axis[0]) / step)
+            ind = min(max(ind, 0), nnode - 2)
+            frac = (val - axis[ind]) / (axis[ind + 1] - axis[ind])
+            lows[dim] = ind
+            fracs[dim] = min(max(frac, 0.0), 1.0)
+
+        values = None
+        if not self._in_memory and self.node_cache is None:
+            # one read of the bounding block instead of one read per corner
+            values = self.values[tuple(slice(low, low + 2) for low in lows)]
+        invalid = False
+        out.fill(0.0)
+        scratch = self._scratch
+        for corner in self._corner_list:
+            weight = 1.0
+            for dim in range(self.ndim):
+                weight *= fracs[dim] if corner[dim] else 1.0 - fracs[dim]
+            if weight == 0.0:
+                continue
+            node = tuple(min(lows[dim] + corner[dim], self._max_index_list[dim]) for dim in range(self.ndim))
+            if self.valid_mask is not None and not self.valid_mask[node]:
+                invalid = True
+                break
+            if self._in_memory:
+                spectrum = self.values[node]
+            elif values is None:
+                spectrum = self.node_cache.get(node, self.values)
+            else:
+                spectrum = values[tuple(min(corner[dim], self._block_max_index[dim]) for dim in range(self.ndim))]
+            np.multiply(spectrum, weight, out=scratch)
+            out += scratch
+        if invalid or np.isnan(out.sum()):
+            out.fill(np.nan)
+            return out, True
+        return out, False
@@ -0,0 +1,204 @@
+import os
+import hashlib
+import numpy as np
+import h5py
+from pathlib import Path
+from .SpecGrid import SpecGrid, CHUNK_LAYOUTS, _dataset_options
+from . import config
+import logging
+logger = logging.getLogger(__name__)
+
+
+def map_dataset(filename, dataset_path, cache_dir=None, max_chunk_bytes=256 * 1024 ** 2):
+    """
+    Memory-map a HDF5 dataset read-only, keeping its stored dtype.
+
+    A contiguous, uncompressed dataset is mapped directly from the HDF5
+    file. Any other layout (chunked or compressed) is exported once into a
+    sidecar .npy file in the cache directory, which is then mapped. The
+    sidecar name records the size and mtime of the HDF5 file, so a
+    modified file gets a new export.
+
+    Args:
+        filename (str): path of the HDF5 file.
+        dataset_path (str): path of the dataset inside the file, e.g. 'default/spec_grid'.
+        cache_dir (str, optional): directory of the sidecar files. Defaults to config.cache_PATH.
+        max_chunk_bytes (int, optional): memory used while exporting a sidecar file.
+
+    Returns:
+        numpy.memmap: the read-only mapped array.
+    """
+    with h5py.File(filename, 'r') as f:
+        dset = f[dataset_path]
+        offset = dset.id.get_offset() if dset.chunks is None and dset.compression is None else None
+        if offset is not None and dset.dtype.isnative:
+            return np.memmap(filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+        sidecar = _sidecar_path(filename, dataset_path, cache_dir)
+        if not sidecar.exists():
+            _export_npy(dset, sidecar, max_chunk_bytes)
+    return np.load(sidecar, mmap_mode='r')
+
+
+def _sidecar_path(filename, dataset_path, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = config.cache_PATH
+    cache_dir = Path(cache_dir).expanduser()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    stat = os.stat(filename)
+    key = f'{os.path.abspath(filename)}:{dataset_path}:{stat.st_size}:{stat.st_mtime_ns}'
+    key_hash = hashlib.md5(key.encode('utf-8')).hexdigest()
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    return cache_dir / f'{base_name}_{dataset_path.replace("/", "_")}_{key_hash}.npy'
+
+
+def _export_npy(dset, sidecar, max_chunk_bytes):
+    logger.info(f'Exporting {dset.name} to {sidecar}')
+    tmp_path = sidecar.with_name(sidecar.name + f'.{os.getpid()}.tmp')
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dset.dtype.newbyteorder('='), shape=dset.shape)
+    row_bytes = max(1, dset.dtype.itemsize * int(np.prod(dset.shape[1:], dtype=np.int64)))
+    step = max(1, int(max_chunk_bytes // row_bytes))
+    for start in range(0, dset.shape[0], step):
+        stop = min(start + step, dset.shape[0])
+        out[start:stop] = dset[start:stop]
+    out.flush()
+    del out
+    os.replace(tmp_path, sidecar)
+
+
+def mapped_resident_bytes(array):
+    """
+    Get the number of bytes of a memory-mapped array resident in RAM.
+
+    The value is read from /proc/self/smaps, so it is only available on
+    Linux. The pages are shared through the page cache: the value counts
+    the pages mapped by this process, which other processes mapping the
+    same file reuse.
+
+    Args:
+        array (numpy.memmap): the mapped array.
+
+    Returns:
+        int or None: resident bytes, None if it cannot be determined.
+    """
+    start = array.ctypes.data
+    stop = start + array.nbytes
+    resident = 0
+    try:
+        with open('/proc/self/smaps') as f:
+            in_range = False
+            for line in f:
+                fields = line.split()
+                if '-' in fields[0] and len(fields) >= 5:
+                    low, high = (int(value, 16) for value in fields[0].split('-'))
+                    in_range = low < stop and high > start
+                elif in_range and fields[0] == 'Rss:':
+                    resident += int(fields[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident
+
+
+def rewrite_grid(filepath, out_path=None, layout='spectrum', compression=None, compression_opts=None,
+                 shuffle=False, wave_tile=4096, max_chunk_bytes=256 * 1024 ** 2):
+    """
+    Rewrite a SpecGrid HDF5 file with another flux-tensor layout.
+
+    The flux tensor is copied slab by slab, so the grid does not need to
+    fit in memory. The new file is written next to the target and moved
+    into place at the end; by default the file is rewritten in place.
+
+    Args:
+        filepath (str): SpecGrid HDF5 file, e.g. a cached derived grid.
+        out_path (str, optional): output file. Defaults to None (replace filepath).
+        layout, compression, compression_opts, shuffle, wave_tile: see SpecGrid.to_hdf5.
+        max_chunk_bytes (int, optional): memory used while copying.
+
+    Returns:
+        pathlib.Path: the written file.
+    """
+    filepath = Path(filepath)
+    out_path = filepath if out_path is None else Path(out_path)
+    tmp_path = out_path.with_name(out_path.name + f'.{os.getpid()}.tmp')
+    with SpecGrid.from_hdf5(filepath, lazy=True) as grid:
+        dset = grid.flux_tensor
+        f = SpecGrid.create_hdf5(tmp_path, grid.wave, grid.axes, grid.axis_names, dtype=dset.dtype,
+                                 valid_mask=grid.valid_mask, grid_parameters=grid.grid_parameters,
+                                 metadata=grid.metadata, layout=layout, compression=compression,
+                                 compression_opts=compression_opts, shuffle=shuffle, wave_tile=wave_tile)
+        try:
+            row_bytes = max(1, dset.dtype.itemsize * int(np.prod(dset.shape[1:], dtype=np.int64)))
+            step = max(1, int(max_chunk_bytes // row_bytes))
+            for start in range(0, dset.shape[0], step):
+                stop = min(start + step, dset.shape[0])
+                f['flux_tensor'][start:stop] = dset[start:stop]
+        except Exception:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        f.close()
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def rewrite_cache(cache_dir=None, pattern='*.h5', layout='spectrum', compression=None,
+                  compression_opts=None, shuffle=False, wave_tile=4096):
+    """
+    Rewrite the cached grids (derived grids, phot grids) with another layout.
+
+    Files which already have the requested layout and filters, and files
+    which are not SpecGrid files, are left untouched.
+
+    Args:
+        cache_dir (str, optional): Defaults to config.cache_PATH.
+        pattern (str, optional): glob pattern of the files. Defaults to '*.h5'.
+        layout, compression, compression_opts, shuffle, wave_tile: see SpecGrid.to_hdf5.
+
+    Returns:
+        list: the rewritten files.
+    """
+    if cache_dir is None:
+        cache_dir = config.cache_PATH
+    rewritten = []
+    for filepath in sorted(Path(cache_dir).expanduser().glob(pattern)):
+        with h5py.File(filepath, 'r') as f:
+            if 'flux_tensor' not in f or 'axis_names' not in f.attrs:
+                continue
+            dset = f['flux_tensor']
+            options = _dataset_options(layout, dset.shape[:-1], dset.shape[-1], compression,
+                                       compression_opts, shuffle, wave_tile)
+            current = (dset.chunks, dset.shuffle, dset.compression, dset.compression_opts)
+            # h5py compresses with gzip level 4 by default
+            wanted = (options.get('chunks'), options.get('shuffle', False), compression,
+                      options.get('compression_opts', 4 if compression == 'gzip' else None))
+            if current == wanted:
+                continue
+        logger.info(f'Rewriting {filepath} with the {layout} layout')
+        rewritten.append(rewrite_grid(filepath, layout=layout, compression=compression,
+                                      compression_opts=compression_opts, shuffle=shuffle,
+                                      wave_tile=wave_tile))
+    return rewritten
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Rewrite SpecGrid files with another chunk layout and compression.')
+    parser.add_argument('paths', nargs='*', help='grid files or directories, defaults to the cache directory')
+    parser.add_argument('--layout', default='spectrum', choices=CHUNK_LAYOUTS)
+    parser.add_argument('--compression', default=None, choices=['gzip', 'lzf'])
+    parser.add_argument('--compression-opts', type=int, default=None, help='gzip level')
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--wave-tile', type=int, default=4096)
+    args = parser.parse_args(argv)
+    options = dict(layout=args.layout, compression=args.compression, compression_opts=args.compression_opts,
+                   shuffle=args.shuffle, wave_tile=args.wave_tile)
+    paths = args.paths or [config.cache_PATH]
+    for path in paths:
+        if os.path.isdir(path):
+            for filepath in rewrite_cache(path, **options):
+                print(filepath)
+        else:
+            print(rewrite_grid(path, **options))
+
+
+if __name__ == '__main__':
+    main()
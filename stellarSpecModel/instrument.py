@@ -0,0 +1,239 @@
+"""
+Off-by-default timers and counters around the hot stages of the models.
+
+The models wrap each stage of a flux or SED evaluation in
+`with instrument.stage(name, items):`. When the instrumentation is
+disabled (the default) `stage` returns a shared no-op context manager,
+the cost is one function call and one global lookup per stage. When it
+is enabled every stage adds its call count, its number of items (spectra
+or points) and its wall time to module-level totals, and the registered
+callbacks are called on a sample of the events.
+
+Stages:
+    interpolate: grid interpolation of log10 spectra (or band fluxes).
+    exp10: the 10 ** log_flux of the interpolated spectra.
+    extinction: reddening of spectra (including extinction_curve).
+    extinction_curve: computation of an extinction curve (cache misses only).
+    rebin: flux-conserving resampling of grid spectra (SpecModel.derive).
+    project: integration of spectra over the filters.
+    phot_grid: interpolation of the band fluxes in the fast photometric mode.
+
+Usage:
+    with instrument.profile() as prof:
+        model.get_SED()
+    print(prof)
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+
+STAGES = ('interpolate', 'exp10', 'extinction', 'extinction_curve', 'rebin', 'project', 'phot_grid')
+
+enabled = False
+_explicit = False
+_n_profiles = 0
+# stage: [calls, items, seconds]
+_totals = {}
+# [func, every, count]
+_callbacks = []
+_lock = threading.Lock()
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('name', 'items', 'start')
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start, self.items)
+        return False
+
+
+def stage(name, items=1):
+    """
+    Time one stage of an evaluation.
+
+    Args:
+        name (str): the stage, see STAGES.
+        items (int, optional): number of spectra or points processed. Defaults to 1.
+
+    Returns:
+        a context manager, a shared no-op one when the instrumentation is disabled.
+    """
+    if not enabled:
+        return _null_stage
+    return _Stage(name, items)
+
+
+def record(name, seconds, items=1):
+    """add one event of a stage to the totals and pass it to the sampling callbacks"""
+    with _lock:
+        total = _totals.get(name)
+        if total is None:
+            total = _totals[name] = [0, 0, 0.0]
+        total[0] += 1
+        total[1] += items
+        total[2] += seconds
+        sampled = []
+        for callback in _callbacks:
+            callback[2] += 1
+            if callback[2] >= callback[1]:
+                callback[2] = 0
+                sampled.append(callback[0])
+    for func in sampled:
+        func(name, seconds, items)
+
+
+def enable():
+    global enabled, _explicit
+    with _lock:
+        _explicit = True
+        enabled = True
+
+
+def disable():
+    """disable the instrumentation, profile() blocks still running keep it on until they exit"""
+    global enabled, _explicit
+    with _lock:
+        _explicit = False
+        enabled = _n_profiles > 0
+
+
+def reset():
+    """clear the totals"""
+    with _lock:
+        _totals.clear()
+
+
+def add_callback(func, every=1):
+    """
+    Register a sampling callback.
+
+    Args:
+        func (callable): func(stage, seconds, items), called outside of the lock.
+        every (int, optional): call func on one event out of every. Defaults to 1.
+    """
+    if every < 1:
+        raise ValueError(f'every should be >= 1, got {every}')
+    with _lock:
+        _callbacks.append([func, int(every), 0])
+
+
+def remove_callback(func):
+    with _lock:
+        _callbacks[:] = [callback for callback in _callbacks if callback[0] is not func]
+
+
+def totals():
+    """
+    The totals since the last reset.
+
+    Returns:
+        dict: {stage: {'calls', 'items', 'seconds'}}.
+    """
+    with _lock:
+        return {name: {'calls': calls, 'items': items, 'seconds': seconds}
+                for name, (calls, items, seconds) in _totals.items()}
+
+
+class Profile:
+    """
+    Per-stage breakdown of the code run inside a profile() block.
+
+    Attributes:
+        stages (dict): {stage: {'calls', 'items', 'seconds', 'fraction'}},
+            fraction is the share of the wall time of the block. Nested
+            stages (extinction_curve in extinction) are counted in both.
+        wall (float): wall time of the block in seconds.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.wall = 0.0
+
+    @property
+    def other(self):
+        """wall time outside of the top-level stages"""
+        return self.wall - sum(val['seconds'] for name, val in self.stages.items() if name != 'extinction_curve')
+
+    def as_dict(self):
+        return {'wall': self.wall, 'other': self.other, 'stages': self.stages}
+
+    def __str__(self):
+        lines = [f"{'stage':18s} {'calls':>9s} {'items':>10s} {'seconds':>11s} {'fraction':>9s}"]
+        for name, val in sorted(self.stages.items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"{name:18s} {val['calls']:9d} {val['items']:10d} {val['seconds']:11.6f} {val['fraction']:9.1%}")
+        lines.append(f"{'other':18s} {'':9s} {'':10s} {self.other:11.6f} "
+                     f"{self.other / self.wall if self.wall > 0 else 0.0:9.1%}")
+        lines.append(f"{'wall':18s} {'':9s} {'':10s} {self.wall:11.6f}")
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'Profile(wall={self.wall:.6f}, stages={sorted(self.stages)})'
+
+
+@contextmanager
+def profile(callback=None, every=1):
+    """
+    Enable the instrumentation inside a block and report the per-stage breakdown.
+
+    Blocks may be nested or run in threads, each reports the difference
+    of the totals between its start and its end.
+
+    Args:
+        callback (callable, optional): sampling callback active inside the block, see add_callback.
+        every (int, optional): sampling period of the callback. Defaults to 1.
+
+    Yields:
+        Profile: filled when the block exits.
+    """
+    global enabled, _n_profiles
+    result = Profile()
+    before = totals()
+    if callback is not None:
+        add_callback(callback, every)
+    with _lock:
+        _n_profiles += 1
+        enabled = True
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result.wall = time.perf_counter() - start
+        with _lock:
+            _n_profiles -= 1
+            enabled = _explicit or _n_profiles > 0
+        if callback is not None:
+            remove_callback(callback)
+        for name, val in totals().items():
+            prev = before.get(name, {'calls': 0, 'items': 0, 'seconds': 0.0})
+            calls = val['calls'] - prev['calls']
+            if calls == 0:
+                continue
+            seconds = val['seconds'] - prev['seconds']
+            result.stages[name] = {
+                'calls': calls,
+                'items': val['items'] - prev['items'],
+                'seconds': seconds,
+                'fraction': seconds / result.wall if result.wall > 0 else 0.0,
+            }
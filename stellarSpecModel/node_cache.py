@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import OrderedDict
+from . import config
+
+
+class NodeCache:
+    """
+    Byte-budgeted LRU cache of the decoded node spectra of one lazy grid.
+
+    The spectra are keyed by their node index and kept in their stored
+    dtype as read-only arrays. A miss reads the node through the h5py
+    dataset passed to `get`, so every SpecModel opening the same file
+    shares one cache although each holds its own dataset handle.
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+        Args:
+            max_bytes (int, optional): byte budget. Defaults to config.node_cache_bytes.
+        """
+        self.max_bytes = config.node_cache_bytes if max_bytes is None else int(max_bytes)
+        self._spectra = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, node, dataset):
+        """
+        Get the spectrum of a grid node.
+
+        Args:
+            node (tuple): the node index (python ints).
+            dataset (h5py.Dataset): the flux tensor to read from on a miss.
+
+        Returns:
+            numpy.ndarray: the read-only (n_wave,) spectrum.
+        """
+        with self._lock:
+            spectrum = self._spectra.get(node)
+            if spectrum is not None:
+                self._spectra.move_to_end(node)
+                self.hits += 1
+                return spectrum
+            self.misses += 1
+        spectrum = dataset[node]
+        spectrum.flags.writeable = False
+        if spectrum.nbytes > self.max_bytes:
+            return spectrum
+        with self._lock:
+            if node not in self._spectra:
+                self._spectra[node] = spectrum
+                self.nbytes += spectrum.nbytes
+                self._evict()
+        return spectrum
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._spectra:
+            _, spectrum = self._spectra.popitem(last=False)
+            self.nbytes -= spectrum.nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """change the byte budget, evicting the least recently used spectra if needed"""
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+
+    def clear(self):
+        """drop the cached spectra and reset the statistics"""
+        with self._lock:
+            self._spectra.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """hit/miss statistics and the memory held by the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'n_nodes': len(self._spectra),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+# (file path, dataset name): (file signature, NodeCache)
+_caches = {}
+_lock = threading.Lock()
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def get_node_cache(dataset):
+    """
+    Get the node cache shared by every model reading `dataset`'s file.
+
+    The caches are keyed by the real path of the file and the dataset
+    name; a file modified since its cache was created gets a new cache.
+
+    Args:
+        dataset (h5py.Dataset): the lazily read flux tensor.
+
+    Returns:
+        NodeCache or None: None if the cache is disabled (config.node_cache_bytes == 0).
+    """
+    if config.node_cache_bytes <= 0:
+        return None
+    path = os.path.realpath(dataset.file.filename)
+    key = (path, dataset.name)
+    signature = _file_signature(path)
+    with _lock:
+        entry = _caches.get(key)
+        if entry is None or entry[0] != signature:
+            entry = (signature, NodeCache())
+            _caches[key] = entry
+        return entry[1]
+
+
+def set_budget(nbytes):
+    """set the byte budget of every node cache (existing and new ones), 0 disables new caches"""
+    config.node_cache_bytes = int(nbytes)
+    with _lock:
+        caches = [cache for _, cache in _caches.values()]
+    for cache in caches:
+        cache.resize(nbytes)
+
+
+def stats():
+    """the statistics of every node cache, keyed by (file path, dataset name)"""
+    with _lock:
+        entries = list(_caches.items())
+    return {key: cache.stats() for key, (_, cache) in entries}
+
+
+def clear():
+    """drop all the node caches"""
+    with _lock:
+        _caches.clear()
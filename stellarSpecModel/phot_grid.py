@@ -0,0 +1,268 @@
+import os
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from tqdm.auto import tqdm
+from .SpecGrid import SpecGrid
+from .grid_interp import MultilinearInterpolator
+from .phot_util import load_filter
+from .projection import get_band_projector
+from . import reddening
+from . import config
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PhotGrid:
+    """
+    A synthetic-photometry grid: the band fluxes of a stellar spectral model
+    precomputed on its (teff, feh, logg) nodes, optionally with an Av axis.
+
+    The log10 band fluxes are stored as a SpecGrid whose "wavelength" axis
+    is the effective wavelength of each band, and are interpolated with the
+    same multilinear kernel as the spectra. The fluxes are at the stellar
+    surface, like the fluxes returned by StellarSpecModel.get_flux.
+
+    A grid compiled without Av nodes stores a per-node, per-band reddening
+    coefficient k = A_band / Av (at Av = 1) in grid_parameters['red_coeff'],
+    and applies Av as band_flux * 10**(-0.4 * Av * k). This neglects the
+    change of the effective wavelength of a band with the reddening; use
+    Av nodes when this matters (large Av, wide bands).
+
+    The band fluxes are few, they are always interpolated in float64
+    whatever config.precision.
+    """
+
+    def __init__(self, grid: SpecGrid):
+        """
+        :param grid: SpecGrid holding the log10 band fluxes
+        """
+        self.grid = grid
+        # the file the grid was loaded from or cached to, None for a grid only in memory
+        self.filepath = None
+        self.bands = list(json.loads(grid.metadata['bands']))
+        self.Rv = float(grid.metadata['Rv'])
+        self.law = str(grid.metadata.get('law', 'F99'))
+        self.axis_names = grid.axis_names
+        axes = tuple(grid.axes[name] for name in self.axis_names)
+        self._interpolator = MultilinearInterpolator(axes, np.asarray(grid.flux_tensor, dtype=float), dtype=np.float64)
+        if 'red_coeff' in grid.grid_parameters:
+            self._coeff_interpolator = MultilinearInterpolator(
+                axes, np.asarray(grid.grid_parameters['red_coeff'], dtype=float), dtype=np.float64)
+        else:
+            self._coeff_interpolator = None
+        self._coeffs = np.empty(len(self.bands))
+
+    @classmethod
+    def load(cls, filepath):
+        """load a phot grid from a HDF5 file"""
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"Phot grid file not found at {filepath}")
+        phot_grid = cls(SpecGrid.from_hdf5(filepath, lazy=False))
+        phot_grid.filepath = str(filepath)
+        return phot_grid
+
+    @classmethod
+    def compile(cls, specmodel, bands, Av=None, Rv=3.1, law='F99', filters=None,
+                cache_dir=None, overwrite=False, progress=False):
+        """
+        Compile the band fluxes of a spectral model on all its grid nodes.
+
+        The result is cached in the derived-grid cache (config.cache_PATH),
+        a later call with the same model, bands, filters and Av/Rv nodes
+        loads the cached grid. A model is identified by its grid file or,
+        without one, by the content of its grid arrays.
+
+        Args:
+            specmodel (StellarSpecModel): the spectral model.
+            bands (list): pyphot band names, e.g. ['SDSS_g', '2MASS_J'].
+            Av (array-like, optional): Av nodes, None compiles the
+                unreddened fluxes and the per-band reddening coefficients.
+                Defaults to None.
+            Rv (float, optional): Defaults to 3.1.
+            law (str, optional): extinction law, one of reddening.available_laws(). Defaults to 'F99'.
+            filters (dict, optional): {band: [wave_filter, transmit]}, None
+                loads the filters with phot_util.load_filter. Defaults to None.
+            cache_dir (str or pathlib.Path, optional): cache directory. Defaults to config.cache_PATH.
+            overwrite (bool, optional): recompile even if cached. Defaults to False.
+            progress (bool, optional): show a progress bar. Defaults to False.
+
+        Returns:
+            PhotGrid: the compiled phot grid.
+        """
+        bands = list(bands)
+        if filters is None:
+            filters = {band: load_filter(band)[:2] for band in bands}
+        filter_list = [(np.asarray(filters[band][0], dtype=float), np.asarray(filters[band][1], dtype=float))
+                       for band in bands]
+        eff_waves = np.array([np.sum(w * t) / np.sum(t) for w, t in filter_list])
+        Av_nodes = None if Av is None else np.unique(np.asarray(Av, dtype=float))
+
+        if cache_dir is None:
+            active_cache_dir = Path(config.cache_PATH).expanduser()
+        else:
+            active_cache_dir = Path(cache_dir).expanduser()
+        active_cache_dir.mkdir(parents=True, exist_ok=True)
+        grid_name = getattr(specmodel, '_grid_name', None)
+        model_name = type(specmodel).__name__ if grid_name is None else os.path.splitext(os.path.basename(grid_name))[0]
+        cache_hash = cls._generate_cache_key(specmodel, bands, filter_list, Av_nodes, Rv, law)
+        if cache_hash is None:
+            logger.info(f"{model_name} has no grid file nor grid array to fingerprint, the phot grid is not cached")
+            cache_filepath = None
+        else:
+            cache_filepath = active_cache_dir / f"{model_name}_photgrid_{cache_hash}.h5"
+        if cache_filepath is not None and cache_filepath.exists() and not overwrite:
+            logger.info(f"Cache hit! Loading phot grid from {cache_filepath}")
+            return cls.load(cache_filepath)
+
+        axes = {'teff': specmodel.teff_grid, 'feh': specmodel.feh_grid, 'logg': specmodel.logg_grid}
+        if Av_nodes is not None:
+            axes['Av'] = Av_nodes
+        axis_names = list(axes.keys())
+        nodes = np.stack(np.meshgrid(specmodel.teff_grid, specmodel.feh_grid, specmodel.logg_grid,
+                                     indexing='ij'), axis=-1).reshape(-1, 3)
+        waves = specmodel.wavelength
+        projector = get_band_projector(waves, filter_list)
+        curve = reddening.get_curve(waves, Rv, law)
+        n_av = 1 if Av_nodes is None else len(Av_nodes)
+        log_band_fluxes = np.full((len(nodes), n_av, len(bands)), np.nan)
+        red_coeffs = np.full((len(nodes), len(bands)), np.nan)
+        block_size = max(1, int(64 * 1024 ** 2 // (8 * len(waves))))
+        starts = range(0, len(nodes), block_size)
+        if progress:
+            starts = tqdm(starts, desc="Compiling phot grid")
+        for start in starts:
+            stop = min(start + block_size, len(nodes))
+            fluxes, invalid = specmodel.get_flux_batch(nodes[start:stop, 0], nodes[start:stop, 1], nodes[start:stop, 2])
+            valid = np.where(~invalid)[0]
+            if Av_nodes is None:
+                log_fluxes = np.log10(projector.apply(fluxes[valid]))
+                log_band_fluxes[start + valid, 0] = log_fluxes
+                log_reddened = np.log10(projector.apply(fluxes[valid] * 10 ** (-0.4 * curve)))
+                red_coeffs[start + valid] = -2.5 * (log_reddened - log_fluxes)
+                continue
+            for ind_av, av in enumerate(Av_nodes):
+                reddened = fluxes[valid] * 10 ** (-0.4 * av * curve)
+                log_band_fluxes[start + valid, ind_av] = np.log10(projector.apply(reddened))
+        shape = tuple(len(axes[name]) for name in axis_names)
+        flux_tensor = log_band_fluxes.reshape(shape + (len(bands),))
+        grid_parameters = {}
+        if Av_nodes is None:
+            grid_parameters['red_coeff'] = red_coeffs.reshape(shape + (len(bands),))
+
+        metadata = {
+            'model_name': model_name,
+            'is_derived': True,
+            'kind': 'phot_grid',
+            'bands': json.dumps(bands),
+            'Rv': float(Rv),
+            'law': law,
+        }
+        grid = SpecGrid(eff_waves, axes, axis_names, flux_tensor,
+                        valid_mask=np.all(np.isfinite(flux_tensor), axis=-1),
+                        grid_parameters=grid_parameters, metadata=metadata)
+        if cache_filepath is None:
+            return cls(grid)
+        logger.info(f"Caching phot grid to {cache_filepath}")
+        # written under a temporary name, so a concurrent compiler never loads a half-written file
+        tmp_filepath = cache_filepath.with_name(f'{cache_filepath.name}.{os.getpid()}.tmp')
+        grid.to_hdf5(tmp_filepath)
+        os.replace(tmp_filepath, cache_filepath)
+        phot_grid = cls(grid)
+        phot_grid.filepath = str(cache_filepath)
+        return phot_grid
+
+    @staticmethod
+    def _generate_cache_key(specmodel, bands, filter_list, Av_nodes, Rv, law):
+        """the cache key of a compilation, None if the model holds no file and no array to fingerprint"""
+        md5_obj = hashlib.md5()
+        md5_obj.update(type(specmodel).__name__.encode('utf-8'))
+        grid_name = getattr(specmodel, '_grid_name', None)
+        if grid_name is not None and os.path.exists(grid_name):
+            stat = os.stat(grid_name)
+            md5_obj.update(f'{os.path.abspath(grid_name)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+        elif getattr(specmodel, '_spec_grid', None) is not None:
+            md5_obj.update(np.ascontiguousarray(specmodel._spec_grid).tobytes())
+        elif getattr(specmodel, 'emulator', None) is not None:
+            emulator = specmodel.emulator
+            for arr in (emulator.mean, emulator.basis, emulator.grid.flux_tensor, emulator.valid_mask):
+                md5_obj.update(np.ascontiguousarray(arr).tobytes())
+        else:
+            return None
+        md5_obj.update(np.ascontiguousarray(specmodel.wavelength, dtype=float).tobytes())
+        for axis in (specmodel.teff_grid, specmodel.feh_grid, specmodel.logg_grid):
+            md5_obj.update(np.ascontiguousarray(axis, dtype=float).tobytes())
+        md5_obj.update(json.dumps({'bands': bands, 'Rv': float(Rv), 'law': law}, sort_keys=True).encode('utf-8'))
+        for wave_filter, transmit in filter_list:
+            md5_obj.update(wave_filter.tobytes())
+            md5_obj.update(transmit.tobytes())
+        if Av_nodes is not None:
+            md5_obj.update(Av_nodes.tobytes())
+        return md5_obj.hexdigest()
+
+    @property
+    def has_Av(self):
+        """whether the grid has an Av axis"""
+        return 'Av' in self.axis_names
+
+    @property
+    def eff_waves(self):
+        return self.grid.wave
+
+    def get_band_fluxes_batch(self, teff, feh, logg, Av=0.0, out=None):
+        """
+        Interpolate the band fluxes of arrays of stellar parameters.
+
+        Args:
+            teff, feh, logg (array-like): stellar parameters, shape (N,).
+            Av (array-like, optional): extinction, shape (N,). Defaults to 0.0.
+            out (numpy.ndarray, optional): (N, n_band) float array to reuse. Defaults to None.
+
+        Returns:
+            tuple: (band_fluxes, invalid), the (N, n_band) band fluxes at the
+            stellar surface and the (N,) bool array flagging the rows outside
+            of the grid.
+        """
+        columns = np.broadcast_arrays(*[np.atleast_1d(np.asarray(col, dtype=float)) for col in (teff, feh, logg, Av)])
+        if self.has_Av:
+            points = np.column_stack(columns)
+        else:
+            points = np.column_stack(columns[:3])
+        log_fluxes, invalid = self._interpolator.evaluate(points, out=out)
+        Av = columns[3]
+        if not self.has_Av and np.any(Av != 0):
+            if self._coeff_interpolator is None:
+                raise ValueError('The phot grid has neither Av nodes nor reddening coefficients, only Av = 0 is supported')
+            red_coeffs, _ = self._coeff_interpolator.evaluate(points)
+            log_fluxes -= 0.4 * Av[:, None] * red_coeffs
+        return np.power(10.0, log_fluxes, out=log_fluxes), invalid
+
+    def get_band_fluxes(self, teff, feh, logg, Av=0.0, out=None):
+        """
+        Interpolate the band fluxes of one set of stellar parameters.
+
+        The single-point path of the interpolators is used, with `out` the
+        call allocates no arrays (it reuses an internal scratch buffer, so
+        a phot grid should not be queried by several threads at once).
+
+        Args:
+            teff, feh, logg, Av (float): stellar parameters.
+            out (numpy.ndarray, optional): (n_band,) float array receiving the band fluxes. Defaults to None.
+
+        Returns:
+            numpy.ndarray: the (n_band,) band fluxes at the stellar surface.
+        """
+        if self.has_Av:
+            log_fluxes, invalid = self._interpolator.evaluate_one((teff, feh, logg, Av), out=out)
+        else:
+            log_fluxes, invalid = self._interpolator.evaluate_one((teff, feh, logg), out=out)
+        if invalid:
+            raise ValueError(f'(teff, feh, logg, Av) = ({teff}, {feh}, {logg}, {Av}) outside of the phot grid')
+        if not self.has_Av and Av != 0:
+            if self._coeff_interpolator is None:
+                raise ValueError('The phot grid has neither Av nodes nor reddening coefficients, only Av = 0 is supported')
+            red_coeffs, _ = self._coeff_interpolator.evaluate_one((teff, feh, logg), out=self._coeffs)
+            red_coeffs *= -0.4 * Av
+            log_fluxes += red_coeffs
+        return np.power(10.0, log_fluxes, out=log_fluxes)
@@ -32,6 +32,27 @@ def load_local_filter(bandname):
         raise ValueError('filter name {} is not supported'.format(bandname))
 
 
+def load_filter(bandname):
+    """load the transmission curve of a filter from the local filter data or from pyphot
+
+    Args:
+        bandname (str): the pyphot filter name, e.g. 'SDSS_r'
+
+    Returns:
+        tuple: (waves, trans, eff_wave, width), waves, eff_wave and width in units of AA
+    """
+    if bandname in _dic_local_f:
+        return load_local_filter(bandname)
+    tfilter = _lib[bandname]
+    waves = tfilter.wavelength.to('AA').value
+    trans = tfilter.transmit
+    eff_wave = tfilter.leff.to('AA').value
+    width = tfilter.width.to('AA').value
+    if bandname == 'WISE_RSR_W3':
+        eff_wave = 115598.23320737253
+    return waves, trans, eff_wave, width
+
+
 def filtername2pyphotname(filtername):
     """convert a input filter name to pyphot filter name. For example, input 'SDSS:r' or 'SDSSr' will return 'SDSS_r'
 
@@ -0,0 +1,461 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+from . import registry
+from . import shared_grid
+from .stellarSpecModel import StellarSpecModel
+from .SED_model import SEDModel, profile_scale
+from .phot_grid import PhotGrid
+from .phot_util import flux_to_mag, mag_to_flux
+import logging
+logger = logging.getLogger(__name__)
+
+
+MODES = ('fluxes', 'mags', 'fit')
+# default values of the optional parameter columns
+PARAM_DEFAULTS = {'R': 1.0, 'distance': 10.0, 'Av': 0.0}
+
+
+def iter_chunks(path, chunk_size, start_chunk=0, key='/'):
+    """
+    Stream the rows of a catalog in chunks of columns.
+
+    Args:
+        path (str): .csv, .h5/.hdf5 (a group of equal-length 1D datasets,
+            one per column) or .parquet file.
+        chunk_size (int): number of rows per chunk.
+        start_chunk (int, optional): number of leading chunks to skip. Defaults to 0.
+        key (str, optional): group of the columns in a HDF5 file. Defaults to '/'.
+
+    Yields:
+        dict: {column name: numpy.ndarray} of each chunk.
+    """
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext == '.csv':
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError('Reading CSV catalogs needs pandas') from None
+        skiprows = range(1, 1 + start_chunk * chunk_size) if start_chunk else None
+        for frame in pd.read_csv(path, chunksize=chunk_size, skiprows=skiprows):
+            yield {name: frame[name].to_numpy() for name in frame.columns}
+    elif ext in ('.h5', '.hdf5'):
+        with h5py.File(path, 'r') as f:
+            group = f[key]
+            names = [name for name in group if isinstance(group[name], h5py.Dataset)]
+            nrow = len(group[names[0]]) if names else 0
+            for start in range(start_chunk * chunk_size, nrow, chunk_size):
+                yield {name: group[name][start:start + chunk_size] for name in names}
+    elif ext == '.parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading Parquet catalogs needs pyarrow') from None
+        for ind, batch in enumerate(pq.ParquetFile(path).iter_batches(batch_size=chunk_size)):
+            if ind >= start_chunk:
+                yield {name: column.to_numpy(zero_copy_only=False) for name, column in zip(batch.schema.names, batch.columns)}
+    else:
+        raise ValueError(f"Unsupported catalog format '{ext}', use .csv, .h5/.hdf5 or .parquet")
+
+
+class _CSVWriter:
+    def __init__(self, path, offset=None):
+        self.path = path
+        if offset is None:
+            self.file = open(path, 'w')
+        else:
+            self.file = open(path, 'r+')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        self.has_header = offset is not None and offset > 0
+
+    def write(self, columns):
+        names = list(columns)
+        if not self.has_header:
+            self.file.write(','.join(names) + '\n')
+            self.has_header = True
+        np.savetxt(self.file, np.column_stack([columns[name] for name in names]), delimiter=',', fmt='%.10g')
+        self.file.flush()
+
+    def state(self):
+        return {'offset': self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+
+class _HDF5Writer:
+    def __init__(self, path, rows=None):
+        self.file = h5py.File(path, 'w' if rows is None else 'r+')
+        self.rows = rows or 0
+        if rows is not None:
+            for name in self.file:
+                self.file[name].resize((rows,))
+
+    def write(self, columns):
+        nrow = len(next(iter(columns.values())))
+        for name, values in columns.items():
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.asarray(values).dtype,
+                                         chunks=(max(1, min(nrow, 65536)),))
+            dset = self.file[name]
+            dset.resize((self.rows + nrow,))
+            dset[self.rows:] = values
+        self.rows += nrow
+        self.file.flush()
+
+    def state(self):
+        return {'rows': self.rows}
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    """one part file per chunk in the output directory"""
+
+    def __init__(self, path, chunk=None):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('Writing Parquet output needs pyarrow') from None
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.chunk = chunk or 0
+        for name in os.listdir(path):
+            if name.startswith('part-') and int(name[5:11]) >= self.chunk:
+                os.remove(os.path.join(path, name))
+
+    def write(self, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table(columns), os.path.join(self.path, f'part-{self.chunk:06d}.parquet'))
+        self.chunk += 1
+
+    def state(self):
+        return {'chunk': self.chunk}
+
+    def close(self):
+        pass
+
+
+def _open_writer(path, state=None):
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext == '.csv':
+        return _CSVWriter(path, None if state is None else state['offset'])
+    if ext in ('.h5', '.hdf5'):
+        return _HDF5Writer(path, None if state is None else state['rows'])
+    if ext == '.parquet':
+        return _ParquetWriter(path, None if state is None else state['chunk'])
+    raise ValueError(f"Unsupported output format '{ext}', use .csv, .h5/.hdf5 or .parquet")
+
+
+class CatalogWorker:
+    """
+    Evaluate catalog chunks with one SED model.
+
+    Each worker process holds one instance, so the stellar model, the band
+    projection and the fit table are built once per process and shared by
+    all the chunks it processes.
+    """
+
+    def __init__(self, model, bands, mode='fluxes', phot_grid=False, Av_nodes=None, fit_axes=None,
+                 phot_grid_path=None):
+        """
+        Args:
+            model (str or StellarSpecModel): a registry model name (e.g. 'BTCond'), the path of a grid file or a loaded model.
+            bands (list): band names, also used to name the columns.
+            mode (str, optional): one of MODES. Defaults to 'fluxes'.
+            phot_grid (bool, optional): use the fast photometric mode. Defaults to False.
+            Av_nodes (array-like, optional): Av nodes of the phot grid and of the fit. Defaults to None.
+            fit_axes (dict, optional): {'teff', 'feh', 'logg'} nodes of the fit, defaults to the model grid.
+            phot_grid_path (str, optional): file of the phot grid already compiled for
+                these bands and Av nodes, loaded instead of compiling it. Defaults to None.
+        """
+        if mode not in MODES:
+            raise ValueError(f'mode should be one of {MODES}')
+        if isinstance(model, StellarSpecModel):
+            specmodel = model
+        elif os.path.exists(str(model)):
+            specmodel = StellarSpecModel(str(model))
+        else:
+            specmodel = registry.get_model(model)
+        self.bands = list(bands)
+        self.mode = mode
+        self.sed_model = SEDModel(self.bands, specmodel=specmodel)
+        if phot_grid and phot_grid_path is not None:
+            self.sed_model.phot_grid = PhotGrid.load(phot_grid_path)
+        elif phot_grid:
+            self.sed_model.enable_phot_grid(Av=Av_nodes)
+        if mode == 'fit':
+            fit_axes = dict(fit_axes or {})
+            self.fit_axes = self.sed_model.grid_axes(fit_axes.get('teff'), fit_axes.get('feh'),
+                                                     fit_axes.get('logg'), Av_nodes)
+            node_fluxes = self.sed_model.node_band_fluxes(*self.fit_axes.values())
+            self.fit_shape = node_fluxes.shape[:-1]
+            self.node_fluxes = node_fluxes.reshape(-1, len(self.bands))
+
+    def process(self, columns):
+        """evaluate one chunk, {column: array} -> {output column: array}"""
+        if self.mode == 'fit':
+            return self._fit(columns)
+        nrow = len(next(iter(columns.values())))
+        params = []
+        for name in SEDModel.param_names:
+            if name in columns:
+                params.append(np.asarray(columns[name], dtype=float))
+            elif name in PARAM_DEFAULTS:
+                params.append(np.full(nrow, PARAM_DEFAULTS[name]))
+            else:
+                raise ValueError(f"The catalog has no '{name}' column")
+        fluxes, invalid = self.sed_model.get_SED_batch(*params)
+        out = {}
+        for ind, band in enumerate(self.bands):
+            if self.mode == 'fluxes':
+                out[f'flux_{band}'] = fluxes[:, ind]
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    out[f'mag_{band}'] = flux_to_mag(fluxes[:, ind], 0.0, self.sed_model.bands[ind])[0]
+        out['valid'] = (~invalid).astype(np.int8)
+        return out
+
+    def _observed(self, columns, nrow):
+        obs = np.full((nrow, len(self.bands)), np.nan)
+        errs = np.full((nrow, len(self.bands)), np.nan)
+        for ind, band in enumerate(self.bands):
+            pyphot_name = self.sed_model.bands[ind]
+            if f'flux_{band}' in columns:
+                obs[:, ind] = columns[f'flux_{band}']
+                errs[:, ind] = columns[f'fluxerr_{band}']
+            elif f'mag_{band}' in columns:
+                obs[:, ind], errs[:, ind] = mag_to_flux(np.asarray(columns[f'mag_{band}'], dtype=float),
+                                                        np.asarray(columns[f'magerr_{band}'], dtype=float), pyphot_name)
+            else:
+                raise ValueError(f"The catalog has neither 'mag_{band}' nor 'flux_{band}' columns")
+        return obs, errs
+
+    def _fit(self, columns):
+        nrow = len(next(iter(columns.values())))
+        obs, errs = self._observed(columns, nrow)
+        distance = np.asarray(columns.get('distance', np.full(nrow, PARAM_DEFAULTS['distance'])), dtype=float)
+        best = np.zeros(nrow, dtype=np.intp)
+        scale = np.full(nrow, np.nan)
+        chisq = np.full(nrow, np.inf)
+        # keep the (stars, nodes) chi-square block under SEDModel.max_block_bytes
+        block = max(1, int(SEDModel.max_block_bytes // (16 * len(self.node_fluxes))))
+        for start in range(0, nrow, block):
+            stop = min(start + block, nrow)
+            block_scale, block_chisq = profile_scale(obs[start:stop], errs[start:stop], self.node_fluxes)
+            rows = np.arange(stop - start)
+            best[start:stop] = np.argmin(block_chisq, axis=1)
+            chisq[start:stop] = block_chisq[rows, best[start:stop]]
+            scale[start:stop] = block_scale[rows, best[start:stop]]
+        valid = np.isfinite(chisq)
+        out = {}
+        for name, ind in zip(self.fit_axes, np.unravel_index(best, self.fit_shape)):
+            out[name] = np.where(valid, self.fit_axes[name][ind], np.nan)
+        out['R'] = np.sqrt(scale) * distance / self.sed_model._rat_rsun_pc
+        out['chisq'] = chisq
+        out['valid'] = valid.astype(np.int8)
+        return out
+
+
+_worker = None
+
+
+def _init_worker(options, shared_spec=None, phot_grid_path=None):
+    global _worker
+    if shared_spec is not None:
+        options = dict(options, model=shared_grid.attach(shared_spec))
+    _worker = CatalogWorker(**options, phot_grid_path=phot_grid_path)
+
+
+def _run_chunk(index, columns):
+    t0 = time.perf_counter()
+    out = _worker.process(columns)
+    return index, out, time.perf_counter() - t0
+
+
+def _signature(input_path, options, chunk_size):
+    stat = os.stat(input_path)
+    key = json.dumps({'input': os.path.abspath(input_path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                      'chunk_size': chunk_size, 'options': options}, sort_keys=True, default=str)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def _checkpoint_path(output_path):
+    return f'{output_path}.checkpoint.json'
+
+
+def run_catalog(input_path, output_path, bands, mode='fluxes', model='BTCond', chunk_size=100000,
+                workers=1, max_pending=None, phot_grid=False, Av_nodes=None, fit_axes=None,
+                resume=True, key='/', metrics_path=None, progress=False, shared_memory=False):
+    """
+    Compute band fluxes, magnitudes or grid fits for a whole catalog.
+
+    The rows are streamed from the input in chunks, and the chunks are fanned
+    out to worker processes. Each worker holds one model (see
+    CatalogWorker). The results are written incrementally in input order. At
+    most max_pending chunks are read ahead of the writer (back-pressure).
+    After every written chunk a checkpoint records the progress, so a run
+    that is interrupted resumes after the last written chunk.
+
+    Input columns: teff, logg, feh and optionally R, distance and Av for
+    the 'fluxes' and 'mags' modes. The 'fit' mode reads mag_<band> and
+    magerr_<band> (or flux_<band> and fluxerr_<band>) and optionally
+    distance (pc, converting the best scales into radii).
+
+    Output columns: flux_<band> or mag_<band>, or teff, feh, logg, Av, R
+    and chisq of the best node for 'fit'; plus valid (0 for rows outside
+    of the model grid).
+
+    Args:
+        input_path (str): .csv, .h5/.hdf5 or .parquet catalog.
+        output_path (str): .csv, .h5/.hdf5 or .parquet (a directory of part files).
+        bands (list): band names, e.g. ['SDSSg', '2MASSJ'].
+        mode (str, optional): 'fluxes', 'mags' or 'fit'. Defaults to 'fluxes'.
+        model (str, optional): registry model name or grid file. Defaults to 'BTCond'.
+        chunk_size (int, optional): rows per chunk. Defaults to 100000.
+        workers (int, optional): worker processes, 1 runs in the calling process. Defaults to 1.
+        max_pending (int, optional): chunks in flight. Defaults to 2 * workers.
+        phot_grid (bool, optional): use the fast photometric mode. Defaults to False.
+        Av_nodes (array-like, optional): Av nodes of the phot grid and of the fit. Defaults to None.
+        fit_axes (dict, optional): teff/feh/logg nodes of the fit. Defaults to the model grid.
+        resume (bool, optional): resume from a matching checkpoint. Defaults to True.
+        key (str, optional): group of the columns in a HDF5 input. Defaults to '/'.
+        metrics_path (str, optional): append one JSON line of metrics per chunk to this file.
+        progress (bool, optional): log the metrics of every chunk at INFO level, otherwise DEBUG.
+        shared_memory (bool, optional): with workers > 1, load the model once and share its grid
+            with the workers through shared memory (see shared_grid) instead of loading one copy
+            per worker. Defaults to False.
+
+    Returns:
+        dict: 'rows', 'chunks', 'seconds', 'rows_per_s' of this run and
+        'metrics', the per-chunk metrics (rows, compute seconds, rows per second).
+    """
+    options = {'model': str(model), 'bands': list(bands), 'mode': mode, 'phot_grid': bool(phot_grid),
+               'Av_nodes': None if Av_nodes is None else np.asarray(Av_nodes, dtype=float).tolist(),
+               'fit_axes': None if fit_axes is None else {name: np.asarray(val, dtype=float).tolist()
+                                                          for name, val in fit_axes.items()}}
+    signature = _signature(input_path, options, chunk_size)
+    checkpoint_path = _checkpoint_path(output_path)
+    state = None
+    start_chunk = 0
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('signature') == signature:
+            state = checkpoint['writer']
+            start_chunk = checkpoint['chunks']
+            logger.info(f'Resuming {output_path} after chunk {start_chunk}')
+        else:
+            logger.warning(f'The checkpoint of {output_path} belongs to another run, starting over')
+    max_pending = max(1, max_pending or 2 * max(1, workers))
+    log = logger.info if progress else logger.debug
+
+    writer = _open_writer(output_path, state)
+    metrics = []
+    t_start = time.perf_counter()
+    chunks_done = start_chunk
+    pool = None
+    shared = None
+    pending = {}
+
+    def write_next():
+        nonlocal chunks_done
+        item = pending.pop(chunks_done)
+        index, out, seconds = item if pool is None else item.result()
+        writer.write(out)
+        nrow = len(next(iter(out.values())))
+        chunks_done = index + 1
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'signature': signature, 'chunks': chunks_done, 'writer': writer.state()}, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        metric = {'chunk': index, 'rows': nrow, 'seconds': seconds,
+                  'rows_per_s': nrow / seconds if seconds > 0 else None,
+                  'elapsed': time.perf_counter() - t_start}
+        metrics.append(metric)
+        log(f"chunk {index}: {nrow} rows in {seconds:.3f} s ({metric['rows_per_s'] or 0:.0f} rows/s)")
+        if metrics_path is not None:
+            with open(metrics_path, 'a') as f:
+                f.write(json.dumps(metric) + '\n')
+
+    try:
+        if workers > 1:
+            shared_spec = None
+            phot_grid_path = None
+            specmodel = None
+            if shared_memory or phot_grid:
+                model_path = str(model)
+                specmodel = StellarSpecModel(model_path) if os.path.exists(model_path) else registry.get_model(model_path)
+            if shared_memory:
+                shared = shared_grid.publish(specmodel)
+                shared_spec = shared.spec
+            if phot_grid:
+                # compiled once here, the workers only load the cached file
+                phot_grid_path = SEDModel(options['bands'], specmodel=specmodel).enable_phot_grid(Av=Av_nodes).filepath
+            # the workers load their own model
+            specmodel = None
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(options, shared_spec, phot_grid_path))
+        else:
+            _init_worker(options)
+            max_pending = 1
+        for index, columns in enumerate(iter_chunks(input_path, chunk_size, start_chunk, key), start=start_chunk):
+            if pool is None:
+                pending[index] = _run_chunk(index, columns)
+            else:
+                pending[index] = pool.submit(_run_chunk, index, columns)
+            # back-pressure: do not read further ahead than max_pending chunks
+            while len(pending) >= max_pending:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if shared is not None:
+            shared.unlink()
+        writer.close()
+    # no checkpoint is written when the catalog has no chunk
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    seconds = time.perf_counter() - t_start
+    rows = sum(metric['rows'] for metric in metrics)
+    return {'rows': rows, 'chunks': len(metrics), 'seconds': seconds,
+            'rows_per_s': rows / seconds if seconds > 0 else None, 'metrics': metrics}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic photometry and SED grid fits of a catalog.')
+    parser.add_argument('input', help='.csv, .h5/.hdf5 or .parquet catalog')
+    parser.add_argument('output', help='.csv, .h5/.hdf5 or .parquet output')
+    parser.add_argument('--bands', nargs='+', required=True, help='band names, e.g. SDSSg 2MASSJ')
+    parser.add_argument('--mode', default='fluxes', choices=MODES)
+    parser.add_argument('--model', default='BTCond', help='registry model name or grid file')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-pending', type=int, default=None)
+    parser.add_argument('--phot-grid', action='store_true', help='use the fast photometric mode')
+    parser.add_argument('--av-nodes', type=float, nargs='+', default=None)
+    parser.add_argument('--no-resume', action='store_true')
+    parser.add_argument('--key', default='/', help='group of the columns in a HDF5 input')
+    parser.add_argument('--metrics', default=None, help='append the per-chunk metrics (JSON lines) to this file')
+    parser.add_argument('--shared-memory', action='store_true', help='share one copy of the grid with the workers')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    summary = run_catalog(args.input, args.output, args.bands, mode=args.mode, model=args.model,
+                          chunk_size=args.chunk_size, workers=args.workers, max_pending=args.max_pending,
+                          phot_grid=args.phot_grid, Av_nodes=args.av_nodes, resume=not args.no_resume,
+                          key=args.key, metrics_path=args.metrics, progress=True, shared_memory=args.shared_memory)
+    print(f"{summary['rows']} rows in {summary['chunks']} chunks, {summary['seconds']:.1f} s "
+          f"({summary['rows_per_s'] or 0:.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
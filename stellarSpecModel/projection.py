@@ -0,0 +1,199 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sparse
+from . import instrument
+
+
+def _bin_edges(wave):
+    """pixel edges at the midpoints between the pixel centers, the outer edges mirrored"""
+    wave = np.asarray(wave, dtype=float)
+    if len(wave) == 1:
+        return np.array([wave[0] - 0.5, wave[0] + 0.5])
+    mids = 0.5 * (wave[1:] + wave[:-1])
+    return np.concatenate(([2 * wave[0] - mids[0]], mids, [2 * wave[-1] - mids[-1]]))
+
+
+def rebin_matrix(wave, new_wave):
+    """
+    Build the flux-conserving rebin operator from `wave` to `new_wave`.
+
+    Each pixel is a bin whose edges are the midpoints between neighbouring
+    pixel centers. The flux density of a new bin is the overlap-weighted
+    mean of the old flux densities over the bin, the part of the bin beyond
+    the edges of the old pixels counting as zero flux. As with
+    pyrebin.rebin_padvalue, the new pixels centered outside of
+    [wave[0], wave[-1]] are padded with zero: their rows are empty.
+
+    Args:
+        wave (numpy.ndarray): ascending wavelength of the input spectra, shape (n,).
+        new_wave (numpy.ndarray): ascending target wavelength, shape (m,).
+
+    Returns:
+        scipy.sparse.csr_matrix: (m, n) matrix R, the rebinned spectrum is R @ flux.
+    """
+    wave = np.asarray(wave, dtype=float)
+    new_wave = np.asarray(new_wave, dtype=float)
+    edges = _bin_edges(wave)
+    new_edges = _bin_edges(new_wave)
+    n, m = len(edges) - 1, len(new_edges) - 1
+    lows = np.maximum(new_edges[:-1], edges[0])
+    highs = np.minimum(new_edges[1:], edges[-1])
+    inside = (highs > lows) & (new_wave >= wave[0]) & (new_wave <= wave[-1])
+    first = np.clip(np.searchsorted(edges, lows, side='right') - 1, 0, n - 1)
+    last = np.clip(np.searchsorted(edges, highs, side='left') - 1, 0, n - 1)
+    counts = np.where(inside, last - first + 1, 0)
+    rows = np.repeat(np.arange(m), counts)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = np.repeat(first, counts) + offsets
+    overlap = np.minimum(edges[cols + 1], highs[rows]) - np.maximum(edges[cols], lows[rows])
+    values = overlap / np.diff(new_edges)[rows]
+    return sparse.csr_matrix((values, (rows, cols)), shape=(m, n))
+
+
+class BandProjector:
+    """
+    Linear projection of model spectra onto a list of photometric bands.
+
+    The rebinning of the spectrum onto each filter wavelength grid and the
+    transmission-weighted integration are folded into one sparse
+    (n_band, n_wave) matrix, so the band fluxes of a stack of spectra are
+    one sparse mat-mat. A single spectrum goes through the dense weights of
+    each band over the wavelength span of its filter: one dot product per
+    band, written into `out` without allocating arrays.
+
+    float32 spectra (see config.precision) are projected with float32
+    copies of the weights, made on first use, so they are never upcast.
+    """
+
+    def __init__(self, wave, filters):
+        """
+        Args:
+            wave (numpy.ndarray): wavelength of the model spectra, shape (n_wave,).
+            filters (list): [(wave_filter, transmit), ...] of each band.
+        """
+        self.wave = np.asarray(wave, dtype=float)
+        rows = []
+        for wave_filter, transmit in filters:
+            wave_filter = np.asarray(wave_filter, dtype=float)
+            transmit = np.asarray(transmit, dtype=float)
+            widths = np.diff(wave_filter)
+            widths = np.append(widths, widths[-1])
+            weights = transmit * widths / np.sum(transmit * widths)
+            rows.append(sparse.csr_matrix(weights) @ rebin_matrix(self.wave, wave_filter))
+        if rows:
+            self.matrix = sparse.vstack(rows).tocsr()
+        else:
+            self.matrix = sparse.csr_matrix((0, len(self.wave)))
+        # per band: (first column, last column + 1, dense weights of the columns in between)
+        self._spans = []
+        for ind in range(self.n_band):
+            start, stop = self.matrix.indptr[ind], self.matrix.indptr[ind + 1]
+            cols = self.matrix.indices[start:stop]
+            if len(cols) == 0:
+                self._spans.append((0, 0, np.empty(0)))
+                continue
+            first = int(cols.min())
+            weights = np.zeros(int(cols.max()) + 1 - first)
+            np.add.at(weights, cols - first, self.matrix.data[start:stop])
+            self._spans.append((first, first + len(weights), weights))
+        self._operators = {np.dtype(np.float64): (self.matrix, self._spans)}
+
+    @property
+    def n_band(self):
+        return self.matrix.shape[0]
+
+    def operators(self, dtype):
+        """the (matrix, spans) pair used for spectra of dtype, float32 or float64"""
+        dtype = np.dtype(np.float32 if dtype == np.float32 else np.float64)
+        operators = self._operators.get(dtype)
+        if operators is None:
+            spans = [(first, stop, weights.astype(dtype)) for first, stop, weights in self._spans]
+            operators = (self.matrix.astype(dtype), spans)
+            self._operators[dtype] = operators
+        return operators
+
+    def apply(self, spectra, out=None):
+        """
+        Get the band fluxes of one spectrum or of a stack of spectra.
+
+        Args:
+            spectra (numpy.ndarray): fluxes, shape (n_wave,) or (N, n_wave).
+            out (numpy.ndarray, optional): float array of shape (n_band,) or
+                (N, n_band) receiving the band fluxes. Defaults to None.
+
+        Returns:
+            numpy.ndarray: band fluxes, shape (n_band,) or (N, n_band), of
+            the dtype of the spectra when out is None.
+        """
+        spectra = np.asarray(spectra)
+        matrix, spans = self.operators(spectra.dtype)
+        if spectra.ndim == 1:
+            with instrument.stage('project'):
+                if out is None:
+                    out = np.empty(self.n_band, dtype=matrix.dtype)
+                for ind, (first, stop, weights) in enumerate(spans):
+                    out[ind] = np.dot(weights, spectra[first:stop])
+                return out
+        with instrument.stage('project', len(spectra)):
+            if out is None:
+                return (matrix @ spectra.T).T
+            out[...] = (matrix @ spectra.T).T
+            return out
+
+
+_projectors = OrderedDict()
+_lock = threading.Lock()
+max_cached_projectors = 32
+
+
+def _projector_key(wave, filters):
+    md5_obj = hashlib.md5(np.ascontiguousarray(wave, dtype=float).tobytes())
+    for wave_filter, transmit in filters:
+        md5_obj.update(np.ascontiguousarray(wave_filter, dtype=float).tobytes())
+        md5_obj.update(np.ascontiguousarray(transmit, dtype=float).tobytes())
+    return md5_obj.hexdigest()
+
+
+def get_band_projector(wave, filters):
+    """
+    Get the BandProjector of a (model wavelength grid, band set) pair.
+
+    The projectors are cached by the content of the wavelength grid and
+    of the filter curves, so every model evaluating the same bands on the
+    same grid shares one matrix.
+
+    Args:
+        wave (numpy.ndarray): wavelength of the model spectra.
+        filters (list): [(wave_filter, transmit), ...] of each band.
+
+    Returns:
+        BandProjector: the cached projector.
+    """
+    key = _projector_key(wave, filters)
+    with _lock:
+        if key in _projectors:
+            _projectors.move_to_end(key)
+            return _projectors[key]
+    projector = BandProjector(wave, filters)
+    with _lock:
+        _projectors[key] = projector
+        while len(_projectors) > max_cached_projectors:
+            _projectors.popitem(last=False)
+    return projector
+
+
+def integrate_bands(waves, spectra, filters):
+    """
+    Integrate spectra over the transmission curves of a list of filters.
+
+    Args:
+        waves (numpy.ndarray): wavelength of the spectra, shape (n_wave,).
+        spectra (numpy.ndarray): fluxes, shape (n_wave,) or (N, n_wave).
+        filters (list): [(wave_filter, transmit), ...] of each band.
+
+    Returns:
+        numpy.ndarray: the band fluxes, shape (n_band,) or (N, n_band).
+    """
+    return get_band_projector(waves, filters).apply(spectra)
@@ -0,0 +1,125 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from . import instrument
+from extinction import fitzpatrick99, ccm89, odonnell94
+
+
+# law name: function(wave, a_v, r_v) returning A_lambda in magnitudes, wave in AA
+_laws = {
+    'F99': fitzpatrick99,
+    'CCM89': ccm89,
+    'O94': odonnell94,
+}
+
+_curves = OrderedDict()
+_curves_by_id = {}
+_lock = threading.Lock()
+max_cached_curves = 64
+
+
+def register_law(name, func, overwrite=False):
+    """
+    Register an extinction law.
+
+    Args:
+        name (str): name of the law.
+        func (callable): func(wave, a_v, r_v) returning A_lambda (mag) for
+            wavelengths in AA. It must be linear in a_v.
+        overwrite (bool, optional): replace an existing law. Defaults to False.
+    """
+    with _lock:
+        if name in _laws and not overwrite:
+            raise ValueError(f"Extinction law '{name}' is already registered. Pass overwrite=True to overwrite.")
+        _laws[name] = func
+        for key in [key for key in _curves if key[1] == name]:
+            del _curves[key]
+        _curves_by_id.clear()
+
+
+def available_laws():
+    return list(_laws.keys())
+
+
+def get_curve(wave, Rv=3.1, law='F99', dtype=None):
+    """
+    Get the extinction curve shape A_lambda / Av of a wavelength grid.
+
+    The curve is computed in float64 once per (wavelength grid, Rv, law,
+    dtype) and cached, the returned array is read-only.
+
+    Args:
+        wave (numpy.ndarray): wavelength in AA.
+        Rv (float, optional): total-to-selective extinction ratio. Defaults to 3.1.
+        law (str, optional): one of available_laws(). Defaults to 'F99'.
+        dtype (numpy.dtype, optional): dtype of the curve, e.g. float32 to
+            redden float32 spectra. Defaults to float64.
+
+    Returns:
+        numpy.ndarray: A_lambda / Av, same shape as wave.
+    """
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    id_key = (id(wave), float(Rv), law, dtype.str)
+    with _lock:
+        hit = _curves_by_id.get(id_key)
+        if hit is not None and hit[0]() is wave:
+            return hit[1]
+    if law not in _laws:
+        raise ValueError(f'law should be one of {list(_laws.keys())}')
+    wave_arr = np.ascontiguousarray(wave, dtype=float)
+    key = (hashlib.md5(wave_arr.tobytes()).hexdigest(), law, float(Rv), dtype.str)
+    with _lock:
+        curve = _curves.get(key)
+    if curve is None:
+        with instrument.stage('extinction_curve'):
+            curve = np.asarray(_laws[law](wave_arr, 1.0, float(Rv)), dtype=float).astype(dtype, copy=False)
+        curve.flags.writeable = False
+    with _lock:
+        _curves[key] = curve
+        _curves.move_to_end(key)
+        while len(_curves) > max_cached_curves:
+            _curves.popitem(last=False)
+        try:
+            ref = weakref.ref(wave)
+        except TypeError:
+            ref = None
+        if ref is not None:
+            if len(_curves_by_id) > 4 * max_cached_curves:
+                _curves_by_id.clear()
+            _curves_by_id[id_key] = (ref, curve)
+    return curve
+
+
+def redden(wave, flux, Av, Rv=3.1, law='F99', out=None):
+    """
+    Apply the extinction Av to one spectrum or to a stack of spectra.
+
+    Args:
+        wave (numpy.ndarray): wavelength in AA, shape (n_wave,).
+        flux (numpy.ndarray): fluxes, shape (n_wave,) or (N, n_wave).
+        Av (float or array-like): extinction, a scalar or one value per spectrum (N,).
+        Rv (float, optional): Defaults to 3.1.
+        law (str, optional): Defaults to 'F99'.
+        out (numpy.ndarray, optional): output array, may be flux itself. Defaults to None.
+
+    Returns:
+        numpy.ndarray: the reddened fluxes, computed in the dtype of out
+        (by default float32 for float32 fluxes, float64 otherwise).
+    """
+    Av = np.asarray(Av, dtype=float)
+    if out is None:
+        flux = np.asarray(flux)
+        out = np.array(flux, dtype=np.float32 if flux.dtype == np.float32 else np.float64)
+    elif out is not flux:
+        out[...] = flux
+    if Av.ndim == 0 and Av == 0:
+        return out
+    with instrument.stage('extinction', 1 if out.ndim == 1 else len(out)):
+        curve = get_curve(wave, Rv, law, dtype=out.dtype)
+        if Av.ndim == 0:
+            out *= 10 ** (-0.4 * float(Av) * curve)
+        else:
+            out *= 10 ** (-0.4 * Av.astype(out.dtype)[:, None] * curve)
+    return out
@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from . import config
+from . import stellarSpecModel
+from .grid_interp import MultilinearInterpolator
+from .emulator import PCAEmulator
+from .tlusty import TlustyModel
+from .tlustyWD import TlustyWDModel
+import logging
+logger = logging.getLogger(__name__)
+
+
+_factories = {
+    'MARCS': stellarSpecModel.MARCS_Model,
+    'MARCS_hiRes': stellarSpecModel.MARCS_Model_hiRes,
+    'BTCond': stellarSpecModel.BTCond_Model,
+    'BTCond_hiRes': stellarSpecModel.BTCond_Model_hiRes,
+    'BTCond_R7500': stellarSpecModel.BTCond_Model_R7500,
+    'BTCond_R1800': stellarSpecModel.BTCond_Model_R1800,
+    'BTCond_R500': stellarSpecModel.BTCond_Model_R500,
+    'BTCond_R100': stellarSpecModel.BTCond_Model_R100,
+    'TLUSTY': TlustyModel,
+    'TLUSTYWD': TlustyWDModel,
+}
+
+# model_name: [model, nbytes], ordered from the least to the most recently used
+_models = OrderedDict()
+_lock = threading.Lock()
+_build_locks = {}
+_memory_budget = config.model_memory_budget
+
+
+def register_model(model_name, factory, overwrite=False):
+    """register a factory (a class or a callable without arguments) building the model `model_name`"""
+    with _lock:
+        if model_name in _factories and not overwrite:
+            raise ValueError(f"Model '{model_name}' is already registered. Pass overwrite=True to overwrite.")
+        _factories[model_name] = factory
+        _models.pop(model_name, None)
+
+
+def available_models():
+    """return the names of the registered models"""
+    return list(_factories.keys())
+
+
+def set_memory_budget(nbytes):
+    """set the memory budget (in bytes) of the loaded models, None or 0 means no limit"""
+    global _memory_budget
+    with _lock:
+        _memory_budget = int(nbytes) if nbytes else None
+        _evict()
+
+
+def get_memory_budget():
+    return _memory_budget
+
+
+def get_model(model_name):
+    """
+    Get the shared instance of a registered model, building it on first use.
+
+    Args:
+        model_name (str): name of the model, one of available_models(),
+            e.g. 'BTCond' or 'BTCond_R100'.
+
+    Returns:
+        StellarSpecModel: the model instance shared by all callers.
+    """
+    with _lock:
+        if model_name not in _factories:
+            raise ValueError(f'model_name should be one of {list(_factories.keys())}')
+        if model_name in _models:
+            _models.move_to_end(model_name)
+            return _models[model_name][0]
+        build_lock = _build_locks.setdefault(model_name, threading.Lock())
+    # build outside of the global lock, so that loading a large grid does not block other models
+    with build_lock:
+        with _lock:
+            if model_name in _models:
+                _models.move_to_end(model_name)
+                return _models[model_name][0]
+            factory = _factories[model_name]
+        logger.info(f'Loading model {model_name}')
+        model = factory()
+        nbytes = model_nbytes(model)
+        with _lock:
+            _models[model_name] = [model, nbytes]
+            _evict(keep=model_name)
+    return model
+
+
+def loaded_models():
+    """return a dict {model_name: nbytes} of the models held by the registry, least recently used first"""
+    with _lock:
+        return {name: nbytes for name, (model, nbytes) in _models.items()}
+
+
+def clear():
+    """drop every model held by the registry"""
+    with _lock:
+        _models.clear()
+
+
+def _evict(keep=None):
+    if not _memory_budget:
+        return
+    total = sum(nbytes for model, nbytes in _models.values())
+    for name in list(_models.keys()):
+        if total <= _memory_budget:
+            break
+        if name == keep:
+            continue
+        model, nbytes = _models.pop(name)
+        total -= nbytes
+        logger.info(f'Evicting model {name} ({nbytes} bytes) from the model registry')
+
+
+def model_nbytes(model):
+    """estimate the heap memory held by the arrays of a model"""
+    seen = set()
+
+    def _count(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        if isinstance(obj, np.memmap):
+            return 0
+        if isinstance(obj, np.ndarray):
+            return obj.nbytes
+        if isinstance(obj, MultilinearInterpolator):
+            return _count(obj.values)
+        if isinstance(obj, PCAEmulator):
+            return obj.nbytes
+        if isinstance(obj, (list, tuple)):
+            return sum(_count(item) for item in obj)
+        if isinstance(obj, dict):
+            return sum(_count(item) for item in obj.values())
+        return 0
+
+    return sum(_count(value) for value in vars(model).values())
@@ -0,0 +1,274 @@
+"""
+Host the arrays of a loaded grid in shared memory for worker processes.
+
+The parent process publishes a StellarSpecModel (or a SpecModel on an
+in-memory SpecGrid) with publish(model): the wavelength, the axes and the
+log-flux tensor are copied once into a multiprocessing.shared_memory
+block. The picklable `spec` of the returned SharedGrid is passed to the
+workers (e.g. in the initargs of a pool), which call attach(spec) and get
+a model whose arrays are read-only views of the block.
+
+Lifecycle:
+    - the workers are expected to be child processes of the publisher;
+    - the publisher owns the block and unlinks it with SharedGrid.unlink
+      (or at the end of a `with` block), at the latest when it exits;
+    - every process keeps one mapping per block whatever the number of
+      attached models, reference counted and closed when the last
+      attached model is detached or garbage collected.
+
+If shared memory is not available (no /dev/shm, no space left, ...)
+publish falls back to the grid file, memory-mapped by the workers (shared
+through the page cache), or to a copy of the arrays in the spec.
+"""
+import os
+import sys
+import atexit
+import threading
+import weakref
+import numpy as np
+from .stellarSpecModel import StellarSpecModel
+from .SpecModel import SpecModel
+from .SpecGrid import SpecGrid
+from .emulator import PCASpecModel, PCAStellarSpecModel
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+# alignment of the arrays in the shared block, in bytes
+ALIGNMENT = 64
+
+# shm name: SharedGrid published by this process
+_published = {}
+# shm name: [SharedMemory, number of attached models] in this process
+_attached = {}
+_lock = threading.Lock()
+
+
+def _model_arrays(model):
+    """the arrays of a model and the spec needed to rebuild it"""
+    if isinstance(model, (PCASpecModel, PCAStellarSpecModel)):
+        raise ValueError('cannot publish a compressed model, it is small enough to be passed to the workers')
+    if isinstance(model, StellarSpecModel):
+        if not hasattr(model, '_spec_grid'):
+            raise ValueError(f'cannot publish a {type(model).__name__}, it has no single (teff, feh, logg) grid')
+        arrays = {'wave': model.wavelength, 'teff': model.teff_grid, 'feh': model.feh_grid,
+                  'logg': model.logg_grid, 'spec_grid': model._spec_grid}
+        spec = {'kind': 'StellarSpecModel', 'grid_name': model._grid_name}
+    elif isinstance(model, SpecModel):
+        grid = model.grid
+        if not isinstance(grid.flux_tensor, np.ndarray):
+            raise ValueError('publish needs an in-memory SpecGrid, a lazy grid is already shared through the page cache')
+        arrays = {'wave': grid.wave, 'flux_tensor': grid.flux_tensor, 'valid_mask': grid.valid_mask}
+        for name in grid.axis_names:
+            arrays[f'axis:{name}'] = np.asarray(grid.axes[name])
+        spec = {'kind': 'SpecModel', 'axis_names': list(grid.axis_names), 'metadata': dict(grid.metadata),
+                'grid_parameters': dict(grid.grid_parameters)}
+    else:
+        raise ValueError(f'cannot publish a {type(model).__name__}, only StellarSpecModel and SpecModel')
+    return {key: np.ascontiguousarray(val) for key, val in arrays.items()}, spec
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedGrid:
+    """
+    Handle of a grid published in shared memory by this process.
+
+    Attributes:
+        spec (dict): picklable description of the grid, the argument of attach.
+        nbytes (int): size of the shared block, 0 in the fallback modes.
+    """
+
+    def __init__(self, spec, shm=None):
+        self.spec = spec
+        self._shm = shm
+        self.nbytes = 0 if shm is None else shm.size
+        self._pid = os.getpid()
+        if shm is not None:
+            with _lock:
+                _published[shm.name] = self
+
+    @property
+    def name(self):
+        """the name of the shared memory block, None in the fallback modes"""
+        return self.spec.get('shm_name')
+
+    @property
+    def is_shared(self):
+        return self._shm is not None
+
+    def unlink(self):
+        """release the block, the processes still attached keep their mapping until they detach"""
+        shm = self._shm
+        if shm is None or os.getpid() != self._pid:
+            return
+        self._shm = None
+        with _lock:
+            _published.pop(shm.name, None)
+        try:
+            shm.close()
+        except BufferError:
+            logger.debug(f'{shm.name} is still referenced in the publishing process')
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+        return False
+
+    def __repr__(self):
+        mode = f"shm '{self.name}', {self.nbytes} bytes" if self.is_shared else self.spec['fallback']
+        return f"SharedGrid({self.spec['kind']}, {mode})"
+
+
+def publish(model, name=None):
+    """
+    Copy the arrays of a loaded model into a shared memory block.
+
+    Args:
+        model (StellarSpecModel or SpecModel): the model, a SpecModel must
+            hold an in-memory grid.
+        name (str, optional): name of the block. Defaults to a random name.
+
+    Returns:
+        SharedGrid: the handle, pass handle.spec to attach.
+
+    Raises:
+        ValueError: for a model without a single in-memory grid (a lazy
+            SpecModel, TlustyModel, TlustyWDModel) or a compressed model.
+    """
+    arrays, spec = _model_arrays(model)
+    layout = []
+    offset = 0
+    for key, arr in arrays.items():
+        layout.append((key, arr.dtype.str, arr.shape, offset))
+        offset = _align(offset + arr.nbytes)
+    try:
+        if shared_memory is None:
+            raise OSError('multiprocessing.shared_memory is not available')
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(offset, 1))
+    except OSError as exc:
+        return _fallback(spec, arrays, exc)
+    for (key, dtype, shape, start), arr in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = arr
+    spec.update({'shm_name': shm.name, 'layout': layout})
+    logger.info(f"Published {spec['kind']} in shared memory '{shm.name}' ({shm.size} bytes)")
+    return SharedGrid(spec, shm)
+
+
+def _fallback(spec, arrays, exc):
+    grid_name = spec.get('grid_name')
+    if spec['kind'] == 'StellarSpecModel' and grid_name is not None and os.path.isfile(grid_name):
+        logger.warning(f'Shared memory is not available ({exc}), the workers will memory-map {grid_name}')
+        spec.update({'shm_name': None, 'fallback': 'mmap'})
+    else:
+        logger.warning(f'Shared memory is not available ({exc}), the workers will get a copy of the grid')
+        spec.update({'shm_name': None, 'fallback': 'copy', 'arrays': arrays})
+    return SharedGrid(spec)
+
+
+def _open(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching registers the block again in the resource
+    # tracker, which child processes share with the publisher, so the
+    # block stays owned by the publisher
+    return shared_memory.SharedMemory(name=name)
+
+
+def _build(spec, arrays):
+    if spec['kind'] == 'StellarSpecModel':
+        return StellarSpecModel.from_arrays(arrays['wave'], arrays['teff'], arrays['feh'], arrays['logg'],
+                                            arrays['spec_grid'], grid_name=spec.get('grid_name'))
+    axes = {name: arrays[f'axis:{name}'] for name in spec['axis_names']}
+    grid = SpecGrid(arrays['wave'], axes, spec['axis_names'], arrays['flux_tensor'],
+                    valid_mask=arrays['valid_mask'], grid_parameters=dict(spec['grid_parameters']),
+                    metadata=dict(spec['metadata']))
+    return SpecModel(grid)
+
+
+def attach(spec):
+    """
+    Get a model on a grid published by publish, without copying its arrays.
+
+    Args:
+        spec (dict): the SharedGrid.spec of the publisher.
+
+    Returns:
+        StellarSpecModel or SpecModel: the model, its arrays are read-only.
+    """
+    name = spec.get('shm_name')
+    if name is None:
+        if spec['fallback'] == 'mmap':
+            return StellarSpecModel(spec['grid_name'], mmap=True)
+        return _build(spec, spec['arrays'])
+    with _lock:
+        entry = _attached.get(name)
+        if entry is None:
+            entry = _attached[name] = [_open(name), 0]
+        entry[1] += 1
+    shm = entry[0]
+    arrays = {}
+    for key, dtype, shape, offset in spec['layout']:
+        arr = np.ndarray(tuple(shape), dtype=dtype, buffer=shm.buf, offset=offset)
+        arr.flags.writeable = False
+        arrays[key] = arr
+    del arr
+    model = _build(spec, arrays)
+    del arrays
+    model._shared = name
+    model._shared_release = weakref.finalize(model, _release, name)
+    return model
+
+
+def _release(name):
+    with _lock:
+        entry = _attached.get(name)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _attached[name]
+    try:
+        entry[0].close()
+    except BufferError:
+        logger.debug(f'{name} is still referenced, its mapping is closed when the process exits')
+
+
+def detach(model):
+    """
+    Release a model returned by attach, the model cannot be used afterwards.
+
+    The mapping of the block is closed with the last attached model of the
+    process. Dropping every reference to a model has the same effect.
+    """
+    release = getattr(model, '_shared_release', None)
+    if release is None:
+        return
+    model.__dict__.clear()
+    release()
+
+
+def attached_blocks():
+    """{shm name: number of attached models} of this process"""
+    with _lock:
+        return {name: entry[1] for name, entry in _attached.items()}
+
+
+@atexit.register
+def _unlink_all():
+    for handle in list(_published.values()):
+        handle.unlink()
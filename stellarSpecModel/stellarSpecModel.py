@@ -1,8 +1,13 @@
 from . import config
 import os
-import scipy.interpolate as spinterp
+import numpy as np
 from astropy import units as u
 import h5py
+from .grid_interp import MultilinearInterpolator
+from .grid_io import map_dataset, mapped_resident_bytes
+from . import instrument
+import logging
+logger = logging.getLogger(__name__)
 
 
 class StellarSpecModel:
@@ -15,12 +20,24 @@ class StellarSpecModel:
         None
     """
 
-    def __init__(self, grid_name):
+    def __init__(self, grid_name, mmap=False, dtype='precision'):
         """
         Initialize the StellarSpecModel.
 
         Args:
             grid_name (str): Name of the spectral grid.
+            mmap (bool, optional): memory-map the log-flux grid instead of
+                reading it into RAM. The pages are loaded on demand and
+                shared between processes through the page cache. A
+                contiguous dataset is mapped from the HDF5 file directly,
+                other layouts are exported once to a .npy file in
+                config.cache_PATH. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of
+                the log-flux grid in RAM, None keeps the stored dtype (e.g.
+                float32), 'precision' follows config.precision. Ignored
+                with mmap=True, which always keeps the stored dtype. The
+                fluxes are computed in config.precision whatever the
+                dtype of the grid. Defaults to 'precision'.
 
         Returns:
             StellarSpecModel: An instance of the StellarSpecModel class.
@@ -32,17 +49,54 @@ class StellarSpecModel:
         teff_grid = grid['teff'].astype(float)[:]
         feh_grid = grid['feh'].astype(float)[:]
         logg_grid = grid['logg'].astype(float)[:]
-        spec_grid = grid['spec_grid'].astype(float)[:]
+        if dtype == 'precision':
+            dtype = config.get_dtype()
+        if not mmap and dtype is None:
+            spec_grid = grid['spec_grid'][:]
+        elif not mmap:
+            spec_grid = grid['spec_grid'].astype(dtype)[:]
         grids.close()
+        if mmap:
+            spec_grid = map_dataset(self._grid_name, 'default/spec_grid')
+            logger.info(f'Memory-mapped {self._grid_name}: {spec_grid.nbytes} bytes of {spec_grid.dtype}')
+        self._set_grid(wave, teff_grid, feh_grid, logg_grid, spec_grid)
+
+    @classmethod
+    def from_arrays(cls, wave, teff_grid, feh_grid, logg_grid, spec_grid, grid_name=None):
+        """
+        Build a model around grid arrays already in memory, without copying them.
+
+        Args:
+            wave (numpy.ndarray): wavelength in AA, shape (n_wave,).
+            teff_grid, feh_grid, logg_grid (numpy.ndarray): the grid axes.
+            spec_grid (numpy.ndarray): log10 fluxes, shape (n_teff, n_feh, n_logg, n_wave).
+            grid_name (str, optional): name or path of the grid, for display. Defaults to None.
+
+        Returns:
+            StellarSpecModel: the model.
+        """
+        model = cls.__new__(cls)
+        model._grid_name = grid_name
+        model._set_grid(wave, teff_grid, feh_grid, logg_grid, spec_grid)
+        return model
+
+    def _set_grid(self, wave, teff_grid, feh_grid, logg_grid, spec_grid):
         self._wavelength = wave
         self._teff_grid = teff_grid
         self._feh_grid = feh_grid
         self._logg_grid = logg_grid
         self._spec_grid = spec_grid
-        self._model = spinterp.RegularGridInterpolator((teff_grid, feh_grid, logg_grid), spec_grid)
+        self._shared = None
+        self._interpolator = MultilinearInterpolator((teff_grid, feh_grid, logg_grid), spec_grid,
+                                                     dtype=config.get_dtype())
         self._flux_units = u.erg / u.s / u.cm ** 2 / u.AA
         self._wavelength_units = u.AA
 
+    @property
+    def dtype(self):
+        """Get the dtype of the returned fluxes (config.precision when the model was built)."""
+        return self._interpolator.dtype
+
     @property
     def wavelength(self):
         """Get the wavelength array."""
@@ -93,7 +147,7 @@ class StellarSpecModel:
         """Get the maximum logg in the grid."""
         return self._logg_grid.max()
 
-    def get_flux(self, teff, feh, logg):
+    def get_flux(self, teff, feh, logg, out=None):
         """
         Get the flux for a given set of Teff, FeH, and logg values.
 
@@ -101,6 +155,8 @@ class StellarSpecModel:
             teff (float): Effective temperature (Teff).
             feh (float): Metallicity (FeH).
             logg (float): Surface gravity (logg).
+            out (numpy.ndarray, optional): float array of shape (n_wave,)
+                receiving the flux, the call then allocates no arrays. Defaults to None.
 
         Returns:
             numpy.ndarray: Flux array.
@@ -111,8 +167,73 @@ class StellarSpecModel:
             raise ValueError('FeH = {} outside of grid range'.format(feh))
         if logg < self.min_logg or logg > self.max_logg:
             raise ValueError('logg = {} outside of grid range'.format(logg))
-        log_flux = self._model((teff, feh, logg))
-        return 10.0 ** log_flux
+        with instrument.stage('interpolate'):
+            log_flux, invalid = self._interpolator.evaluate_one((teff, feh, logg), out=out)
+        with instrument.stage('exp10'):
+            return np.power(10.0, log_flux, out=log_flux)
+
+    def get_flux_batch(self, teff, feh, logg, out=None):
+        """
+        Get the fluxes for arrays of Teff, FeH, and logg values.
+
+        Unlike get_flux, parameters outside of the grid do not raise an
+        exception, the corresponding rows are filled with NaN and flagged
+        in the returned mask.
+
+        Args:
+            teff (array-like): Effective temperatures (Teff), shape (N,).
+            feh (array-like): Metallicities (FeH), shape (N,).
+            logg (array-like): Surface gravities (logg), shape (N,).
+            out (numpy.ndarray, optional): float array of shape (N, n_wave)
+                to reuse for the result. Defaults to None.
+
+        Returns:
+            tuple: (fluxes, invalid), the (N, n_wave) flux array and the
+            (N,) bool array flagging the rows outside of the grid.
+        """
+        points = np.column_stack(np.broadcast_arrays(
+            np.atleast_1d(np.asarray(teff, dtype=float)),
+            np.atleast_1d(np.asarray(feh, dtype=float)),
+            np.atleast_1d(np.asarray(logg, dtype=float))))
+        with instrument.stage('interpolate', len(points)):
+            log_flux, invalid = self._interpolator.evaluate(points, out=out)
+        with instrument.stage('exp10', len(points)):
+            return np.power(10.0, log_flux, out=log_flux), invalid
+
+    def memory_report(self):
+        """
+        Report the memory held by the log-flux grid.
+
+        Returns:
+            dict: 'dtype' of the grid, 'grid_nbytes' (size of the grid),
+            'float64_nbytes' (size of the grid upcast to float64),
+            'heap_nbytes' (bytes allocated in the process), 'mapped_nbytes'
+            (bytes memory-mapped from disk), 'resident_nbytes' (mapped bytes
+            currently in RAM, None if unknown), 'shared_nbytes' (bytes in
+            shared memory, see shared_grid) and 'saved_nbytes' (float64
+            size minus the bytes actually held in RAM by this process).
+        """
+        spec_grid = self._spec_grid
+        float64_nbytes = spec_grid.size * np.dtype(np.float64).itemsize
+        heap_nbytes = mapped_nbytes = resident_nbytes = shared_nbytes = 0
+        if isinstance(spec_grid, np.memmap):
+            mapped_nbytes = spec_grid.nbytes
+            resident_nbytes = mapped_resident_bytes(spec_grid)
+        elif self._shared is not None:
+            shared_nbytes = spec_grid.nbytes
+        else:
+            heap_nbytes = spec_grid.nbytes
+        in_ram = heap_nbytes + shared_nbytes + (resident_nbytes if resident_nbytes is not None else mapped_nbytes)
+        return {
+            'dtype': str(spec_grid.dtype),
+            'grid_nbytes': spec_grid.nbytes,
+            'float64_nbytes': float64_nbytes,
+            'heap_nbytes': heap_nbytes,
+            'mapped_nbytes': mapped_nbytes,
+            'resident_nbytes': resident_nbytes,
+            'shared_nbytes': shared_nbytes,
+            'saved_nbytes': float64_nbytes - in_ram,
+        }
 
     @property
     def flux_units(self):
@@ -135,12 +256,13 @@ class MARCS_Model(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the MARCS_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             MARCS_Model: An instance of the MARCS_Model class.
@@ -150,7 +272,7 @@ class MARCS_Model(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class MARCS_Model_hiRes(StellarSpecModel):
@@ -163,12 +285,13 @@ class MARCS_Model_hiRes(StellarSpecModel):
     Attributes:
         None
     """
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the MARCS_Model_hiRes.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             MARCS_Model_hiRes: An instance of the MARCS_Model_hiRes class.
@@ -178,7 +301,7 @@ class MARCS_Model_hiRes(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class BTCond_Model(StellarSpecModel):
@@ -191,12 +314,13 @@ class BTCond_Model(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the BTCond_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             BTCond_Model: An instance of the BTCond_Model class.
@@ -206,7 +330,7 @@ class BTCond_Model(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class BTCond_Model_hiRes(StellarSpecModel):
@@ -219,12 +343,13 @@ class BTCond_Model_hiRes(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the BTCond_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             BTCond_Model: An instance of the BTCond_Model class.
@@ -234,7 +359,7 @@ class BTCond_Model_hiRes(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class BTCond_Model_R7500(StellarSpecModel):
@@ -247,12 +372,13 @@ class BTCond_Model_R7500(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the BTCond_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             BTCond_Model: An instance of the BTCond_Model class.
@@ -262,7 +388,7 @@ class BTCond_Model_R7500(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class BTCond_Model_R1800(StellarSpecModel):
@@ -275,12 +401,13 @@ class BTCond_Model_R1800(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the BTCond_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             BTCond_Model: An instance of the BTCond_Model class.
@@ -290,7 +417,7 @@ class BTCond_Model_R1800(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class BTCond_Model_R500(StellarSpecModel):
@@ -303,12 +430,13 @@ class BTCond_Model_R500(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the BTCond_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             BTCond_Model: An instance of the BTCond_Model class.
@@ -318,7 +446,7 @@ class BTCond_Model_R500(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
 
 
 class BTCond_Model_R100(StellarSpecModel):
@@ -331,12 +459,13 @@ class BTCond_Model_R100(StellarSpecModel):
         None
     """
 
-    def __init__(self):
+    def __init__(self, mmap=False, dtype='precision'):
         """
         Initialize the BTCond_Model.
 
         Args:
-            None
+            mmap (bool, optional): memory-map the grid, see StellarSpecModel. Defaults to False.
+            dtype (numpy.dtype, None or 'precision', optional): dtype of the grid in RAM, see StellarSpecModel. Defaults to 'precision'.
 
         Returns:
             BTCond_Model: An instance of the BTCond_Model class.
@@ -346,4 +475,4 @@ class BTCond_Model_R100(StellarSpecModel):
         abs_filename = os.path.join(config.grid_data_dir, file_name)
         if not os.path.exists(abs_filename):
             config.fetch_grid(grid_name)
-        super().__init__(abs_filename)
\ No newline at end of file
+        super().__init__(abs_filename, mmap=mmap, dtype=dtype)
\ No newline at end of file
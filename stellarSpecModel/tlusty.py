@@ -1,68 +1,189 @@
 from . import config
 from .stellarSpecModel import StellarSpecModel
+from .grid_interp import MultilinearInterpolator
+from . import instrument
 import h5py
-import scipy.interpolate as spinterp
 from astropy import units as u
 import numpy as np
 import os
+import threading
 
 
 class TlustyModel(StellarSpecModel):
+    """
+    The TLUSTY grid, made of sub-grids covering different logg ranges.
 
-    def __init__(self):
+    Only the axes of the sub-grids are read when the model is built. The
+    spectra of a sub-grid are read on its first query. A query is routed to
+    its sub-grid through an interval index over logg: the logg axis is cut
+    at the edges of every sub-grid and each segment is owned by the first
+    sub-grid (in file order) covering it. The top logg of the last sub-grid
+    is included. The spectra of the sub-grids are held and interpolated in
+    config.precision (read when the model is built).
+    """
+
+    def __init__(self, filename=None):
+        """
+        Args:
+            filename (str, optional): path of the grid file. Defaults to the
+                TLUSTY file in config.grid_data_dir.
+        """
         self._flux_units = u.erg / u.s / u.cm ** 2 / u.AA
         self._wavelength_units = u.AA
-        grid_name = 'TLUSTY'
-        fname, url, md5_value = config.grid_names[grid_name]
-        abs_filename = os.path.join(config.grid_data_dir, fname)
-        h5grids = h5py.File(abs_filename, 'r')
+        if filename is None:
+            fname, url, md5_value = config.grid_names['TLUSTY']
+            filename = os.path.join(config.grid_data_dir, fname)
+        self._grid_name = filename
+        self._shared = None
+        self._dtype = config.get_dtype()
         grids = []
-        loggs_left = []
-        loggs_right = []
-        models = []
-        all_teffs = np.array([])
-        all_loggs = np.array([])
-        all_fehs = np.array([])
-        for gname in h5grids:
-            grid = h5grids[gname]
-            waves = grid['wave'].astype(float)[:]
-            teffs = grid['teff'].astype(float)[:]
-            loggs = grid['logg'].astype(float)[:] / 100
-            fehs = grid['z'].astype(float)[:]
-            spec_grids = grid['spec_grid'].astype(float)[:]
-            model = spinterp.RegularGridInterpolator((teffs, fehs, loggs), spec_grids)
-            models.append(model)
-            loggs_left.append(loggs.min())
-            loggs_right.append(loggs.max())
-            grids.append([teffs, fehs, loggs])
-            all_teffs = np.concatenate((all_teffs, teffs))
-            all_loggs = np.concatenate((all_loggs, loggs))
-            all_fehs = np.concatenate((all_fehs, fehs))
+        group_names = []
+        with h5py.File(filename, 'r') as h5grids:
+            for gname in h5grids:
+                grid = h5grids[gname]
+                teffs = grid['teff'].astype(float)[:]
+                loggs = grid['logg'].astype(float)[:] / 100
+                fehs = grid['z'].astype(float)[:]
+                if not group_names:
+                    waves = grid['wave'].astype(float)[:]
+                grids.append([teffs, fehs, loggs])
+                group_names.append(gname)
+        all_teffs = np.concatenate([grid[0] for grid in grids])
+        all_fehs = np.concatenate([grid[1] for grid in grids])
+        all_loggs = np.concatenate([grid[2] for grid in grids])
         self._teff_grid = np.unique(all_teffs)
         self._logg_grid = np.unique(all_loggs)
         self._feh_grid = np.unique(all_fehs)
-        np.sort(self._teff_grid)
-        np.sort(self._logg_grid)
-        np.sort(self._feh_grid)
-        h5grids.close()
         self._wavelength = waves
         self._grids = grids
-        self._models = models
-        self._loggs_left = np.array(loggs_left)
-        self._loggs_right = np.array(loggs_right)
+        self._group_names = group_names
+        self._models = [None] * len(grids)
+        self._load_lock = threading.Lock()
+        self._loggs_left = np.array([grid[2].min() for grid in grids])
+        self._loggs_right = np.array([grid[2].max() for grid in grids])
+        self._build_logg_index()
 
-    def get_flux(self, teff, feh, logg):
-        arg = (logg >= self._loggs_left) & (logg < self._loggs_right)
-        if not arg.any():
-            raise ValueError(f'logg {logg} out of range')
-        ind = np.where(arg)[0][0]
+    def _build_logg_index(self):
+        """cut the logg axis at the sub-grid edges and assign each segment to a sub-grid"""
+        edges = np.unique(np.concatenate((self._loggs_left, self._loggs_right)))
+        owners = np.full(len(edges), -1, dtype=np.intp)
+        # segment k is [edges[k], edges[k + 1]), the last one is the single point edges[-1]
+        upper = np.append(edges[1:], edges[-1])
+        for ind in range(len(self._grids) - 1, -1, -1):
+            covered = (self._loggs_left[ind] <= edges) & (upper <= self._loggs_right[ind])
+            owners[covered] = ind
+        self._logg_edges = edges
+        self._logg_owners = owners
+
+    def _subgrid_index(self, logg):
+        """index of the sub-grid of each logg, -1 outside of every sub-grid"""
+        logg = np.asarray(logg, dtype=float)
+        seg = np.searchsorted(self._logg_edges, logg, side='right') - 1
+        inside = (seg >= 0) & (logg <= self._logg_edges[-1])
+        return np.where(inside, self._logg_owners[np.clip(seg, 0, None)], -1)
+
+    def _get_model(self, ind):
+        """the interpolator of sub-grid ind, its spectra are read on first use"""
         model = self._models[ind]
-        grid = self._grids[ind]
-        teffs, fehs, loggs = grid
+        if model is None:
+            with self._load_lock:
+                model = self._models[ind]
+                if model is None:
+                    with h5py.File(self._grid_name, 'r') as h5grids:
+                        spec_grids = h5grids[self._group_names[ind]]['spec_grid'].astype(self._dtype)[:]
+                    model = MultilinearInterpolator(tuple(self._grids[ind]), spec_grids, dtype=self._dtype)
+                    self._models[ind] = model
+        return model
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def loaded_subgrids(self):
+        """names of the sub-grids whose spectra are in memory"""
+        return [name for name, model in zip(self._group_names, self._models) if model is not None]
+
+    def memory_report(self):
+        """
+        Report the memory held by the sub-grids loaded so far, see StellarSpecModel.memory_report.
+
+        The sub-grids are read into the heap, nothing is mapped or shared.
+        """
+        grids = [model.values for model in self._models if model is not None]
+        grid_nbytes = sum(grid.nbytes for grid in grids)
+        float64_nbytes = sum(grid.size for grid in grids) * np.dtype(np.float64).itemsize
+        return {
+            'dtype': str(self._dtype),
+            'grid_nbytes': grid_nbytes,
+            'float64_nbytes': float64_nbytes,
+            'heap_nbytes': grid_nbytes,
+            'mapped_nbytes': 0,
+            'resident_nbytes': 0,
+            'shared_nbytes': 0,
+            'saved_nbytes': float64_nbytes - grid_nbytes,
+        }
+
+    def get_flux(self, teff, feh, logg, out=None):
+        """
+        Get the flux at one (teff, feh, logg) point.
+
+        Args:
+            teff, feh, logg (float): the point.
+            out (numpy.ndarray, optional): float array of shape (n_wave,) receiving the flux. Defaults to None.
+
+        Returns:
+            numpy.ndarray: the flux, shape (n_wave,).
+        """
+        ind = int(self._subgrid_index(logg))
+        if ind < 0:
+            raise ValueError(f'logg {logg} out of range')
+        teffs, fehs, loggs = self._grids[ind]
         if teff < teffs.min() or teff > teffs.max():
             raise ValueError(f'teff {teff} out of range')
         if feh < fehs.min() or feh > fehs.max():
             raise ValueError(f'feh {feh} out of range')
-        log_flux = model((teff, feh, logg))
-        flux = 10 ** log_flux
-        return flux
\ No newline at end of file
+        model = self._get_model(ind)
+        with instrument.stage('interpolate'):
+            log_flux, invalid = model.evaluate_one((teff, feh, logg), out=out)
+        with instrument.stage('exp10'):
+            return np.power(10.0, log_flux, out=log_flux)
+
+    def get_flux_batch(self, teff, feh, logg, out=None):
+        """
+        Get the fluxes for arrays of Teff, FeH, and logg values.
+
+        The points are grouped by sub-grid and every group is interpolated
+        in one vectorized call, so mixed-logg inputs cost one call per
+        sub-grid involved.
+
+        Args:
+            teff, feh, logg (array-like): shape (N,) or scalars.
+            out (numpy.ndarray, optional): (N, n_wave) float array to reuse. Defaults to None.
+
+        Returns:
+            tuple: (fluxes, invalid), the (N, n_wave) fluxes and the (N,)
+            bool array flagging the points outside of the grid (NaN rows).
+        """
+        teff, feh, logg = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(teff, dtype=float)),
+            np.atleast_1d(np.asarray(feh, dtype=float)),
+            np.atleast_1d(np.asarray(logg, dtype=float)))
+        if out is None:
+            out = np.empty((len(teff), len(self._wavelength)), dtype=self._dtype)
+        invalid = np.ones(len(teff), dtype=bool)
+        grid_inds = self._subgrid_index(logg)
+        out[grid_inds < 0] = np.nan
+        order = np.argsort(grid_inds, kind='stable')
+        bounds = np.searchsorted(grid_inds[order], np.arange(len(self._grids) + 1))
+        for ind in range(len(self._grids)):
+            rows = order[bounds[ind]:bounds[ind + 1]]
+            if len(rows) == 0:
+                continue
+            points = np.column_stack((teff[rows], feh[rows], logg[rows]))
+            with instrument.stage('interpolate', len(rows)):
+                log_flux, sub_invalid = self._get_model(ind).evaluate(points)
+            with instrument.stage('exp10', len(rows)):
+                out[rows] = np.power(10.0, log_flux, out=log_flux)
+            invalid[rows] = sub_invalid
+        return out, invalid
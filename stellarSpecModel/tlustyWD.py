@@ -1,35 +1,162 @@
 from . import config
 from .stellarSpecModel import StellarSpecModel
+from .SpecGrid import SpecGrid
+from .SpecModel import SpecModel
 import h5py
-import scipy.interpolate as spinterp
+import hashlib
+from pathlib import Path
 from astropy import units as u
 import numpy as np
 import os
 import spectool
+import logging
+logger = logging.getLogger(__name__)
 
 
 class TlustyWDModel(StellarSpecModel):
+    """
+    The TLUSTY white dwarf grid (teff, logg).
 
-    def __init__(self):
+    The linear fluxes of the original file are converted once into a
+    log10 flux grid on vacuum wavelengths and cached in the SpecGrid
+    format (one spectrum per chunk). Later constructions only open the
+    cached file lazily, and the queries read the spectra they need through
+    the shared node cache.
+    """
+
+    # upper limit of the memory used while converting the original grid, in bytes
+    convert_block_bytes = 64 * 1024 ** 2
+
+    def __init__(self, filename=None, cache_dir=None, lazy=True):
+        """
+        Args:
+            filename (str, optional): path of the original grid file. Defaults
+                to the TLUSTYWD file in config.grid_data_dir.
+            cache_dir (str, optional): directory of the converted grid. Defaults to config.cache_PATH.
+            lazy (bool, optional): read the spectra on demand instead of
+                loading the whole converted grid. Defaults to True.
+        """
         self._flux_units = u.erg / u.s / u.cm ** 2 / u.AA
         self._wavelength_units = u.AA
-        grid_name = 'TLUSTYWD'
-        fname, url, md5_value = config.grid_names[grid_name]
-        abs_filename = os.path.join(config.grid_data_dir, fname)
-        h5grids = h5py.File(abs_filename, 'r')
-        grid_name = 'default'
-        grid = h5grids[grid_name]
-        wave = grid['wave'].astype(float)[:]
-        teff_grid = grid['tgrid'].astype(float)[:]
-        logg_grid = grid['ggrid'].astype(float)[:]
-        flux_grid = grid['flux'].astype(float)[:]
-        model = spinterp.RegularGridInterpolator((teff_grid, logg_grid), np.log10(flux_grid.T))
-        self._model = model
-        self._wavelength = spectool.spec_func.air2vac(wave)
-        self._teff_grid = teff_grid
-        self._logg_grid = logg_grid
+        if filename is None:
+            fname, url, md5_value = config.grid_names['TLUSTYWD']
+            filename = os.path.join(config.grid_data_dir, fname)
+        self._grid_name = filename
+        self._shared = None
+        cache_filepath = self.cache_path(filename, cache_dir)
+        if not cache_filepath.exists():
+            self.convert(filename, cache_filepath)
+        self.grid = SpecGrid.from_hdf5(cache_filepath, lazy=lazy)
+        self._spec_model = SpecModel(self.grid)
+        self._wavelength = self.grid.wave
+        self._teff_grid = self.grid.axes['teff']
+        self._logg_grid = self.grid.axes['logg']
+
+    @property
+    def dtype(self):
+        return self._spec_model.dtype
+
+    def memory_report(self):
+        """
+        Report the memory held by the converted grid, see StellarSpecModel.memory_report.
+
+        A lazy grid stays on disk and only the spectra of its node cache
+        are held in RAM, 'node_cache_nbytes' gives their size (the cache is
+        shared by every model reading the same file). Nothing is mapped or
+        shared.
+        """
+        flux_tensor = self.grid.flux_tensor
+        grid_nbytes = flux_tensor.size * flux_tensor.dtype.itemsize
+        float64_nbytes = flux_tensor.size * np.dtype(np.float64).itemsize
+        node_cache = self._spec_model.node_cache
+        node_cache_nbytes = node_cache.nbytes if node_cache is not None else 0
+        heap_nbytes = node_cache_nbytes if isinstance(flux_tensor, h5py.Dataset) else grid_nbytes
+        return {
+            'dtype': str(flux_tensor.dtype),
+            'grid_nbytes': grid_nbytes,
+            'float64_nbytes': float64_nbytes,
+            'heap_nbytes': heap_nbytes,
+            'mapped_nbytes': 0,
+            'resident_nbytes': 0,
+            'shared_nbytes': 0,
+            'node_cache_nbytes': node_cache_nbytes,
+            'saved_nbytes': float64_nbytes - heap_nbytes,
+        }
+
+    @staticmethod
+    def cache_path(filename, cache_dir=None):
+        """path of the converted grid, keyed by the path, size and mtime of the original file"""
+        cache_dir = Path(config.cache_PATH if cache_dir is None else cache_dir).expanduser()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        stat = os.stat(filename)
+        key = f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+        key_hash = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return cache_dir / f'TLUSTYWD_loggrid_{key_hash}.h5'
+
+    @classmethod
+    def convert(cls, filename, cache_filepath):
+        """
+        Convert the original grid into a SpecGrid file of log10 fluxes.
+
+        The flux dataset, stored as (wave, logg, teff), is read in blocks of
+        teff, transposed and converted to log10, so the whole linear grid is
+        never held in memory. The wavelengths are converted from air to
+        vacuum.
+        """
+        logger.info(f'Converting {filename} to {cache_filepath}')
+        tmp_path = Path(f'{cache_filepath}.{os.getpid()}.tmp')
+        with h5py.File(filename, 'r') as h5grids:
+            grid = h5grids['default']
+            wave = spectool.spec_func.air2vac(grid['wave'].astype(float)[:])
+            axes = {'teff': grid['tgrid'].astype(float)[:], 'logg': grid['ggrid'].astype(float)[:]}
+            flux = grid['flux']
+            metadata = {'model_name': 'TLUSTYWD', 'wave_sampling': 'custom', 'source': os.path.abspath(filename)}
+            f = SpecGrid.create_hdf5(tmp_path, wave, axes, ['teff', 'logg'], dtype=np.float64,
+                                     metadata=metadata, layout='spectrum')
+            try:
+                block = max(1, int(cls.convert_block_bytes // (8 * len(wave) * len(axes['logg']))))
+                for start in range(0, len(axes['teff']), block):
+                    stop = min(start + block, len(axes['teff']))
+                    with np.errstate(divide='ignore'):
+                        f['flux_tensor'][start:stop] = np.log10(flux[:, :, start:stop].astype(float).T)
+            finally:
+                f.close()
+        os.replace(tmp_path, cache_filepath)
 
     def get_flux(self, teff, logg):
-        logflux = self._model((teff, logg))
-        flux = 10 ** logflux
-        return flux
\ No newline at end of file
+        """
+        Get the flux at one or several (teff, logg) points.
+
+        Args:
+            teff (float or array-like): effective temperature.
+            logg (float or array-like): surface gravity.
+
+        Returns:
+            numpy.ndarray: the flux, shape (n_wave,) for scalars and
+            (N, n_wave) for arrays of shape (N,).
+
+        Raises:
+            ValueError: if a point is outside of the grid.
+        """
+        if np.ndim(teff) == 0 and np.ndim(logg) == 0:
+            return self._spec_model.get_flux(teff=teff, logg=logg)
+        fluxes, invalid = self.get_flux_batch(teff, logg)
+        if invalid.any():
+            ind = np.flatnonzero(invalid)[0]
+            teff_bad, logg_bad = np.broadcast_arrays(np.atleast_1d(teff), np.atleast_1d(logg))
+            raise ValueError(f'(teff, logg) = ({teff_bad[ind]}, {logg_bad[ind]}) outside of the grid range')
+        return fluxes
+
+    def get_flux_batch(self, teff, logg, out=None):
+        """
+        Get the fluxes of arrays of (teff, logg) in one vectorized call.
+
+        Args:
+            teff, logg (array-like): shape (N,) or scalars.
+            out (numpy.ndarray, optional): (N, n_wave) float array to reuse. Defaults to None.
+
+        Returns:
+            tuple: (fluxes, invalid), the (N, n_wave) fluxes and the (N,)
+            bool array flagging the points outside of the grid (NaN rows).
+        """
+        return self._spec_model.get_flux_batch(out=out, teff=teff, logg=logg)
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+import scipy.interpolate as spinterp
+from stellarSpecModel import StellarSpecModel
+
+
+def make_grid(fname):
+    wave = np.geomspace(3000, 30000, 200)
+    teff = np.arange(3500, 8001, 500.0)
+    feh = np.array([-1.0, -0.5, 0.0, 0.5])
+    logg = np.array([3.0, 4.0, 5.0])
+    T, F, G = np.meshgrid(teff, feh, logg, indexing='ij')
+    log_flux = 4 * np.log10(T)[..., None] - 0.3 * np.log10(wave) + 0.05 * F[..., None] + 0.01 * G[..., None]
+    with h5py.File(fname, 'w') as f:
+        grid = f.create_group('default')
+        grid['wave'] = wave
+        grid['teff'] = teff
+        grid['feh'] = feh
+        grid['logg'] = logg
+        grid['spec_grid'] = log_flux.astype(np.float32)
+
+
+def test_batch_flux():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        model = StellarSpecModel(fname)
+        rng = np.random.default_rng(42)
+        teffs = rng.uniform(3000, 8500, 200)
+        fehs = rng.uniform(-1, 0.5, 200)
+        loggs = rng.uniform(3, 5, 200)
+        fluxes, invalid = model.get_flux_batch(teffs, fehs, loggs)
+        assert fluxes.shape == (200, len(model.wavelength))
+        outside = (teffs < model.min_teff) | (teffs > model.max_teff)
+        assert np.array_equal(invalid, outside)
+        assert np.all(np.isnan(fluxes[invalid]))
+
+        ref_model = spinterp.RegularGridInterpolator(
+            (model.teff_grid, model.feh_grid, model.logg_grid), model._spec_grid)
+        points = np.column_stack((teffs, fehs, loggs))[~invalid]
+        assert np.allclose(fluxes[~invalid], 10 ** ref_model(points), rtol=1e-10)
+
+        out = np.empty_like(fluxes)
+        fluxes2, _ = model.get_flux_batch(teffs, fehs, loggs, out=out)
+        assert fluxes2 is out
+        assert np.allclose(model.get_flux(5700, 0.0, 4.5), 10 ** ref_model((5700, 0.0, 4.5)))
+
+
+def test_mmap_grid():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        model = StellarSpecModel(fname)
+        model_mmap = StellarSpecModel(fname, mmap=True)
+        assert isinstance(model_mmap._spec_grid, np.memmap)
+        assert model_mmap._spec_grid.dtype == np.float32
+        fluxes, _ = model.get_flux_batch([4200, 6100], [-0.3, 0.2], [3.3, 4.7])
+        fluxes_mmap, _ = model_mmap.get_flux_batch([4200, 6100], [-0.3, 0.2], [3.3, 4.7])
+        assert np.allclose(fluxes, fluxes_mmap, rtol=1e-12)
+        report = model_mmap.memory_report()
+        assert report['heap_nbytes'] == 0
+        assert report['mapped_nbytes'] == report['float64_nbytes'] // 2
+
+
+if __name__ == '__main__':
+    test_batch_flux()
+    test_mmap_grid()
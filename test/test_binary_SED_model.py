@@ -1,4 +1,11 @@
-from stellarSpecModel import BinarySEDModel
+import os
+import tempfile
+from stellarSpecModel import BinarySEDModel, StellarSpecModel, instrument, reddening
+from stellarSpecModel import binary_SED_model
+from stellarSpecModel.projection import get_band_projector
+from test_batch_flux import make_grid
+from test_sed_likelihood import make_shaped_grid
+from scipy.optimize import nnls
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -66,5 +73,110 @@ def test():
     plt.show()
 
 
+def test_single_pass():
+    bands = ['SDSSg', 'SDSSr', '2MASSJ', '2MASSKs']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        specmodel = StellarSpecModel(fname)
+        binary = BinarySEDModel(teff1=6100, feh1=-0.3, R1=1.2, D=150.0, Av=0.4,
+                                teff2=4700, logg2=4.6, R2=0.8, specmodel=specmodel)
+        binary.add_data(bands)
+
+        waves = specmodel.wavelength
+        spec1 = reddening.redden(waves, specmodel.get_flux(6100, -0.3, 4.4) * (1.2 / 150.0 * binary._rat_rsun_pc) ** 2, 0.4)
+        spec2 = reddening.redden(waves, specmodel.get_flux(4700, -0.3, 4.6) * (0.8 / 150.0 * binary._rat_rsun_pc) ** 2, 0.4)
+        projector = get_band_projector(waves, [binary.filters[band] for band in binary._bands])
+        sed1, sed2 = projector.apply(spec1), projector.apply(spec2)
+
+        with instrument.profile() as prof:
+            assert np.allclose(binary.get_SED_spec1()[1], spec1, rtol=1e-14)
+            assert np.allclose(binary.get_SED_spec2()[1], spec2, rtol=1e-14)
+            assert np.allclose(binary.get_SED_spec()[1], spec1 + spec2, rtol=1e-14)
+            assert np.allclose(binary.get_SED1()[1], sed1, rtol=1e-12)
+            assert np.allclose(binary.get_SED2()[1], sed2, rtol=1e-12)
+            assert np.allclose(binary.get_SED()[1], sed1 + sed2, rtol=1e-12)
+            binary.plot()
+        # each component is interpolated, reddened and projected once
+        assert prof.stages['interpolate']['calls'] == 2
+        assert prof.stages['project']['calls'] == 1
+        assert 'extinction_curve' not in prof.stages or prof.stages['extinction_curve']['calls'] <= 1
+
+        # only the changed component is recomputed, direct attribute changes are seen
+        binary.R2 = 1.0
+        with instrument.profile() as prof:
+            sed = binary.get_SED()[1]
+        assert prof.stages['interpolate']['calls'] == 1
+        assert np.allclose(sed, sed1 + sed2 * (1.0 / 0.8) ** 2, rtol=1e-12)
+        binary.set_pars(Av=0.0)
+        spec1_noext = specmodel.get_flux(6100, -0.3, 4.4) * (1.2 / 150.0 * binary._rat_rsun_pc) ** 2
+        assert np.allclose(binary.get_SED_spec1()[1], spec1_noext, rtol=1e-14)
+
+
+def test_projector_cache(monkeypatch):
+    bands = ['SDSSg', 'SDSSr', '2MASSJ']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        specmodel = StellarSpecModel(fname)
+        binary = BinarySEDModel(teff1=6100, feh1=-0.3, R1=1.2, D=150.0, Av=0.4,
+                                teff2=4700, logg2=4.6, R2=0.8, specmodel=specmodel)
+        binary.add_data(bands, obs_fluxes=[1.0, 1.0, 1.0], obs_fluxerrs=[0.1, 0.1, 0.1])
+        # the shared projector is built from an equal copy of the wavelength grid
+        shared = get_band_projector(specmodel.wavelength.copy(), [binary.filters[band] for band in binary._bands])
+        calls = []
+
+        def counted(wave, filters):
+            calls.append(len(filters))
+            return get_band_projector(wave, filters)
+
+        monkeypatch.setattr(binary_SED_model, 'get_band_projector', counted)
+        for teff in [6000, 6100, 6200]:
+            binary.set_pars(teff1=teff)
+            binary.get_lnlike()
+        assert calls == [3] and binary._projector is shared
+        binary.add_data(['2MASSH'])
+        binary.get_SED()
+        assert calls == [3, 4]
+
+
+def test_fit_grid():
+    bands = ['SDSSu', 'SDSSg', 'SDSSr', 'SDSSi', '2MASSJ', '2MASSH', '2MASSKs']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname)
+        specmodel = StellarSpecModel(fname)
+        truth = dict(teff1=6500.0, logg1=4.0, R1=1.2, teff2=4500.0, logg2=4.0, R2=0.8, feh1=0.0, D=100.0, Av=0.2)
+        binary = BinarySEDModel(specmodel=specmodel, **truth)
+        binary.add_data(bands)
+        fluxes = binary.get_SED()[1]
+        binary = BinarySEDModel(specmodel=specmodel, syserr=0.02, **truth)
+        binary.add_data(bands, obs_fluxes=fluxes, obs_fluxerrs=0.01 * fluxes)
+
+        teffs = specmodel.teff_grid
+        result = binary.fit_grid(teff1=teffs[teffs >= 5000], teff2=teffs, logg2=[3.0, 4.0])
+        assert result['chisq'].shape == (len(teffs[teffs >= 5000]), 1, len(teffs), 2, 1, 1)
+        best = result['best'][0]
+        assert best['teff1'] == 6500 and best['teff2'] == 4500 and best['logg2'] == 4.0
+        assert np.isclose(best['R1'], 1.2, rtol=1e-6) and np.isclose(best['R2'], 0.8, rtol=1e-6)
+        assert best['chisq'] < 1e-8
+        assert all(a['chisq'] <= b['chisq'] for a, b in zip(result['best'], result['best'][1:]))
+
+        # every pair matches the NNLS solution and get_chisq_syserr
+        fluxes_obs, sigmas = binary._sigmas()
+        rng = np.random.default_rng(1)
+        for _ in range(10):
+            ind = tuple(rng.integers(0, n) for n in result['chisq'].shape)
+            params = {name: result['axes'][name][i] for name, i in zip(result['axes'], ind)}
+            flux1 = binary.node_band_fluxes(params['teff1'], params['feh'], params['logg1'], params['Av'])[0, 0, 0, 0]
+            flux2 = binary.node_band_fluxes(params['teff2'], params['feh'], params['logg2'], params['Av'])[0, 0, 0, 0]
+            scales, _ = nnls(np.column_stack((flux1, flux2)) / sigmas[:, None], fluxes_obs / sigmas)
+            radii = np.sqrt(scales) * 100.0 / binary._rat_rsun_pc
+            assert np.allclose([result['R1'][ind], result['R2'][ind]], radii, rtol=1e-6, atol=1e-8)
+            binary.set_pars(teff1=params['teff1'], logg1=params['logg1'], teff2=params['teff2'],
+                            logg2=params['logg2'], R1=max(radii[0], 1e-30), R2=max(radii[1], 1e-30))
+            assert np.isclose(result['chisq'][ind], binary.get_chisq_syserr(), rtol=1e-6)
+
+
 if __name__ == '__main__':
     test()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from stellarSpecModel import StellarSpecModel, SEDModel, registry
+from stellarSpecModel.SpecModel import SpecModel
+from stellarSpecModel.emulator import compress, svd_basis, PCASpecModel, PCAStellarSpecModel
+from test_spec_model import make_spec_grid
+from test_sed_likelihood import make_shaped_grid
+
+
+def test_svd_basis():
+    rng = np.random.default_rng(0)
+    # rank 3 spectra plus a small noise
+    log_flux = rng.normal(size=(60, 3)) @ rng.normal(size=(3, 400)) + 1e-6 * rng.normal(size=(60, 400))
+    mean, basis, coefficients, max_error = svd_basis(log_flux, tol=1e-4)
+    assert basis.shape == (3, 400) and coefficients.shape == (60, 3)
+    assert np.allclose(basis @ basis.T, np.eye(3))
+    assert max_error <= 1e-4
+    assert np.isclose(np.abs(mean + coefficients @ basis - log_flux).max(), max_error)
+    # capped number of components
+    mean, basis, coefficients, max_error = svd_basis(log_flux, tol=1e-4, max_components=2)
+    assert len(basis) == 2 and max_error > 1e-4
+
+
+def test_compress_stellar_spec_model():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname)
+        model = StellarSpecModel(fname)
+        pca_model = compress(model, tol=1e-4, cache_dir=tmpdir)
+        assert isinstance(pca_model, PCAStellarSpecModel)
+        report = pca_model.emulator.report()
+        assert report['max_error'] <= 1e-4 and report['compression_ratio'] > 2
+        assert report['n_components'] < 20
+        assert pca_model.memory_report()['heap_nbytes'] == report['nbytes'] < model.memory_report()['heap_nbytes']
+        assert report['nbytes'] <= registry.model_nbytes(pca_model) < registry.model_nbytes(model)
+
+        # the nodes and the interpolated points are reproduced within tol
+        rng = np.random.default_rng(1)
+        points = np.column_stack([rng.uniform(3500, 8000, 50), rng.uniform(-1, 0.5, 50), rng.uniform(3, 5, 50)])
+        points = np.vstack([points, [[5000, 0.0, 4.0], [9000, 0.0, 4.0]]])
+        fluxes, invalid = pca_model.get_flux_batch(points[:, 0], points[:, 1], points[:, 2])
+        ref_fluxes, ref_invalid = model.get_flux_batch(points[:, 0], points[:, 1], points[:, 2])
+        assert np.array_equal(invalid, ref_invalid) and invalid[-1]
+        assert np.abs(np.log10(fluxes[~invalid] / ref_fluxes[~invalid])).max() <= 1e-4
+        assert np.allclose(pca_model.get_flux(*points[0]), fluxes[0], rtol=1e-12)
+        with pytest.raises(ValueError, match='outside of grid range'):
+            pca_model.get_flux(9000, 0.0, 4.0)
+
+        # the compressed model is accepted wherever a StellarSpecModel is
+        sed = SEDModel(teff=5700, feh=-0.2, logg=4.3, R=1.0, distance=100, specmodel=pca_model)
+        ref_sed = SEDModel(teff=5700, feh=-0.2, logg=4.3, R=1.0, distance=100, specmodel=model)
+        assert np.allclose(sed.get_SED_spec()[1], ref_sed.get_SED_spec()[1], rtol=3e-4)
+
+        # the second call loads the cached emulator
+        cached = compress(model, tol=1e-4, cache_dir=tmpdir)
+        assert cached.emulator.n_components == report['n_components']
+        assert np.array_equal(cached.get_flux(*points[0]), pca_model.get_flux(*points[0]))
+        with pytest.raises(ValueError, match='already compressed'):
+            compress(pca_model)
+
+
+def test_compress_spec_model():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pca_model = compress(model, tol=1e-6, cache_dir=tmpdir)
+        assert isinstance(pca_model, PCASpecModel) and isinstance(pca_model, SpecModel)
+        assert np.array_equal(pca_model.wave, grid.wave)
+        # the grid is rank 2 around its mean: teff and logg scale the spectra
+        assert pca_model.emulator.n_components <= 2
+        assert np.allclose(pca_model.get_flux(teff=5720, logg=4.1), model.get_flux(teff=5720, logg=4.1), rtol=1e-5)
+        fluxes, invalid = pca_model.get_flux_batch(teff=[4100, 7800], logg=[3.7, 3.2])
+        assert np.array_equal(invalid, [False, True]) and np.all(np.isnan(fluxes[1]))
+        with pytest.raises(ValueError, match='physical hole'):
+            pca_model.get_flux(teff=7800, logg=3.2)
+
+        loaded = PCASpecModel.load(pca_model._grid_name)
+        assert np.array_equal(loaded.get_flux(teff=4100, logg=3.7), pca_model.get_flux(teff=4100, logg=3.7))
+        assert loaded.metadata['kind'] == 'pca_grid'
+
+
+if __name__ == '__main__':
+    test_svd_basis()
+    test_compress_stellar_spec_model()
+    test_compress_spec_model()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+from stellarSpecModel import StellarSpecModel, SEDModel, BinarySEDModel
+from stellarSpecModel import instrument
+from test_batch_flux import make_grid
+
+
+def test_profile():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        specmodel = StellarSpecModel(fname)
+        model = SEDModel(['SDSSg', 'SDSSr', '2MASSJ'], specmodel=specmodel)
+        model.set_SED_pars(5700, 4.5, 0.0, 1.0, 100.0, 0.3)
+
+        assert not instrument.enabled
+        instrument.reset()
+        model.get_SED()
+        assert instrument.totals() == {}
+
+        samples = []
+        with instrument.profile(callback=lambda *event: samples.append(event), every=2) as prof:
+            model.get_SED()
+            model.get_SED_batch([5000, 6000, 7000], 4.5, 0.0, 1.0, 100.0, 0.3)
+        assert not instrument.enabled
+        stages = prof.stages
+        for name in ['interpolate', 'exp10', 'extinction', 'project']:
+            assert stages[name]['calls'] == 2
+        assert stages['interpolate']['items'] == 4
+        assert stages['project']['items'] == 4
+        assert all(0 <= val['fraction'] <= 1 for val in stages.values())
+        assert prof.other >= 0
+        assert len(samples) == sum(val['calls'] for val in stages.values()) // 2
+        assert 'interpolate' in str(prof)
+
+        binary = BinarySEDModel(teff1=5800, feh1=0.0, logg1=4.4, R1=1.0, D=100.0, Av=0.3,
+                                teff2=4500, logg2=4.6, R2=0.7, specmodel=specmodel)
+        binary.add_data(['SDSSg', 'SDSSr', '2MASSJ'], obs_fluxes=[1.0, 1.0, 1.0], obs_fluxerrs=[0.1, 0.1, 0.1])
+        with instrument.profile() as outer:
+            with instrument.profile() as inner:
+                binary.get_lnlike()
+            binary.set_pars(teff1=5900)
+            binary.get_lnlike()
+        assert inner.stages['interpolate']['calls'] == 2
+        assert outer.stages['interpolate']['calls'] == 3
+        assert outer.stages['project']['calls'] == 2
+        assert not instrument.enabled
+
+
+if __name__ == '__main__':
+    test_profile()
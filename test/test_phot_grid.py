@@ -0,0 +1,78 @@
+import os
+import tempfile
+import numpy as np
+from stellarSpecModel import StellarSpecModel
+from stellarSpecModel.phot_grid import PhotGrid
+from stellarSpecModel.projection import integrate_bands
+from test_batch_flux import make_grid
+
+
+def box_filters():
+    filters = {}
+    for name, (wmin, wmax) in {'box_b': (4000, 5000), 'box_r': (6000, 7000), 'box_j': (11000, 14000)}.items():
+        waves = np.linspace(wmin, wmax, 50)
+        filters[name] = [waves, np.ones_like(waves)]
+    return filters
+
+
+def test_phot_grid():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        model = StellarSpecModel(fname)
+        filters = box_filters()
+        bands = list(filters.keys())
+        Avs = np.linspace(0, 2, 5)
+        phot_grid = PhotGrid.compile(model, bands, Av=Avs, filters=filters, cache_dir=tmpdir)
+        assert phot_grid.bands == bands
+        filter_list = [filters[band] for band in bands]
+
+        # exact on the grid nodes
+        flux = model.get_flux(5000, 0.0, 4.0)
+        ref = integrate_bands(model.wavelength, flux, filter_list)
+        assert np.allclose(phot_grid.get_band_fluxes(5000, 0.0, 4.0, 0.0), ref)
+
+        # close to the spectrum integration between the nodes
+        flux = model.get_flux(5230, -0.2, 4.4)
+        ref = integrate_bands(model.wavelength, flux, filter_list)
+        assert np.allclose(phot_grid.get_band_fluxes(5230, -0.2, 4.4, 0.0), ref, rtol=1e-2)
+
+        fluxes, invalid = phot_grid.get_band_fluxes_batch([5000, 9000], [0, 0], [4, 4], [1.0, 1.0])
+        assert fluxes.shape == (2, len(bands))
+        assert list(invalid) == [False, True]
+
+        cached = PhotGrid.compile(model, bands, Av=Avs, filters=filters, cache_dir=tmpdir)
+        assert np.allclose(cached.grid.flux_tensor, phot_grid.grid.flux_tensor)
+
+        # without Av nodes the extinction goes through the per-band reddening coefficients
+        PhotGrid.compile(model, bands, filters=filters, cache_dir=tmpdir)
+        coeff_grid = PhotGrid.compile(model, bands, filters=filters, cache_dir=tmpdir)
+        assert 'red_coeff' in coeff_grid.grid.grid_parameters
+        assert np.allclose(coeff_grid.get_band_fluxes(5000, 0.0, 4.0, 0.5),
+                           phot_grid.get_band_fluxes(5000, 0.0, 4.0, 0.5), rtol=1e-3)
+
+
+def test_phot_grid_in_memory_model():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        model = StellarSpecModel(fname)
+        filters = box_filters()
+        bands = list(filters.keys())
+        # a model built from arrays has no grid file (_grid_name is None)
+        in_memory = StellarSpecModel.from_arrays(model.wavelength, model.teff_grid, model.feh_grid,
+                                                 model.logg_grid, model._spec_grid)
+        phot_grid = PhotGrid.compile(in_memory, bands, filters=filters, cache_dir=tmpdir)
+        assert np.allclose(phot_grid.grid.flux_tensor,
+                           PhotGrid.compile(model, bands, filters=filters, cache_dir=tmpdir).grid.flux_tensor)
+
+        # same wavelength grid, different fluxes: the cached band fluxes of the first model are not reused
+        brighter = StellarSpecModel.from_arrays(model.wavelength, model.teff_grid, model.feh_grid,
+                                                model.logg_grid, model._spec_grid + 1.0)
+        brighter_grid = PhotGrid.compile(brighter, bands, filters=filters, cache_dir=tmpdir)
+        assert np.allclose(brighter_grid.grid.flux_tensor, phot_grid.grid.flux_tensor + 1.0)
+
+
+if __name__ == '__main__':
+    test_phot_grid()
+    test_phot_grid_in_memory_model()
@@ -0,0 +1,171 @@
+import os
+import json
+import tempfile
+import numpy as np
+import h5py
+import pandas as pd
+import pytest
+from stellarSpecModel import StellarSpecModel, config, pipeline
+from stellarSpecModel.SED_model import SEDModel
+from stellarSpecModel.phot_grid import PhotGrid
+from stellarSpecModel.phot_util import flux_to_mag
+from test_sed_likelihood import make_shaped_grid
+
+
+BANDS = ['SDSSg', 'SDSSr', 'SDSSi', '2MASSJ', '2MASSH']
+
+
+def make_catalog(fname, nrow=1000):
+    rng = np.random.default_rng(3)
+    catalog = pd.DataFrame({
+        'teff': rng.uniform(3600, 7900, nrow),
+        'logg': rng.uniform(3, 5, nrow),
+        'feh': rng.uniform(-1, 0.5, nrow),
+        'R': rng.uniform(0.5, 2, nrow),
+        'distance': rng.uniform(50, 500, nrow),
+        'Av': rng.uniform(0, 1, nrow),
+    })
+    catalog.loc[0, 'teff'] = 9000
+    catalog.to_csv(fname, index=False)
+    return catalog
+
+
+def test_pipeline_fluxes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grid_file = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(grid_file)
+        catalog = make_catalog(os.path.join(tmpdir, 'catalog.csv'))
+        model = SEDModel(BANDS, specmodel=StellarSpecModel(grid_file))
+        expected, invalid = model.get_SED_batch(*[catalog[name].to_numpy() for name in SEDModel.param_names])
+
+        output = os.path.join(tmpdir, 'fluxes.h5')
+        summary = pipeline.run_catalog(os.path.join(tmpdir, 'catalog.csv'), output, BANDS, model=grid_file,
+                                       chunk_size=128, workers=2, metrics_path=os.path.join(tmpdir, 'metrics.jsonl'))
+        assert summary['rows'] == 1000 and summary['chunks'] == 8
+        assert not os.path.exists(output + '.checkpoint.json')
+        with h5py.File(output, 'r') as f:
+            assert np.array_equal(f['valid'][:], ~invalid)
+            for ind, band in enumerate(BANDS):
+                assert np.allclose(f[f'flux_{band}'][:], expected[:, ind], rtol=1e-12, equal_nan=True)
+        with open(os.path.join(tmpdir, 'metrics.jsonl')) as f:
+            assert [json.loads(line)['chunk'] for line in f] == list(range(8))
+
+        output = os.path.join(tmpdir, 'mags.csv')
+        pipeline.run_catalog(os.path.join(tmpdir, 'catalog.csv'), output, BANDS, mode='mags', model=grid_file,
+                             chunk_size=300)
+        mags = pd.read_csv(output)
+        assert len(mags) == 1000
+        assert np.allclose(mags['mag_2MASSJ'][1:], flux_to_mag(expected[1:, 3], 0.0, model.bands[3])[0], rtol=1e-8)
+
+
+def test_pipeline_phot_grid_workers(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # a cold cache: the phot grid is compiled once by the parent, the workers only load it
+        cache_dir = os.path.join(tmpdir, 'cache')
+        monkeypatch.setattr(config, 'cache_PATH', cache_dir)
+        monkeypatch.setenv('stellarSpecModel_cache_PATH', cache_dir)
+        grid_file = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(grid_file)
+        catalog = make_catalog(os.path.join(tmpdir, 'catalog.csv'))
+        Av_nodes = np.linspace(0, 1, 5)
+        compile_log = os.path.join(tmpdir, 'compile.log')
+        compile_phot_grid = PhotGrid.compile.__func__
+
+        def logged_compile(cls, *args, **kwargs):
+            with open(compile_log, 'a') as f:
+                f.write(f'{os.getpid()}\n')
+            return compile_phot_grid(cls, *args, **kwargs)
+
+        # the forked workers inherit the patched method
+        monkeypatch.setattr(PhotGrid, 'compile', classmethod(logged_compile))
+        output = os.path.join(tmpdir, 'fluxes.h5')
+        summary = pipeline.run_catalog(os.path.join(tmpdir, 'catalog.csv'), output, BANDS, model=grid_file,
+                                       chunk_size=100, workers=4, phot_grid=True, Av_nodes=Av_nodes)
+        assert summary['rows'] == 1000
+        with open(compile_log) as f:
+            assert f.read().split() == [str(os.getpid())]
+        assert len([name for name in os.listdir(cache_dir) if '_photgrid_' in name]) == 1
+
+        model = SEDModel(BANDS, specmodel=StellarSpecModel(grid_file))
+        model.enable_phot_grid(Av=Av_nodes)
+        expected, invalid = model.get_SED_batch(*[catalog[name].to_numpy() for name in SEDModel.param_names])
+        with h5py.File(output, 'r') as f:
+            assert np.array_equal(f['valid'][:], ~invalid)
+            for ind, band in enumerate(BANDS):
+                assert np.allclose(f[f'flux_{band}'][:], expected[:, ind], rtol=1e-12, equal_nan=True)
+
+
+def test_pipeline_resume(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grid_file = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(grid_file)
+        catalog_file = os.path.join(tmpdir, 'catalog.csv')
+        make_catalog(catalog_file)
+        reference = os.path.join(tmpdir, 'reference.csv')
+        pipeline.run_catalog(catalog_file, reference, BANDS, model=grid_file, chunk_size=100)
+
+        output = os.path.join(tmpdir, 'output.csv')
+        process = pipeline.CatalogWorker.process
+        calls = []
+
+        def failing_process(self, columns):
+            calls.append(1)
+            if len(calls) == 4:
+                raise RuntimeError('interrupted')
+            return process(self, columns)
+
+        monkeypatch.setattr(pipeline.CatalogWorker, 'process', failing_process)
+        with pytest.raises(RuntimeError):
+            pipeline.run_catalog(catalog_file, output, BANDS, model=grid_file, chunk_size=100)
+        with open(output + '.checkpoint.json') as f:
+            assert json.load(f)['chunks'] == 3
+        monkeypatch.setattr(pipeline.CatalogWorker, 'process', process)
+        summary = pipeline.run_catalog(catalog_file, output, BANDS, model=grid_file, chunk_size=100)
+        assert summary['chunks'] == 7
+        with open(output) as f1, open(reference) as f2:
+            assert f1.read() == f2.read()
+
+
+def test_pipeline_fit():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grid_file = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(grid_file)
+        model = SEDModel(BANDS, specmodel=StellarSpecModel(grid_file))
+        truths = np.array([[6000, 4.0, -0.5, 1.3, 200.0, 0.5], [4500, 3.0, 0.0, 0.7, 80.0, 0.0],
+                           [7500, 5.0, 0.5, 2.0, 400.0, 1.0]])
+        fluxes, _ = model.get_SED_batch(*truths.T)
+        columns = {'distance': truths[:, 4]}
+        for ind, band in enumerate(BANDS):
+            columns[f'mag_{band}'] = flux_to_mag(fluxes[:, ind], 0.0, model.bands[ind])[0]
+            columns[f'magerr_{band}'] = np.full(3, 0.01)
+        columns['mag_SDSSg'][1] = np.nan
+        catalog_file = os.path.join(tmpdir, 'catalog.h5')
+        with h5py.File(catalog_file, 'w') as f:
+            for name, values in columns.items():
+                f[name] = values
+        output = os.path.join(tmpdir, 'fit.csv')
+        pipeline.run_catalog(catalog_file, output, BANDS, mode='fit', model=grid_file, chunk_size=2,
+                             Av_nodes=[0.0, 0.5, 1.0])
+        fit = pd.read_csv(output)
+        assert np.allclose(fit[['teff', 'logg', 'feh', 'Av']].to_numpy(), truths[:, [0, 1, 2, 5]])
+        assert np.allclose(fit['R'], truths[:, 3], rtol=1e-6)
+
+
+def test_pipeline_empty():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grid_file = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(grid_file)
+        catalog_file = os.path.join(tmpdir, 'catalog.h5')
+        with h5py.File(catalog_file, 'w') as f:
+            for name in SEDModel.param_names:
+                f[name] = np.zeros(0)
+        output = os.path.join(tmpdir, 'fluxes.h5')
+        summary = pipeline.run_catalog(catalog_file, output, BANDS, model=grid_file, chunk_size=128)
+        assert summary['rows'] == 0 and summary['chunks'] == 0
+        assert not os.path.exists(output + '.checkpoint.json')
+
+
+if __name__ == '__main__':
+    test_pipeline_fluxes()
+    test_pipeline_fit()
+    test_pipeline_empty()
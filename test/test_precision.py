@@ -0,0 +1,108 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from stellarSpecModel import StellarSpecModel, config, reddening
+from stellarSpecModel.SpecModel import SpecModel
+from stellarSpecModel.emulator import compress
+from test_spec_model import make_spec_grid
+from test_sed_likelihood import make_shaped_grid, make_model
+from test_sed_workspace import traced_peak
+
+
+def max_rel_error(values, reference):
+    return np.max(np.abs(values / reference - 1))
+
+
+def test_set_precision():
+    assert config.precision == 'float64' and config.get_dtype() == np.float64
+    with pytest.raises(ValueError, match='precision should be one of'):
+        config.set_precision('float16')
+    assert config.get_dtype(np.float32) == np.float32
+
+
+def test_float32_models():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname)
+        ref = StellarSpecModel(fname)
+        config.set_precision('float32')
+        try:
+            model = StellarSpecModel(fname)
+            spec_model = SpecModel(make_spec_grid())
+            pca_model = compress(ref, tol=1e-4, cache_dir=tmpdir)
+        finally:
+            config.set_precision('float64')
+        assert ref.dtype == np.float64 and model.dtype == np.float32
+        assert model.memory_report()['dtype'] == 'float32'
+
+        flux = model.get_flux(5720, -0.3, 4.2)
+        assert flux.dtype == np.float32
+        assert max_rel_error(flux, ref.get_flux(5720, -0.3, 4.2)) < 1e-5
+        teff, feh, logg = [4100, 6600, 9000], [0.2, -0.7, 0.0], [3.4, 4.9, 4.0]
+        fluxes, invalid = model.get_flux_batch(teff, feh, logg)
+        ref_fluxes, ref_invalid = ref.get_flux_batch(teff, feh, logg)
+        assert fluxes.dtype == np.float32 and np.array_equal(invalid, ref_invalid)
+        assert max_rel_error(fluxes[~invalid], ref_fluxes[~invalid]) < 1e-5
+
+        grid = make_spec_grid()
+        flux = spec_model.get_flux(teff=5720, logg=4.1)
+        assert flux.dtype == np.float32
+        assert max_rel_error(flux, SpecModel(grid).get_flux(teff=5720, logg=4.1)) < 1e-5
+        flux = pca_model.get_flux(5720, -0.3, 4.2)
+        assert flux.dtype == np.float32 and max_rel_error(flux, ref.get_flux(5720, -0.3, 4.2)) < 3e-4
+        # the reported error includes the float32 rounding of the emulator
+        nodes = np.stack(np.meshgrid(ref.teff_grid, ref.feh_grid, ref.logg_grid, indexing='ij'), axis=-1).reshape(-1, 3)
+        log_flux, _ = pca_model.emulator.evaluate(nodes)
+        node_error = np.abs(log_flux - ref._spec_grid.reshape(len(nodes), -1)).max()
+        assert node_error <= pca_model.emulator.max_error * (1 + 1e-6)
+
+        # reddening keeps the dtype of the spectra
+        waves = model.wavelength
+        reddened = reddening.redden(waves, model.get_flux(5720, -0.3, 4.2), 0.7)
+        ref_reddened = reddening.redden(waves, ref.get_flux(5720, -0.3, 4.2), 0.7)
+        assert reddened.dtype == np.float32 and max_rel_error(reddened, ref_reddened) < 1e-5
+        curve = reddening.get_curve(waves, dtype=np.float32)
+        assert curve.dtype == np.float32 and reddening.get_curve(waves).dtype == np.float64
+
+
+def test_float32_sed():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname, n_wave=3000)
+        ref = make_model(StellarSpecModel(fname))
+        config.set_precision('float32')
+        try:
+            model = make_model(StellarSpecModel(fname))
+        finally:
+            config.set_precision('float64')
+        workspace = model.workspace
+        assert workspace.flux.dtype == workspace.extinction.dtype == np.float32
+        assert workspace.band_fluxes.dtype == np.float64
+
+        # the band fluxes and the likelihood stay float64 and close to the float64 reference
+        fluxes = model.get_SED()[1]
+        assert fluxes.dtype == np.float64 and max_rel_error(fluxes, ref.get_SED()[1]) < 1e-5
+        assert max_rel_error(model.get_SED(out=workspace.band_fluxes)[1], ref.get_SED()[1]) < 1e-5
+        assert np.isclose(model.get_log_likelihood(), ref.get_log_likelihood(), rtol=1e-4)
+        params = ([5200, 6100], [4.4, 3.6], [0.1, -0.6], [1.0, 2.0], [150, 300], [0.0, 1.2])
+        fluxes, invalid = model.get_SED_batch(*params)
+        assert max_rel_error(fluxes, ref.get_SED_batch(*params)[0]) < 1e-5
+        node_fluxes = model.node_band_fluxes([5000, 6000], [0.0], [4.0], [0.0, 0.5])
+        assert max_rel_error(node_fluxes, ref.node_band_fluxes([5000, 6000], [0.0], [4.0], [0.0, 0.5])) < 1e-5
+
+        # float32 spectra are projected without being upcast
+        teffs = iter(np.tile(np.linspace(4000, 7500, 50), 100).tolist())
+
+        def evaluate():
+            model.set_teff(next(teffs))
+            model.get_log_likelihood()
+
+        peak, leaked = traced_peak(evaluate)
+        assert peak < workspace.flux.nbytes / 4 and leaked <= 0, (peak, leaked)
+
+
+if __name__ == '__main__':
+    test_set_precision()
+    test_float32_models()
+    test_float32_sed()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from stellarSpecModel.projection import rebin_matrix, get_band_projector, _bin_edges
+from stellarSpecModel.phot_util import load_filter, filtername2pyphotname
+
+
+def test_rebin_matrix():
+    rng = np.random.default_rng(0)
+    wave = np.sort(rng.uniform(1000, 5000, 400))
+    flux = rng.uniform(1, 2, 400)
+    new_wave = np.geomspace(1200, 4800, 300)
+    rebinned = rebin_matrix(wave, new_wave) @ flux
+    # flux conserving: integral over the new bins equals the integral of the covered old pixels
+    edges, new_edges = _bin_edges(wave), _bin_edges(new_wave)
+    cum_flux = np.concatenate(([0], np.cumsum(flux * np.diff(edges))))
+    ref = np.diff(np.interp(new_edges, edges, cum_flux)) / np.diff(new_edges)
+    assert np.allclose(rebinned, ref, rtol=1e-10)
+    # the new pixels centered outside of the old wavelength range are padded with zero,
+    # the part of a bin beyond the old pixels counts as zero flux
+    new_wave = np.linspace(500, 6000, 50)
+    inside = (new_wave >= wave[0]) & (new_wave <= wave[-1])
+    new_edges = _bin_edges(new_wave)
+    covered = np.diff(np.clip(new_edges, edges[0], edges[-1])) / np.diff(new_edges)
+    assert np.allclose(rebin_matrix(wave, new_wave) @ np.ones(400), np.where(inside, covered, 0.0))
+
+
+def test_band_projector():
+    rng = np.random.default_rng(1)
+    wave = np.geomspace(3000, 30000, 2000)
+    filters = [(np.linspace(4000, 5000, 80), np.hanning(80)),
+               (np.linspace(12000, 14000, 30), np.ones(30))]
+    projector = get_band_projector(wave, filters)
+    assert get_band_projector(wave.copy(), filters) is projector
+    spectra = rng.uniform(1, 2, (7, len(wave)))
+    band_fluxes = projector.apply(spectra)
+    assert band_fluxes.shape == (7, 2)
+    for spec, fluxes in zip(spectra, band_fluxes):
+        assert np.allclose(projector.apply(spec), fluxes)
+        wave_filter, transmit = filters[0]
+        widths = np.append(np.diff(wave_filter), np.diff(wave_filter)[-1])
+        flux_interp = rebin_matrix(wave, wave_filter) @ spec
+        ref = np.sum(flux_interp * transmit * widths) / np.sum(transmit * widths)
+        assert np.isclose(fluxes[0], ref)
+
+
+def baseline_band_fluxes(pyrebin, wave, flux, filters):
+    """the band loop of SEDModel.get_SED before the projector"""
+    band_fluxes = []
+    for wave_filter, transmit in filters:
+        flux_interp = pyrebin.rebin_padvalue(wave, flux, wave_filter)
+        widths = np.diff(wave_filter)
+        widths = np.append(widths, widths[-1])
+        band_fluxes.append(np.sum(flux_interp * transmit * widths) / np.sum(transmit * widths))
+    return np.array(band_fluxes)
+
+
+def test_baseline_band_fluxes():
+    pyrebin = pytest.importorskip('spectool.pyrebin')
+    # the grid ends inside 2MASSKs and before W1
+    wave = np.geomspace(2000, 22000, 20000)
+    flux = 1e20 / wave ** 5 / np.expm1(1.4387769e8 / (wave * 5800.0))
+    bands = ['SDSSg', 'SDSSr', '2MASSJ', '2MASSKs', 'W1']
+    filters = [load_filter(filtername2pyphotname(band))[:2] for band in bands]
+    band_fluxes = get_band_projector(wave, filters).apply(flux)
+    assert np.allclose(band_fluxes, baseline_band_fluxes(pyrebin, wave, flux, filters), rtol=1e-10, atol=1e-300)
+    assert band_fluxes[-1] == 0
+
+
+if __name__ == '__main__':
+    test_rebin_matrix()
+    test_band_projector()
+    test_baseline_band_fluxes()
@@ -0,0 +1,26 @@
+import numpy as np
+from extinction import apply, fitzpatrick99, ccm89
+from stellarSpecModel import reddening
+
+
+def test_reddening():
+    wave = np.geomspace(1000, 50000, 500)
+    flux = np.linspace(1, 2, 500)
+    curve = reddening.get_curve(wave, 3.1, 'F99')
+    assert reddening.get_curve(wave, 3.1, 'F99') is curve
+    assert reddening.get_curve(wave.copy(), 3.1, 'F99') is curve
+    assert not curve.flags.writeable
+    assert np.allclose(reddening.redden(wave, flux, 0.8), apply(fitzpatrick99(wave, 0.8, 3.1), flux))
+    assert np.allclose(reddening.redden(wave, flux, 0.8, 2.5, 'CCM89'), apply(ccm89(wave, 0.8, 2.5), flux))
+
+    stack = np.vstack([flux, flux])
+    reddened = reddening.redden(wave, stack, np.array([0.0, 1.5]))
+    assert np.allclose(reddened[0], flux)
+    assert np.allclose(reddened[1], apply(fitzpatrick99(wave, 1.5, 3.1), flux))
+
+    out = flux.copy()
+    assert reddening.redden(wave, out, 0.3, out=out) is out
+
+
+if __name__ == '__main__':
+    test_reddening()
@@ -0,0 +1,31 @@
+import os
+import tempfile
+from stellarSpecModel import StellarSpecModel
+from stellarSpecModel import registry
+from test_batch_flux import make_grid
+
+
+def test_registry():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        registry.register_model('test_grid_a', lambda: StellarSpecModel(fname), overwrite=True)
+        registry.register_model('test_grid_b', lambda: StellarSpecModel(fname), overwrite=True)
+        old_budget = registry.get_memory_budget()
+        try:
+            model = registry.get_model('test_grid_a')
+            assert registry.get_model('test_grid_a') is model
+            nbytes = registry.loaded_models()['test_grid_a']
+            assert nbytes >= model._spec_grid.nbytes
+            registry.set_memory_budget(int(1.5 * nbytes))
+            registry.get_model('test_grid_b')
+            loaded = registry.loaded_models()
+            assert 'test_grid_a' not in loaded
+            assert 'test_grid_b' in loaded
+        finally:
+            registry.set_memory_budget(old_budget)
+            registry.clear()
+
+
+if __name__ == '__main__':
+    test_registry()
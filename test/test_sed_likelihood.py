@@ -0,0 +1,101 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+from stellarSpecModel import StellarSpecModel
+from stellarSpecModel.SED_model import ObservedSEDModel
+from test_batch_flux import make_grid
+
+
+def make_shaped_grid(fname, n_wave=300):
+    """a grid whose parameters change the shape of the spectra, not only their scale"""
+    wave = np.geomspace(3000, 30000, n_wave)
+    teff = np.arange(3500, 8001, 500.0)
+    feh = np.array([-1.0, -0.5, 0.0, 0.5])
+    logg = np.array([3.0, 4.0, 5.0])
+    T, F, G = np.meshgrid(teff, feh, logg, indexing='ij')
+    x = 1.4388e8 / (wave * T[..., None])
+    log_flux = -5 * np.log10(wave) - np.log10(np.expm1(x)) + 0.1 * F[..., None] * (wave / 1e4) \
+        - 0.05 * G[..., None] * np.log10(wave / 3000)
+    with h5py.File(fname, 'w') as f:
+        grid = f.create_group('default')
+        grid['wave'] = wave
+        grid['teff'] = teff
+        grid['feh'] = feh
+        grid['logg'] = logg
+        grid['spec_grid'] = log_flux + 20
+
+
+def make_model(specmodel):
+    bands = ['SDSSg', 'SDSSr', 'SDSSi', '2MASSJ', '2MASSH']
+    truth = (5700, 4.3, -0.2, 1.1, 200.0, 0.4)
+    model = ObservedSEDModel(bands=bands, specmodel=specmodel, observed_fluxes=np.ones(len(bands)),
+                             observed_errors=np.ones(len(bands)))
+    model.set_SED_pars(*truth)
+    fluxes = model.get_SED()[1]
+    model.obs_fluxes = list(fluxes * (1 + 0.03 * np.random.default_rng(0).standard_normal(len(bands))))
+    model.obs_flux_errs = list(0.05 * fluxes)
+    model.set_syserr_all(list(0.01 * fluxes))
+    return model
+
+
+def test_log_likelihood():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        model = make_model(StellarSpecModel(fname))
+        rng = np.random.default_rng(1)
+        thetas = np.column_stack([rng.uniform(4000, 7000, 32), rng.uniform(3, 5, 32), rng.uniform(-1, 0.5, 32),
+                                  rng.uniform(0.8, 1.3, 32), rng.uniform(150, 250, 32), rng.uniform(0, 1, 32)])
+        thetas[0, 0] = 9000
+        log_likes = model.log_likelihood(thetas)
+        assert log_likes.shape == (32,)
+        assert log_likes[0] == -np.inf
+        for theta, log_like in zip(thetas[1:], log_likes[1:]):
+            model.set_SED_pars(*theta)
+            assert np.isclose(model.get_log_likelihood(), log_like, rtol=1e-10)
+            assert np.isclose(model.log_likelihood(theta), log_like, rtol=1e-10)
+        assert model.observations['fluxes'].flags.writeable is False
+
+        # stateless: the parameters held by the model are unchanged
+        model.set_SED_pars(5000, 4.0, 0.0, 1.0, 100.0, 0.0)
+        model.log_likelihood(thetas)
+        assert (model.teff, model.logg, model.distance) == (5000, 4.0, 100.0)
+
+
+def test_fit_grid():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname)
+        model = make_model(StellarSpecModel(fname))
+        truth = (6000, 4.0, -0.5, 1.3, 200.0, 0.6)
+        model.set_SED_pars(*truth)
+        fluxes = model.get_SED()[1]
+        model.obs_fluxes = list(fluxes)
+        model.obs_flux_errs = list(0.002 * fluxes)
+        model.set_syserr_all([0.0] * len(fluxes))
+        Avs = np.linspace(0, 1.2, 5)
+        result = model.fit_grid(Av=Avs, distance=200.0)
+        assert result['chisq'].shape == (10, 4, 3, 5)
+        best = result['best']
+        assert (best['teff'], best['logg'], best['feh'], best['Av']) == (6000, 4.0, -0.5, 0.6)
+        assert np.isclose(best['R'], 1.3, rtol=1e-8)
+        assert best['chisq'] < 1e-12
+        for name, marginal in result['marginals'].items():
+            assert np.isclose(np.sum(marginal), 1.0)
+            assert np.argmax(marginal) == list(result['axes'][name]).index(best[name])
+
+        # the chi-square of a node matches the likelihood at the best radius
+        model.set_SED_pars(4500, 3.0, 0.0, result['R'][2, 2, 0, 1], 200.0, Avs[1])
+        assert np.isclose(model.get_chisq(), result['chisq'][2, 2, 0, 1], rtol=1e-8)
+
+        # the same fit through the phot grid
+        model.enable_phot_grid(Av=Avs, cache_dir=tmpdir)
+        result_phot = model.fit_grid(distance=200.0)
+        assert result_phot['best']['teff'] == 6000 and result_phot['best']['Av'] == 0.6
+        assert np.allclose(result_phot['chisq'], result['chisq'], rtol=1e-6, atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_log_likelihood()
+    test_fit_grid()
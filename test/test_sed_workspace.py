@@ -0,0 +1,78 @@
+import os
+import tempfile
+import tracemalloc
+import numpy as np
+from stellarSpecModel import StellarSpecModel
+from test_sed_likelihood import make_shaped_grid, make_model
+
+
+def traced_peak(func, ncall=200, nwarm=1000):
+    """peak and growth of the traced memory over ncall calls, in bytes"""
+    # the warm-up also fills the free lists of the interpreter (small tuples, floats)
+    for _ in range(nwarm):
+        func()
+    tracemalloc.start()
+    try:
+        func()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for _ in range(ncall):
+            func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before, current - before
+
+
+def test_workspace():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname)
+        model = make_model(StellarSpecModel(fname))
+        workspace = model.workspace
+        ref_waves, ref_fluxes = model.get_SED()
+        waves, fluxes = model.get_SED(out=workspace.band_fluxes)
+        assert fluxes is workspace.band_fluxes and waves is workspace.eff_waves
+        assert np.array_equal(waves, ref_waves) and np.allclose(fluxes, ref_fluxes, rtol=1e-12)
+        assert np.allclose(model.get_SED_spec(out=workspace.flux)[1], model.get_SED_spec()[1], rtol=1e-12)
+        theta = [model.teff, model.logg, model.feh, model.rad, model.distance, model.Av]
+        assert np.isclose(model.get_log_likelihood(), model.log_likelihood(theta), rtol=1e-10)
+        obs = model.observations
+        assert np.isclose(model.get_chisq(), np.sum((obs['fluxes'] - ref_fluxes)**2 / obs['flux_errs']**2), rtol=1e-10)
+
+        # the extinction factor is cached by Av, Rv and the law
+        model.set_Av(0.0)
+        no_ext = model.get_SED()[1]
+        model.set_Av(0.4)
+        assert np.allclose(model.get_SED()[1], ref_fluxes, rtol=1e-12)
+        assert np.all(model.get_SED()[1] < no_ext)
+
+        # the workspace follows the band list
+        model.add_band('2MASSKs')
+        assert model.workspace is not workspace and len(model.workspace.band_fluxes) == len(model.bands)
+
+
+def test_no_allocation():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(fname, n_wave=3000)
+        model = make_model(StellarSpecModel(fname))
+        spectrum_bytes = model.workspace.flux.nbytes
+        teffs = iter(np.tile(np.linspace(4000, 7500, 50), 100).tolist())
+
+        def evaluate():
+            model.set_teff(next(teffs))
+            model.get_log_likelihood()
+
+        peak, leaked = traced_peak(evaluate)
+        # no spectrum-sized (or band-sized) array is allocated, only a few small python objects
+        assert peak < spectrum_bytes / 4 and leaked <= 0, (peak, leaked)
+
+        model.enable_phot_grid(cache_dir=tmpdir)
+        peak, leaked = traced_peak(evaluate)
+        assert peak < spectrum_bytes / 4 and leaked <= 0, (peak, leaked)
+
+
+if __name__ == '__main__':
+    test_workspace()
+    test_no_allocation()
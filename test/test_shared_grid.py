@@ -0,0 +1,107 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+from concurrent.futures import ProcessPoolExecutor
+from stellarSpecModel import StellarSpecModel, shared_grid, pipeline
+from stellarSpecModel.SpecModel import SpecModel
+from test_batch_flux import make_grid
+from test_spec_model import make_spec_grid
+from test_pipeline import BANDS, make_catalog
+
+
+_model = None
+
+
+def _attach(spec):
+    global _model
+    _model = shared_grid.attach(spec)
+
+
+def _flux(point):
+    return _model.get_flux(*point), _model._spec_grid.flags.writeable, os.getpid()
+
+
+def test_shared_stellar_spec_model():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.hdf5')
+        make_grid(fname)
+        model = StellarSpecModel(fname)
+        points = [(4200, -0.3, 3.3), (6100, 0.2, 4.7), (7700, -0.9, 3.9)]
+        with shared_grid.publish(model) as handle:
+            assert handle.is_shared and handle.nbytes >= model._spec_grid.nbytes
+            attached = shared_grid.attach(handle.spec)
+            attached2 = shared_grid.attach(handle.spec)
+            assert shared_grid.attached_blocks() == {handle.name: 2}
+            assert np.allclose(attached.get_flux(*points[0]), model.get_flux(*points[0]), rtol=1e-14)
+            assert not attached._spec_grid.flags.writeable
+            report = attached.memory_report()
+            assert report['shared_nbytes'] == model._spec_grid.nbytes and report['heap_nbytes'] == 0
+            shared_grid.detach(attached)
+            del attached2
+            assert shared_grid.attached_blocks() == {}
+
+            with ProcessPoolExecutor(max_workers=2, initializer=_attach, initargs=(handle.spec,)) as pool:
+                results = list(pool.map(_flux, points))
+            for point, (flux, writeable, pid) in zip(points, results):
+                assert pid != os.getpid() and not writeable
+                assert np.allclose(flux, model.get_flux(*point), rtol=1e-14)
+            name = handle.name
+        assert not os.path.exists(f'/dev/shm/{name}')
+
+
+def test_shared_spec_model():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    with shared_grid.publish(model) as handle:
+        attached = shared_grid.attach(handle.spec)
+        assert np.allclose(attached.get_flux(teff=5720, logg=4.1), model.get_flux(teff=5720, logg=4.1), rtol=1e-14)
+        assert np.array_equal(attached.grid.valid_mask, grid.valid_mask)
+        fluxes, invalid = attached.get_flux_batch(teff=[4100, 7800], logg=[3.7, 3.2])
+        assert np.array_equal(invalid, [False, True])
+        shared_grid.detach(attached)
+
+
+def test_fallback():
+    saved = shared_grid.shared_memory
+    shared_grid.shared_memory = None
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'grid.hdf5')
+            make_grid(fname)
+            model = StellarSpecModel(fname)
+            handle = shared_grid.publish(model)
+            assert not handle.is_shared and handle.spec['fallback'] == 'mmap'
+            attached = shared_grid.attach(handle.spec)
+            assert isinstance(attached._spec_grid, np.memmap)
+            assert np.allclose(attached.get_flux(5000, 0.0, 4.0), model.get_flux(5000, 0.0, 4.0), rtol=1e-6)
+            del attached
+
+            handle = shared_grid.publish(SpecModel(make_spec_grid()))
+            assert handle.spec['fallback'] == 'copy'
+            assert shared_grid.attach(handle.spec).get_flux(teff=5720, logg=4.1).shape == (150,)
+    finally:
+        shared_grid.shared_memory = saved
+
+
+def test_pipeline_shared_memory():
+    from test_sed_likelihood import make_shaped_grid
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grid_file = os.path.join(tmpdir, 'grid.hdf5')
+        make_shaped_grid(grid_file)
+        make_catalog(os.path.join(tmpdir, 'catalog.csv'), nrow=300)
+        outputs = []
+        for shared in [False, True]:
+            output = os.path.join(tmpdir, f'fluxes_{shared}.h5')
+            pipeline.run_catalog(os.path.join(tmpdir, 'catalog.csv'), output, BANDS, model=grid_file,
+                                 chunk_size=100, workers=2, shared_memory=shared)
+            with h5py.File(output, 'r') as f:
+                outputs.append(f[f'flux_{BANDS[0]}'][:])
+        assert np.array_equal(outputs[0], outputs[1], equal_nan=True)
+
+
+if __name__ == '__main__':
+    test_shared_stellar_spec_model()
+    test_shared_spec_model()
+    test_fallback()
+    test_pipeline_shared_memory()
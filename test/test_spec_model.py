@@ -0,0 +1,226 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+import pytest
+import scipy.interpolate as spinterp
+from stellarSpecModel.SpecGrid import SpecGrid
+from stellarSpecModel.SpecModel import SpecModel
+from stellarSpecModel.grid_io import rewrite_cache
+from stellarSpecModel import node_cache
+
+
+def rebin_reference(wave, flux, new_wave):
+    def edges(w):
+        mids = 0.5 * (w[1:] + w[:-1])
+        return np.concatenate(([2 * w[0] - mids[0]], mids, [2 * w[-1] - mids[-1]]))
+    old_edges, new_edges = edges(wave), edges(new_wave)
+    cumulative = np.concatenate(([0], np.cumsum(flux * np.diff(old_edges))))
+    return np.diff(np.interp(new_edges, old_edges, cumulative)) / np.diff(new_edges)
+
+
+def make_spec_grid():
+    wave = np.geomspace(3000, 30000, 150)
+    teff = np.arange(3500, 8001, 500.0)
+    logg = np.array([3.0, 3.5, 4.5, 5.0])
+    T, G = np.meshgrid(teff, logg, indexing='ij')
+    log_flux = 4 * np.log10(T)[..., None] - 0.3 * np.log10(wave) + 0.01 * G[..., None]
+    valid_mask = np.ones(T.shape, dtype=bool)
+    valid_mask[-1, 0] = False
+    log_flux[-1, 0] = np.nan
+    return SpecGrid(wave, {'teff': teff, 'logg': logg}, ['teff', 'logg'], log_flux, valid_mask=valid_mask)
+
+
+def test_get_flux():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    ref_model = spinterp.RegularGridInterpolator((grid.axes['teff'], grid.axes['logg']), grid.flux_tensor)
+    assert np.allclose(model.get_flux(teff=5720, logg=4.1), 10 ** ref_model((5720, 4.1)), rtol=1e-12)
+    # a point on the edge of the hole cell only uses valid nodes
+    expected = 0.6 * grid.flux_tensor[-2, 0] + 0.4 * grid.flux_tensor[-2, 1]
+    assert np.allclose(model.get_flux(teff=7500, logg=3.2), 10 ** expected, rtol=1e-12)
+
+    out = np.empty(grid.n_wave)
+    flux = model.get_flux(out=out, teff=4100, logg=3.7)
+    assert flux is out
+    assert np.allclose(flux, 10 ** ref_model((4100, 3.7)), rtol=1e-12)
+
+    with pytest.raises(ValueError, match='Missing required grid parameters'):
+        model.get_flux(teff=5000)
+    with pytest.raises(ValueError, match='outside of the grid range'):
+        model.get_flux(teff=9000, logg=4.0)
+    with pytest.raises(ValueError, match='physical hole'):
+        model.get_flux(teff=7800, logg=3.2)
+
+
+def test_get_flux_batch():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    teffs = np.array([4100, 7800, 9000, 6000])
+    loggs = np.array([3.7, 3.2, 4.0, 4.9])
+    fluxes, invalid = model.get_flux_batch(teff=teffs, logg=loggs)
+    assert np.array_equal(invalid, [False, True, True, False])
+    assert np.all(np.isnan(fluxes[invalid]))
+    for ind in np.where(~invalid)[0]:
+        assert np.allclose(fluxes[ind], model.get_flux(teff=teffs[ind], logg=loggs[ind]), rtol=1e-12)
+
+
+def test_lazy_get_flux():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.h5')
+        grid.to_hdf5(fname)
+        with SpecGrid.from_hdf5(fname, lazy=True) as lazy_grid:
+            lazy_model = SpecModel(lazy_grid)
+            assert np.allclose(lazy_model.get_flux(teff=5720, logg=4.1), model.get_flux(teff=5720, logg=4.1), rtol=1e-12)
+            fluxes, invalid = lazy_model.get_flux_batch(teff=[4100, 7800], logg=[3.7, 3.2])
+            assert np.array_equal(invalid, [False, True])
+            with pytest.raises(ValueError, match='physical hole'):
+                lazy_model.get_flux(teff=7800, logg=3.2)
+
+
+def test_derive_resample():
+    grid = make_spec_grid()
+    grid.metadata['model_name'] = 'synthetic'
+    model = SpecModel(grid)
+    wavelength = {'range': (4000, 20000), 'method': 'log', 'step': 2e-3}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        derived = model.derive(wavelength=wavelength, cache_dir=tmpdir)
+        derived_threads = model.derive(wavelength=wavelength, cache_dir=tmpdir, overwrite=True,
+                                       workers=3, block_size=7)
+        derived_procs = model.derive(wavelength=wavelength, cache_dir=tmpdir, overwrite=True,
+                                     workers=2, executor='process', block_size=11)
+    new_wave = derived.grid.wave
+    assert np.array_equal(derived.grid.valid_mask, grid.valid_mask)
+    assert np.all(np.isnan(derived.grid.flux_tensor[~grid.valid_mask]))
+    assert np.array_equal(derived_threads.grid.flux_tensor, derived.grid.flux_tensor, equal_nan=True)
+    assert np.array_equal(derived_procs.grid.flux_tensor, derived.grid.flux_tensor, equal_nan=True)
+
+    wave_mask = (grid.wave >= 4000) & (grid.wave <= 20000)
+    cropped_wave = grid.wave[wave_mask]
+    inner = (new_wave > cropped_wave[1]) & (new_wave < cropped_wave[-2])
+    for idx in [(0, 0), (4, 2), (-1, -1)]:
+        expected = rebin_reference(cropped_wave, 10 ** grid.flux_tensor[idx][wave_mask], new_wave)
+        assert np.allclose(10 ** derived.grid.flux_tensor[idx][inner], expected[inner], rtol=1e-10)
+
+
+def test_resample_baseline():
+    pyrebin = pytest.importorskip('spectool.pyrebin')
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    wave_mask = (grid.wave >= 4000) & (grid.wave <= 20000)
+    cropped_wave = grid.wave[wave_mask]
+    cropped_flux = grid.flux_tensor[..., wave_mask]
+    # extends past both ends of cropped_wave
+    new_wave = np.geomspace(3500, 23000, 500)
+    out = np.full(grid.valid_mask.shape + (len(new_wave),), np.nan)
+    model._resample(cropped_wave, cropped_flux, grid.valid_mask, new_wave, out, block_size=7)
+    # the loop of derive before the rebin operator
+    for idx in np.ndindex(grid.valid_mask.shape):
+        if not grid.valid_mask[idx]:
+            assert np.all(np.isnan(out[idx]))
+            continue
+        with np.errstate(divide='ignore'):
+            expected = np.log10(pyrebin.rebin_padvalue(cropped_wave, 10 ** cropped_flux[idx], new_wave))
+        assert np.array_equal(np.isinf(out[idx]), np.isinf(expected))
+        finite = np.isfinite(expected)
+        assert np.allclose(out[idx][finite], expected[finite], rtol=0, atol=1e-12)
+
+
+def test_stream_derive():
+    grid = make_spec_grid()
+    grid.metadata['model_name'] = 'synthetic'
+    select = {'teff': [4000.0, 5000.0, 5500.0, 7500.0, 8000.0], 'logg': (3.0, 4.5)}
+    wavelength = {'range': (4000, 20000), 'method': 'log', 'step': 2e-3}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.h5')
+        grid.to_hdf5(fname)
+        with SpecGrid.from_hdf5(fname, lazy=True) as lazy_grid:
+            model = SpecModel(lazy_grid)
+            derived = model.derive(select, wavelength, cache_dir=tmpdir)
+            expected = np.asarray(derived.grid.flux_tensor)
+            # one spectrum, one logg row and whole teff slabs per read
+            for budget in [1, 20000, 10 ** 8]:
+                streamed = model.derive(select, wavelength, cache_dir=tmpdir, overwrite=True, memory_budget=budget)
+                assert isinstance(streamed.grid.flux_tensor, h5py.Dataset)
+                assert streamed.grid.flux_tensor.chunks == (1, 1, len(streamed.grid.wave))
+                assert np.array_equal(streamed.grid.flux_tensor[:], expected, equal_nan=True)
+                assert np.array_equal(streamed.grid.valid_mask, derived.grid.valid_mask)
+                assert np.array_equal(streamed.grid.wave, derived.grid.wave)
+                streamed.grid.close()
+            cropped = model.derive(select, {'range': (4000, 20000)}, cache_dir=tmpdir, memory_budget=20000)
+            wave_mask = (grid.wave >= 4000) & (grid.wave <= 20000)
+            teff_idx = [1, 3, 4, 8, 9]
+            assert np.array_equal(cropped.grid.flux_tensor[:],
+                                  grid.flux_tensor[np.ix_(teff_idx, [0, 1, 2], wave_mask)], equal_nan=True)
+            cropped.grid.close()
+            derived.grid.close()
+
+
+def test_layouts():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    expected = model.get_flux(teff=5720, logg=4.1)
+    options_list = [{'layout': 'spectrum'}, {'layout': 'cell', 'compression': 'lzf', 'shuffle': True},
+                    {'layout': 'wave_tile', 'wave_tile': 64, 'compression': 'gzip'}]
+    chunks_list = [(1, 1, 150), (2, 2, 150), (1, 1, 64)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for ind, (options, chunks) in enumerate(zip(options_list, chunks_list)):
+            fname = os.path.join(tmpdir, f'grid_{ind}.h5')
+            grid.to_hdf5(fname, **options)
+            with SpecGrid.from_hdf5(fname, lazy=True) as lazy_grid:
+                assert lazy_grid.flux_tensor.chunks == chunks
+                assert np.allclose(SpecModel(lazy_grid).get_flux(teff=5720, logg=4.1), expected, rtol=1e-12)
+        with pytest.raises(ValueError):
+            grid.to_hdf5(os.path.join(tmpdir, 'bad.h5'), compression='gzip')
+
+        rewritten = rewrite_cache(tmpdir, layout='cell', compression='gzip', shuffle=True)
+        assert len(rewritten) == 3
+        assert rewrite_cache(tmpdir, layout='cell', compression='gzip', shuffle=True) == []
+        with SpecGrid.from_hdf5(rewritten[0], lazy=True) as lazy_grid:
+            assert lazy_grid.flux_tensor.chunks == (2, 2, 150)
+            assert lazy_grid.flux_tensor.compression == 'gzip'
+            assert np.array_equal(lazy_grid.flux_tensor[:], grid.flux_tensor, equal_nan=True)
+            assert np.array_equal(lazy_grid.valid_mask, grid.valid_mask)
+
+
+def test_node_cache():
+    grid = make_spec_grid()
+    model = SpecModel(grid)
+    assert model.node_cache is None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'grid.h5')
+        grid.to_hdf5(fname, layout='spectrum', compression='gzip')
+        node_cache.clear()
+        with SpecGrid.from_hdf5(fname, lazy=True) as grid1, SpecGrid.from_hdf5(fname, lazy=True) as grid2:
+            model1, model2 = SpecModel(grid1), SpecModel(grid2)
+            cache = model1.node_cache
+            assert cache is model2.node_cache
+            expected = model.get_flux(teff=5720, logg=4.1)
+            assert np.allclose(model1.get_flux(teff=5720, logg=4.1), expected, rtol=1e-12)
+            assert cache.stats()['misses'] == 4 and cache.stats()['hits'] == 0
+            assert np.allclose(model2.get_flux(teff=5710, logg=4.2), model.get_flux(teff=5710, logg=4.2), rtol=1e-12)
+            assert cache.stats()['misses'] == 4 and cache.stats()['hits'] == 4
+            fluxes, invalid = model2.get_flux_batch(teff=[5720, 5730], logg=[4.1, 4.0])
+            assert np.allclose(fluxes[0], expected, rtol=1e-12)
+            assert cache.stats()['hits'] == 12
+
+            cache.resize(3 * grid.n_wave * 8)
+            stats = cache.stats()
+            assert stats['n_nodes'] == 3 and stats['nbytes'] <= stats['max_bytes']
+            assert stats['evictions'] == 1
+            assert np.allclose(model1.get_flux(teff=3700, logg=3.1), model.get_flux(teff=3700, logg=3.1), rtol=1e-12)
+            assert cache.stats()['n_nodes'] == 3
+        node_cache.clear()
+
+
+if __name__ == '__main__':
+    test_get_flux()
+    test_get_flux_batch()
+    test_lazy_get_flux()
+    test_derive_resample()
+    test_resample_baseline()
+    test_stream_derive()
+    test_layouts()
+    test_node_cache()
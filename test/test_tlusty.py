@@ -1,8 +1,70 @@
-from stellarSpecModel import TlustyModel
+import os
+import tempfile
+import pytest
+from stellarSpecModel import TlustyModel, shared_grid
 import numpy as np
+import h5py
+import scipy.interpolate as spinterp
 import matplotlib.pyplot as plt
 
 
+def make_tlusty_grid(fname):
+    """two sub-grids in the TLUSTY layout, overlapping in logg"""
+    wave = np.geomspace(900, 30000, 120)
+    subgrids = {'BSTAR': (np.arange(15000, 30001, 2500.0), np.array([175, 250, 325, 400, 475])),
+                'OSTAR': (np.arange(27500, 55001, 2500.0), np.array([300, 375, 450, 475]))}
+    z = np.array([0.0, 0.5, 1.0])
+    with h5py.File(fname, 'w') as f:
+        for gname, (teff, logg) in subgrids.items():
+            T, Z, G = np.meshgrid(teff, z, logg / 100, indexing='ij')
+            log_flux = 4 * np.log10(T)[..., None] - 0.3 * np.log10(wave) + 0.02 * Z[..., None] + 0.05 * G[..., None]
+            grid = f.create_group(gname)
+            grid['wave'] = wave
+            grid['teff'] = teff
+            grid['logg'] = logg
+            grid['z'] = z
+            grid['spec_grid'] = log_flux
+
+
+def test_subgrid_index():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'tlusty.hdf5')
+        make_tlusty_grid(fname)
+        model = TlustyModel(fname)
+        assert model.loaded_subgrids == []
+        assert np.array_equal(model._subgrid_index([1.7, 1.75, 3.0, 4.74, 4.75, 4.8]), [-1, 0, 0, 0, 0, -1])
+        with h5py.File(fname, 'r') as f:
+            refs = [spinterp.RegularGridInterpolator(
+                (f[name]['teff'][:], f[name]['z'][:], f[name]['logg'][:] / 100), f[name]['spec_grid'][:])
+                for name in model._group_names]
+        # the top logg of the sub-grids is reachable
+        assert np.allclose(model.get_flux(20000, 0.5, 4.75), 10 ** refs[0]((20000, 0.5, 4.75)), rtol=1e-12)
+        assert model.loaded_subgrids == ['BSTAR']
+        teffs = np.array([16000, 29000, 20000, 26000, 50000])
+        fehs = np.array([0.1, 0.7, 0.5, 0.0, 0.3])
+        loggs = np.array([2.0, 4.75, 1.0, 3.3, 3.5])
+        fluxes, invalid = model.get_flux_batch(teffs, fehs, loggs)
+        assert np.array_equal(invalid, [False, False, True, False, True])
+        assert np.all(np.isnan(fluxes[invalid]))
+        for ind in np.where(~invalid)[0]:
+            assert np.allclose(fluxes[ind], model.get_flux(teffs[ind], fehs[ind], loggs[ind]), rtol=1e-12)
+            assert np.allclose(fluxes[ind], 10 ** refs[0]((teffs[ind], fehs[ind], loggs[ind])), rtol=1e-12)
+
+
+def test_memory_report():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'tlusty.hdf5')
+        make_tlusty_grid(fname)
+        model = TlustyModel(fname)
+        assert model.memory_report()['grid_nbytes'] == 0
+        model.get_flux(20000, 0.5, 3.0)
+        report = model.memory_report()
+        # the BSTAR sub-grid: 7 teff x 3 z x 5 logg x 120 wavelengths
+        assert report['grid_nbytes'] == report['heap_nbytes'] == report['float64_nbytes'] == 7 * 3 * 5 * 120 * 8
+        with pytest.raises(ValueError, match='no single'):
+            shared_grid.publish(model)
+
+
 def main():
     model = TlustyModel()
     print('teff grid:', model.teff_grid)
@@ -1,7 +1,74 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+import pytest
+import scipy.interpolate as spinterp
+import spectool
 import matplotlib.pyplot as plt
 from stellarSpecModel import TlustyWDModel
 
 
+def make_wd_grid(fname):
+    """a grid in the TlustyGrids layout, flux stored as (wave, logg, teff)"""
+    wave = np.geomspace(1000, 20000, 80)
+    tgrid = np.arange(10000, 40001, 5000.0)
+    ggrid = np.array([7.0, 7.5, 8.0, 8.5, 9.0])
+    T, G = np.meshgrid(tgrid, ggrid, indexing='ij')
+    flux = 10 ** (4 * np.log10(T)[..., None] - 0.3 * np.log10(wave) + 0.1 * G[..., None])
+    with h5py.File(fname, 'w') as f:
+        grid = f.create_group('default')
+        grid['wave'] = wave
+        grid['tgrid'] = tgrid
+        grid['ggrid'] = ggrid
+        grid['flux'] = flux.T
+
+
+def test_cached_grid():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'TlustyGrids.hdf5')
+        make_wd_grid(fname)
+        model = TlustyWDModel(fname, cache_dir=tmpdir)
+        cache_file = TlustyWDModel.cache_path(fname, tmpdir)
+        assert cache_file.exists()
+        with h5py.File(fname, 'r') as f:
+            grid = f['default']
+            ref = spinterp.RegularGridInterpolator((grid['tgrid'][:], grid['ggrid'][:]), np.log10(grid['flux'][:].T))
+            assert np.allclose(model.wavelength, spectool.spec_func.air2vac(grid['wave'][:]), rtol=1e-14)
+        assert np.allclose(model.get_flux(21000, 8.2), 10 ** ref((21000, 8.2)), rtol=1e-12)
+
+        teffs = np.array([12000, 21000, 39000])
+        loggs = np.array([7.1, 8.2, 9.0])
+        fluxes = model.get_flux(teffs, loggs)
+        assert fluxes.shape == (3, len(model.wavelength))
+        assert np.allclose(fluxes, 10 ** ref(np.column_stack((teffs, loggs))), rtol=1e-12)
+        fluxes, invalid = model.get_flux_batch([12000, 50000], 8.0)
+        assert np.array_equal(invalid, [False, True])
+        with pytest.raises(ValueError):
+            model.get_flux(teffs, [7.1, 8.2, 9.5])
+        with pytest.raises(ValueError):
+            model.get_flux(50000, 8.0)
+
+        # the lazy grid stays on disk, only the cached node spectra are in RAM
+        report = model.memory_report()
+        grid_nbytes = 7 * 5 * len(model.wavelength) * 8
+        assert report['grid_nbytes'] == report['float64_nbytes'] == grid_nbytes
+        assert 0 < report['node_cache_nbytes'] == report['heap_nbytes'] < grid_nbytes
+        assert report['saved_nbytes'] == grid_nbytes - report['heap_nbytes']
+
+        mtime = os.stat(cache_file).st_mtime_ns
+        model2 = TlustyWDModel(fname, cache_dir=tmpdir)
+        assert os.stat(cache_file).st_mtime_ns == mtime
+        assert np.allclose(model2.get_flux(21000, 8.2), model.get_flux(21000, 8.2), rtol=1e-14)
+        model.grid.close()
+        model2.grid.close()
+
+        model = TlustyWDModel(fname, cache_dir=tmpdir, lazy=False)
+        report = model.memory_report()
+        assert report['heap_nbytes'] == report['grid_nbytes'] == grid_nbytes
+        assert report['node_cache_nbytes'] == 0 and report['saved_nbytes'] == 0
+
+
 def plot_model():
     model = TlustyWDModel()
 
@@ -0,0 +1,72 @@
+import os
+import json
+import tempfile
+import hashlib
+from stellarSpecModel import config
+
+
+def test_verify():
+    saved = config.grid_names, config.grid_data_dir, config.hash_chunk_bytes
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = os.urandom(100000)
+        good_md5 = hashlib.md5(data).hexdigest()
+        for name in ['a.hdf5', 'b.hdf5']:
+            with open(os.path.join(tmpdir, name), 'wb') as f:
+                f.write(data)
+        config.grid_names = {'A': ('a.hdf5', 'None', good_md5), 'B': ('b.hdf5', 'None', '0' * 32),
+                             'C': ('c.hdf5', 'None', good_md5)}
+        config.grid_data_dir = tmpdir
+        config.hash_chunk_bytes = 4096
+        try:
+            fname = os.path.join(tmpdir, 'a.hdf5')
+            assert config.file_md5(fname) == good_md5
+            assert config.read_stamp(fname) is None
+            assert config.verify_all(workers=3) == {'A': 'ok', 'B': 'broken', 'C': 'missing'}
+            stamp = config.read_stamp(fname)
+            assert stamp['md5'] == good_md5 and stamp['size'] == len(data)
+            assert config.read_stamp(os.path.join(tmpdir, 'b.hdf5')) is None
+
+            # an up-to-date stamp is trusted, the file is not read again
+            with open(config._stamp_path(fname)) as f:
+                stamp = json.load(f)
+            stamp['md5'] = 'f' * 32
+            with open(config._stamp_path(fname), 'w') as f:
+                json.dump(stamp, f)
+            assert config.check_md5(fname, 'f' * 32)
+            assert not config.check_md5(fname, 'f' * 32, force=True)
+
+            # a modified file invalidates the stamp
+            with open(fname, 'r+b') as f:
+                f.write(b'corrupted')
+            assert config.read_stamp(fname) is None
+            future = config.verify_in_background(['A'])
+            assert future.result(timeout=30) == {'A': 'broken'}
+
+            path, future = config.fetch_grid('B', background=True)
+            assert path == os.path.join(tmpdir, 'b.hdf5')
+            assert future.result(timeout=30) == {'B': 'broken'}
+        finally:
+            config.grid_names, config.grid_data_dir, config.hash_chunk_bytes = saved
+
+
+def test_fetch_grid_download(monkeypatch):
+    data = os.urandom(1000)
+
+    def download(url, download_dir, expected_file_name):
+        with open(os.path.join(download_dir, expected_file_name), 'wb') as f:
+            f.write(data)
+
+    monkeypatch.setattr(config, 'download_from_jianguoyun', download)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(config, 'grid_names', {'A': ('a.hdf5', 'None', hashlib.md5(data).hexdigest())})
+        monkeypatch.setattr(config, 'grid_data_dir', tmpdir)
+        # a fresh download is verified at once, the future is already resolved
+        path, future = config.fetch_grid('A', background=True)
+        assert path == os.path.join(tmpdir, 'a.hdf5')
+        assert future.done() and future.result() == {'A': 'ok'}
+        path, future = config.fetch_grid('A', background=True)
+        assert future.result(timeout=30) == {'A': 'ok'}
+
+
+if __name__ == '__main__':
+    test_verify()